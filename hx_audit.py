@@ -1,40 +1,113 @@
 import xml.etree.ElementTree as ET
 import zipfile
 import json
-from collections import OrderedDict
+from collections import Counter
 
 def get_mime_type(generator):
 	return (generator in ['w32apifile-acquisition', 'w32disk-acquisition']) and 'application/octet-stream' or 'application/xml'
 
 # TODO: replace code that uses this with AuditPackage.audit_to_dict	
 def get_audit_records(audit_data, generator, item_name, fields=None, post_process=None, **static_values):
-	items = []
+	return list(iter_audit_records(audit_data, generator, item_name, fields=fields, post_process=post_process, **static_values))
+
+# Same records as get_audit_records, one at a time. The XML is parsed incrementally and each item element
+# is freed once its record is built, so memory use doesn't grow with the size of the audit.
+def iter_audit_records(audit_data, generator, item_name, fields=None, post_process=None, **static_values):
 	mime_type = get_mime_type(generator)
 	if mime_type == 'application/xml':
-		xml_items = ET.parse(audit_data).findall('./{0}'.format(item_name))
-		for xml_item in xml_items:
-			item = dict(static_values)
-			for e in xml_item:
-				if fields and e.tag not in fields:
-					continue
-				# TODO: we only recurse 1 level deep - should recurse further
-				if len(list(e)) > 0:
-					item[e.tag] = [(_.tag, _.text) for _ in e[0]]
-				else:
-					item[e.tag] = e.text
-						
-			if post_process:
-				item.update(post_process(audit_data))
+		root = None
+		depth = 0
+		for event, elem in ET.iterparse(audit_data, events = ("start", "end")):
+			if event == "start":
+				depth += 1
+				if depth == 1:
+					root = elem
+				continue
+			
+			depth -= 1
+			# Items are the children of the root element
+			if depth != 1:
+				continue
+			
+			if elem.tag == item_name:
+				item = dict(static_values)
+				for e in elem:
+					if fields and e.tag not in fields:
+						continue
+					# TODO: we only recurse 1 level deep - should recurse further
+					if len(e) > 0:
+						item[e.tag] = [(_.tag, _.text) for _ in e[0]]
+					else:
+						item[e.tag] = e.text
 				
-			items.append(item)	
+				if post_process:
+					item.update(post_process(audit_data))
+				
+				yield item
+			
+			# Free the item, and drop it from the root so the tree doesn't grow
+			elem.clear()
+			root.clear()
 	elif mime_type == 'application/octet-stream' and post_process:
 		item = dict(static_values)
 		item.update(post_process(audit_data))
-		items.append(item)
+		yield item
 	else:
 		#TODO: Unexpected mime_type?
 		pass
-	return items
+
+# Group records into lists of up to batch_size
+def iter_batches(records, batch_size):
+	batch = []
+	for record in records:
+		batch.append(record)
+		if len(batch) >= batch_size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+# The two functions below are module level and only take plain values so that they can be run in a worker
+# process, see hxtool_scheduler.run_in_process(). Rather than returning the records, which would have to be held 
+# and pickled as a whole, they write them to output_path as JSON lines for iter_json_lines() to read back.
+def write_audit_package_records(acquisition_package_path, output_path, generator, item_name, fields=None, post_process=None, **static_values):
+	count = 0
+	with open(output_path, 'w', encoding = 'utf-8') as f:
+		for record in iter_audit_package_records(acquisition_package_path, generator, item_name, fields=fields, post_process=post_process, **static_values):
+			f.write(json.dumps(record))
+			f.write('\n')
+			count += 1
+	return count
+
+def write_audit_package_dicts(acquisition_package_path, output_path, hostname, agent_id = None, batch_mode = True, flatten = False):
+	warnings = []
+	with open(output_path, 'w', encoding = 'utf-8') as f:
+		with AuditPackage(acquisition_package_path) as audit_package:
+			for audit in audit_package.audits:
+				try:
+					# audit_to_dict clears its results once they have been consumed, so write them out first
+					for record in audit_package.audit_to_dict(audit, hostname, agent_id = agent_id, batch_mode = batch_mode, flatten = flatten):
+						f.write(json.dumps(record))
+						f.write('\n')
+				except EmptyAuditException as e:
+					warnings.append(str(e))
+	return warnings
+
+def iter_json_lines(path):
+	with open(path, 'r', encoding = 'utf-8') as f:
+		for line in f:
+			yield json.loads(line)
+
+# The records of the generator's audit in an acquisition package, nothing if the package doesn't have that audit
+def iter_audit_package_records(acquisition_package_path, generator, item_name, fields=None, post_process=None, **static_values):
+	with AuditPackage(acquisition_package_path) as audit_package:
+		audit_data = audit_package.get_audit(generator=generator, open_only=True)
+		if audit_data:
+			try:
+				for record in iter_audit_records(audit_data, generator, item_name, fields=fields, post_process=post_process, **static_values):
+					yield record
+			finally:
+				audit_data.close()
 
 class EmptyAuditException(Exception): pass
 
@@ -101,7 +174,7 @@ class AuditPackage:
 		
 		return self.package.read(payload_name).decode('utf-8')	
 		
-	def audit_to_dict(self, audit, hostname, agent_id = None, batch_mode = True):
+	def audit_to_dict(self, audit, hostname, agent_id = None, batch_mode = True, flatten = False):
 		d = {
 				'hostname' : self.hostname or hostname,
 				'agent_id' : self.agent_id or agent_id,
@@ -117,28 +190,21 @@ class AuditPackage:
 				
 				if payload:
 					if result['type'] == 'application/xml':
-						payload_item_tag = None
 						batch_dict = {'results' : []}
-						xml_iterator = ET.iterparse(payload, events = ["start", "end"], parser = ET.XMLParser(encoding = 'utf-8'))
 						
-						(event, elem) = next(xml_iterator)
-						if elem.tag == "itemList" and event == "start":
-							if len(elem) == 0:
+						(root_tag, payload_item_tag) = self.get_payload_item_tag(result['payload'])
+						if root_tag == "itemList":
+							if payload_item_tag is None:
 								# Empty payload
 								return
 							
-							# Find the payload item element tag
-							(event, elem) = next(xml_iterator)
-							payload_item_tag = elem.tag
 							d['generator_item_name'] = payload_item_tag
 							
-							if payload_item_tag is None:
-								raise EmptyAuditException("The audit payload '{}' for generator '{}' is empty. Please manually inspect the audit package: {}".format(result['payload'], audit['generator'], self.package.filename)) 
-						
-							
+							# Now that the item tag is known only end events are needed, which halves the events the parser produces
+							xml_iterator = ET.iterparse(payload, events = ["end"], parser = ET.XMLParser(encoding = 'utf-8'))
 							for event, elem in xml_iterator:
-								if elem.tag == payload_item_tag and event == "end":
-									result_dict = self.xml_to_dict(elem)
+								if elem.tag == payload_item_tag:
+									result_dict = self.xml_to_dict(elem, flatten = flatten)
 							
 									# Free memory used by the elements
 									elem.clear()
@@ -188,22 +254,74 @@ class AuditPackage:
 								result_dict.clear()
 			return
 	
-	def xml_to_dict(self, element):
-		d = OrderedDict()
-
-		if len(element) > 0:
-			for child_element in element:
-				rc_element_dict = self.xml_to_dict(child_element)
-				sub_value = rc_element_dict[child_element.tag]
-
-				if child_element.tag in d:
-					if isinstance(d[child_element.tag], list):
-						d[child_element.tag].append(sub_value)
-					else:
-						d[child_element.tag] = [d[child_element.tag], sub_value]
+	# Returns the tag of the root element of an XML payload and the tag of its first child, the payload item tag.
+	# Only the start of the payload is parsed.
+	def get_payload_item_tag(self, payload_name):
+		root_tag = None
+		payload = self.get_audit(payload_name = payload_name, open_only = True)
+		try:
+			for event, elem in ET.iterparse(payload, events = ["start"], parser = ET.XMLParser(encoding = 'utf-8')):
+				if root_tag is None:
+					root_tag = elem.tag
 				else:
-					d[child_element.tag] = sub_value
-
-			return {element.tag : d}
-		else:
+					return (root_tag, elem.tag)
+		finally:
+			payload.close()
+		return (root_tag, None)
+	
+	# Converts an element to {tag : value}, where the value is the text of a leaf element, or a dictionary of
+	# the children of the element. Children with the same tag become a list. With flatten, the leaves of nested
+	# elements are stored under their path instead, i.e. {'PEInfo.DigitalSignature.SignatureExists' : 'true'}.
+	# Elements that repeat have their index in the path, i.e. {'Sections.Section.0.Name' : '.text'}, so that
+	# the values of each repeated element stay together, which suits columnar outputs.
+	# This is the per item hot path for large audits, so it walks the element with a stack rather than recursing.
+	def xml_to_dict(self, element, flatten = False, separator = '.'):
+		if len(element) == 0:
 			return {element.tag : element.text}
+		
+		d = {}
+		if flatten:
+			# (children, path prefix, number of children per tag, index of the next child per tag)
+			stack = [(iter(element), '', Counter([_.tag for _ in element]), {})]
+			while stack:
+				(children, prefix, counts, indexes) = stack[-1]
+				child = next(children, None)
+				if child is None:
+					stack.pop()
+					continue
+				
+				key = prefix + child.tag
+				if counts[child.tag] > 1:
+					index = indexes.get(child.tag, 0)
+					indexes[child.tag] = index + 1
+					key = key + separator + str(index)
+				
+				if len(child) > 0:
+					stack.append((iter(child), key + separator, Counter([_.tag for _ in child]), {}))
+				else:
+					d[key] = child.text
+			return {element.tag : d}
+		
+		stack = [(iter(element), d)]
+		while stack:
+			(children, parent) = stack[-1]
+			child = next(children, None)
+			if child is None:
+				stack.pop()
+				continue
+			
+			if len(child) > 0:
+				value = {}
+				stack.append((iter(child), value))
+			else:
+				value = child.text
+			
+			if child.tag in parent:
+				if isinstance(parent[child.tag], list):
+					parent[child.tag].append(value)
+				else:
+					parent[child.tag] = [parent[child.tag], value]
+			else:
+				parent[child.tag] = value
+		
+		return {element.tag : d}
@@ -9,7 +9,7 @@
 
 try:
 	import requests
-	from requests.packages.urllib3.exceptions import InsecureRequestWarning
+	from requests.packages.urllib3.exceptions import InsecureRequestWarning, ProtocolError, ReadTimeoutError
 except ImportError:
 	print("HXTool requires the 'requests' module, please install it.")
 	exit(1)
@@ -21,11 +21,16 @@ import logging
 import datetime
 import pickle
 import shutil
+import os
+import time
+from multiprocessing.pool import ThreadPool
 
 class HXAPI:
 	HX_DEFAULT_PORT = 3000
 	HX_MIN_API_VERSION = 2
 	DEFAULT_LIMIT = 100000
+	DOWNLOAD_CHUNK_SIZE = 1048576
+	DOWNLOAD_SEGMENT_SIZE = 67108864
 	
 	def __init__(self, hx_host, hx_port = HX_DEFAULT_PORT, headers = None, cookies = None, proxies = None, disable_certificate_verification = True, logger_name = None, default_encoding = 'utf-8'):
 		if logger_name:
@@ -624,27 +629,140 @@ class HXAPI:
 
 
 	# Download an acquisition (file)
-	def restDownloadFile(self, url, destination_file_path = None, accept = 'application/octet-stream'):
+	# When downloading to a file the data goes to destination_file_path.part first, so an interrupted download
+	# resumes with a Range request, on the next retry or the next call. With segments > 1 files of at least two segment_size
+	# are downloaded in up to that many parallel ranges, each over a session of its own.
+	def restDownloadFile(self, url, destination_file_path = None, accept = 'application/octet-stream', chunk_size = DOWNLOAD_CHUNK_SIZE, segments = 1, segment_size = DOWNLOAD_SEGMENT_SIZE, retries = 3):
 
-		request = self.build_request(url, accept = accept)
 		try:
-			response = self._session.send(request, stream = True)
-			
-			if not response.encoding:
-				response.encoding = self.default_encoding
-			
 			if destination_file_path: 
-				with open(destination_file_path, 'wb') as f:
-					shutil.copyfileobj(response.raw, f)
-				return(True, response.status_code, None)	
+				total_size = None
+				if segments > 1:
+					total_size = self._download_size(url, accept)
+				
+				if total_size and total_size >= segment_size * 2:
+					segment_count = min(segments, (total_size + segment_size - 1) // segment_size)
+					segment_length = (total_size + segment_count - 1) // segment_count
+					ranges = [(i * segment_length, min(total_size, (i + 1) * segment_length) - 1) for i in range(segment_count)]
+					part_paths = ['{}.part{}'.format(destination_file_path, i) for i in range(segment_count)]
+					self.logger.debug("Downloading %s in %d segments.", url, segment_count)
+					# requests.Session isn't thread safe
+					sessions = [self._download_session() for i in range(segment_count)]
+					download_pool = ThreadPool(segment_count)
+					try:
+						status_codes = download_pool.starmap(self._download_range, [(url, accept, part_paths[i], ranges[i][0], ranges[i][1], chunk_size, retries, sessions[i]) for i in range(segment_count)])
+					finally:
+						download_pool.close()
+						download_pool.join()
+						for session in sessions:
+							session.close()
+					response_code = status_codes[0]
+					
+					with open('{}.part'.format(destination_file_path), 'wb') as f:
+						for part_path in part_paths:
+							with open(part_path, 'rb') as part_file:
+								shutil.copyfileobj(part_file, f, chunk_size)
+					for part_path in part_paths:
+						os.remove(part_path)
+				else:
+					response_code = self._download_range(url, accept, '{}.part'.format(destination_file_path), 0, None, chunk_size, retries)
+				
+				part_path = '{}.part'.format(destination_file_path)
+				if total_size and os.path.getsize(part_path) != total_size:
+					self.logger.error("Download of %s is %d bytes, expected %d bytes.", url, os.path.getsize(part_path), total_size)
+					os.remove(part_path)
+					return(False, response_code, None)
+				
+				os.replace(part_path, destination_file_path)
+				return(True, response_code, None)	
 			else:
+				request = self.build_request(url, accept = accept)
+				response = self._session.send(request, stream = True)
+				
+				if not response.encoding:
+					response.encoding = self.default_encoding
+				
 				return(True, response.status_code, response)
 				
-		except (requests.HTTPError, requests.ConnectionError) as e:
+		except (requests.HTTPError, requests.ConnectionError, requests.exceptions.ChunkedEncodingError, ProtocolError, ReadTimeoutError) as e:
 			response_code = None
-			if e.response:
+			if hasattr(e, 'response') and e.response is not None:
 				response_code = e.response.status_code
 			return(False, response_code, e)
+	
+	# Total size of the file at url from a one byte Range request, or None if the server doesn't support ranges
+	def _download_size(self, url, accept):
+		request = self.build_request(url, accept = accept)
+		request.headers['Range'] = 'bytes=0-0'
+		response = self._session.send(request, stream = True)
+		try:
+			content_range = response.headers.get('Content-Range', '')
+			if response.status_code == 206 and '/' in content_range and not content_range.endswith('*'):
+				return int(content_range.rsplit('/', 1)[1])
+		finally:
+			response.close()
+		return None
+	
+	# A session for one segment of a segmented download. Requests are still prepared by self._session,
+	# so they carry its headers, token and cookies.
+	def _download_session(self):
+		session = requests.Session()
+		session.verify = self._session.verify
+		session.cert = self._session.cert
+		session.proxies = self._session.proxies.copy()
+		return session
+	
+	# Download bytes start to end (inclusive, None for the end of the file) of url, appending to what part_path already has
+	def _download_range(self, url, accept, part_path, start, end, chunk_size, retries, session = None):
+		if session is None:
+			session = self._session
+		attempt = 0
+		while True:
+			offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+			if end is not None and start + offset > end:
+				return 206
+			
+			request = self.build_request(url, accept = accept)
+			if start + offset > 0 or end is not None:
+				request.headers['Range'] = 'bytes={}-{}'.format(start + offset, end if end is not None else '')
+			try:
+				response = session.send(request, stream = True)
+				try:
+					# Nothing left to download
+					if response.status_code == 416 and offset > 0 and end is None:
+						return response.status_code
+					
+					if not response.ok:
+						response.raise_for_status()
+					
+					if 'X-FeApi-Token' in response.headers:
+						self.set_token(response.headers.get('X-FeApi-Token'))
+					
+					mode = 'ab'
+					if response.status_code != 206:
+						if start > 0:
+							raise requests.HTTPError("The server doesn't support Range requests.", response = response)
+						# The server ignored the Range header and is sending the whole file
+						mode = 'wb'
+					
+					with open(part_path, mode) as f:
+						shutil.copyfileobj(response.raw, f, chunk_size)
+						written = f.tell() - (offset if mode == 'ab' else 0)
+					
+					# A dropped connection can end the body early without raising
+					content_length = response.headers.get('Content-Length', None)
+					if content_length is not None and written < int(content_length):
+						raise requests.exceptions.ChunkedEncodingError("Incomplete download, received {} of {} bytes.".format(written, content_length))
+					
+					return response.status_code
+				finally:
+					response.close()
+			except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError, ProtocolError, ReadTimeoutError) as e:
+				attempt += 1
+				if attempt > retries:
+					raise
+				self.logger.warning("Download of %s interrupted, resuming. Attempt %d of %d. Error: %s", url, attempt, retries, e)
+				time.sleep(attempt)
 			
 	# Delete bulk acquisition file		
 	def restDeleteFile(self, url):
@@ -332,12 +332,11 @@ def multifile(hx_api_object):
 @app.route('/file_listing', methods=['GET'])
 @valid_session_required
 def file_listing(hx_api_object):
-	#TODO: Modify template and move to Ajax
 	fl_id = request.args.get('id')
 	file_listing = hxtool_global.hxtool_db.fileListingGetById(fl_id)
-	fl_results = file_listing['files']
+	# The results are paged in by the template from /api/v1/acquisition/multi/file_listing/results
 	display_fields = ['FullPath', 'Username', 'SizeInBytes', 'Modified', 'Sha256sum'] 
-	return render_template('ht_file_listing.html', user=session['ht_user'], controller='{0}:{1}'.format(hx_api_object.hx_host, hx_api_object.hx_port), file_listing=file_listing, fl_results=fl_results, display_fields=display_fields)
+	return render_template('ht_file_listing.html', user=session['ht_user'], controller='{0}:{1}'.format(hx_api_object.hx_host, hx_api_object.hx_port), file_listing=file_listing, display_fields=display_fields)
 
 ### Stacking
 @app.route('/stacking', methods=['GET'])
@@ -475,7 +474,7 @@ def app_init(debug = False):
 	
 	# Init DB
 	# Disable the write cache altogether - too many issues reported with it enabled.
-	hxtool_global.hxtool_db = hxtool_db(combine_app_path(hxtool_vars.data_path, 'hxtool.db'), 
+	hxtool_global.hxtool_db = open_database(hxtool_global.hxtool_config,
 										apicache = hxtool_global.hxtool_config.get_child_item('apicache', 'enabled', False),
 										apicache_refresh_interval = hxtool_global.hxtool_config.get_child_item('apicache', 'refresh_interval'),
 										write_cache_size = 0)
@@ -486,7 +485,9 @@ def app_init(debug = False):
 		hxtool_global.hxtool_x15_object = hxtool_x15()
 	
 	# Initialize the scheduler
-	hxtool_global.hxtool_scheduler = hxtool_scheduler(hxtool_global.hxtool_config['scheduler']['thread_count'])
+	hxtool_global.hxtool_scheduler = hxtool_scheduler(hxtool_global.hxtool_config['scheduler']['thread_count'], pool_sizes = hxtool_global.hxtool_config.get_child_item('scheduler', 'pools'), process_pool_size = hxtool_global.hxtool_config.get_child_item('scheduler', 'process_pool_size', 0),
+														history_length = hxtool_global.hxtool_config.get_child_item('scheduler', 'history_length'),
+														history_archive_path = combine_app_path(hxtool_vars.data_path, 'history') if hxtool_global.hxtool_config.get_child_item('scheduler', 'history_archive', False) else None)
 	hxtool_global.hxtool_scheduler.start()
 	
 	# Initialize background API sessions
@@ -495,6 +496,12 @@ def app_init(debug = False):
 	# Load tasks from the database after the task API sessions have been initialized
 	hxtool_global.hxtool_scheduler.load_from_database()
 	
+	# Schedule database retention and compaction
+	db_compaction_task = hxtool_scheduler_task("System", "Database Compaction", immutable = True)
+	db_compaction_task.set_schedule(minutes = hxtool_global.hxtool_config.get_child_item('database', 'compaction_interval', 60))
+	db_compaction_task.add_step(db_compaction_task_module)
+	hxtool_global.hxtool_scheduler.add(db_compaction_task)
+	
 	app.config['SESSION_COOKIE_NAME'] = "hxtool_session"
 	app.permanent_session_lifetime = datetime.timedelta(days=7)
 	app.session_interface = hxtool_session_interface(app, expiration_delta=hxtool_global.hxtool_config['network']['session_timeout'])
@@ -510,6 +517,22 @@ def app_init(debug = False):
 
 	set_svg_mimetype()
 
+def open_database(config, **kwargs):
+	db_engine = DB_ENGINE_TINYDB
+	if config:
+		db_engine = config.get_child_item('database', 'engine', DB_ENGINE_TINYDB)
+	if db_engine not in db_engine_file_names:
+		logger.error("Unknown database engine: %s, falling back to %s", db_engine, DB_ENGINE_TINYDB)
+		db_engine = DB_ENGINE_TINYDB
+	
+	# An existing TinyDB database is migrated the first time the SQLite engine is used
+	return hxtool_db(combine_app_path(hxtool_vars.data_path, db_engine_file_names[db_engine]),
+					db_engine = db_engine,
+					migrate_from = combine_app_path(hxtool_vars.data_path, db_engine_file_names[DB_ENGINE_TINYDB]),
+					journal = config.get_child_item('database', 'journal', False) if config else False,
+					journal_compact_size = config.get_child_item('database', 'journal_compact_size', 16777216) if config else 16777216,
+					**kwargs)
+
 # Version specific upgrade code goes here
 def hxtool_upgrade():
 	files_to_move = ['hxtool.db', 'conf.json', 'hxtool.key', 'hxtool.crt']
@@ -539,7 +562,7 @@ if __name__ == "__main__":
 			debug_mode = True
 		elif sys.argv[1] == '--clear-sessions':
 			print("Clearing sessions from the database and exiting.")
-			hxtool_db = hxtool_db(combine_app_path(hxtool_vars.data_path, 'hxtool.db'))
+			hxtool_db = open_database(hxtool_config(combine_app_path(hxtool_vars.data_path, 'conf.json')))
 			for s in hxtool_db.sessionList():
 				hxtool_db.sessionDelete(s['session_id'])
 			hxtool_db.close()
@@ -555,7 +578,7 @@ if __name__ == "__main__":
 			r = f("Do you want to proceed (Y/N)?")
 			if r.strip().lower() == 'y':
 				print("Clearing saved tasks from the database and exiting.")
-				hxtool_db = hxtool_db(combine_app_path(hxtool_vars.data_path, 'hxtool.db'))
+				hxtool_db = open_database(hxtool_config(combine_app_path(hxtool_vars.data_path, 'conf.json')))
 				for t in hxtool_db.taskList():
 					hxtool_db.taskDelete(t['profile_id'], t['task_id'])
 				hxtool_db.close()
@@ -443,35 +443,66 @@ def hxtool_api_scheduler_remove(hx_api_object):
 def scheduler_health(hx_api_object):
 	return(app.response_class(response=json.dumps(hxtool_global.hxtool_scheduler.status()), status=200, mimetype='application/json'))
 
+# Add ?format=prometheus for the Prometheus text format
+@ht_api.route('/api/v{0}/scheduler/metrics'.format(HXTOOL_API_VERSION), methods=['GET'])
+@valid_session_required
+def scheduler_metrics(hx_api_object):
+	metrics = hxtool_global.hxtool_scheduler.metrics()
+	if request.args.get('format') == 'prometheus':
+		return(app.response_class(response=hxtool_scheduler_metrics.prometheus(metrics), status=200, content_type='text/plain; version=0.0.4; charset=utf-8'))
+	return(app.response_class(response=json.dumps(metrics), status=200, mimetype='application/json'))
+
+# DataTables server-side processing: draw, start, length, search[value] and order[0][column]/order[0][dir]
 @ht_api.route('/api/v{0}/scheduler_tasks'.format(HXTOOL_API_VERSION), methods=['GET'])
 @valid_session_required
 def scheduler_tasks(hx_api_object):
+	scheduler_task_columns = {
+		'profile' : 'profile_id',
+		'profile_name' : 'profile_name',
+		'name' : 'name',
+		'enabled' : 'enabled',
+		'last_run' : 'last_run',
+		'next_run' : 'next_run',
+		'immutable' : 'immutable',
+		'state' : 'state'
+	}
+	
+	order_by = None
+	order_column = request.args.get('order[0][column]', None)
+	if order_column is not None:
+		order_by = scheduler_task_columns.get(request.args.get('columns[{}][data]'.format(order_column), None), None)
+	
+	start = request.args.get('start', 0, type = int)
+	length = request.args.get('length', -1, type = int)
+	
+	(records_total, records_filtered, tasks) = hxtool_global.hxtool_scheduler.task_page(offset = max(start, 0),
+																						limit = length if length > 0 else None,
+																						search = request.args.get('search[value]', None),
+																						order_by = order_by,
+																						descending = (request.args.get('order[0][dir]', 'asc') == 'desc'))
+	
 	mytasks = {}
 	mytasks['data'] = []
-	for task in hxtool_global.hxtool_scheduler.tasks():
-		if not task['parent_id']:
-
-			taskstates = {}
-			for subtask in hxtool_global.hxtool_scheduler.tasks():
-				if subtask['parent_id'] == task['task_id']:
-					if not task_state_description.get(subtask['state'], "Unknown") in taskstates.keys():
-						taskstates[task_state_description.get(subtask['state'], "Unknown")] = 1
-					else:
-						taskstates[task_state_description.get(subtask['state'], "Unknown")] += 1
-
-			mytasks['data'].append({
-				"DT_RowId": task['task_id'],
-				"profile": task['profile_id'],
-				"profile_name": task['profile_name'],
-				"child_states": json.dumps(taskstates),
-				"name": task['name'],
-				"enabled": task['enabled'],
-				"last_run": str(task['last_run']),
-				"next_run": str(task['next_run']),
-				"immutable": task['immutable'],
-				"state": task_state_description.get(task['state'], "Unknown"),
-				"action": task['task_id']
-				})
+	for task in tasks:
+		mytasks['data'].append({
+			"DT_RowId": task['task_id'],
+			"profile": task['profile_id'],
+			"profile_name": task['profile_name'],
+			"child_states": json.dumps(task['child_states']),
+			"name": task['name'],
+			"enabled": task['enabled'],
+			"last_run": str(task['last_run']),
+			"next_run": str(task['next_run']),
+			"immutable": task['immutable'],
+			"state": task_state_description.get(task['state'], "Unknown"),
+			"action": task['task_id']
+			})
+	
+	if 'draw' in request.args:
+		mytasks['draw'] = request.args.get('draw', 0, type = int)
+		mytasks['recordsTotal'] = records_total
+		mytasks['recordsFiltered'] = records_filtered
+	
 	return(app.response_class(response=json.dumps(mytasks), status=200, mimetype='application/json'))
 
 
@@ -1185,6 +1216,31 @@ def hxtool_api_acquisition_multi_file_listing_remove(hx_api_object):
 		return(app.response_class(response=json.dumps("OK"), status=200, mimetype='application/json'))
 
 
+@ht_api.route('/api/v{0}/acquisition/multi/file_listing/results'.format(HXTOOL_API_VERSION), methods=['GET'])
+@valid_session_required
+def hxtool_api_acquisition_multi_file_listing_results(hx_api_object):
+	file_listing_job = hxtool_global.hxtool_db.fileListingGetById(request.args.get('id'))
+	if not file_listing_job:
+		return make_response_by_code(404)
+	if session['ht_profileid'] != file_listing_job['profile_id']:
+		return make_response_by_code(401)
+	
+	# Also takes DataTables server-side processing parameters: draw, start and length
+	offset = int(request.args.get('offset', request.args.get('start', 0)))
+	limit = request.args.get('limit', request.args.get('length'))
+	if limit is not None:
+		limit = int(limit)
+		if limit < 0:
+			limit = None
+	
+	files = list(hxtool_global.hxtool_db.fileListingResults(file_listing_job.doc_id, offset = offset, limit = limit))
+	r = {'data' : files, 'offset' : offset, 'recordsTotal' : file_listing_job.get('file_count', 0)}
+	if 'draw' in request.args:
+		r['draw'] = request.args.get('draw', 0, type = int)
+		r['recordsFiltered'] = r['recordsTotal']
+	return(app.response_class(response=json.dumps(r), status=200, mimetype='application/json'))
+
+
 @ht_api.route('/api/v{0}/acquisition/multi/mf/stop'.format(HXTOOL_API_VERSION), methods=['GET'])
 @valid_session_required
 def hxtool_api_acquisition_multi_mf_stop(hx_api_object):
@@ -1247,7 +1303,8 @@ def hxtool_api_acquisition_multi_mf_new(hx_api_object):
 				if not file_listing:
 					app.logger.warn('File Listing %s does not exist - User: %s@%s:%s', session['ht_user'], fl_id, hx_api_object.hx_host, hx_api_object.hx_port)
 					continue
-				choice_files = [file_listing['files'][i] for i in file_ids if i <= len(file_listing['files'])]
+				file_ids = set(file_ids)
+				choice_files = [f for (i, f) in enumerate(hxtool_global.hxtool_db.fileListingResults(file_listing.doc_id)) if i in file_ids]
 				multi_file_eid = hxtool_global.hxtool_db.multiFileCreate(session['ht_user'], session['ht_profileid'], display_name=display_name, file_listing_id=file_listing.doc_id, api_mode=use_api_mode)
 				# Create a data acquisition for each file from its host
 				for cf in choice_files:
@@ -1299,7 +1356,7 @@ def datatable_multi_filelisting(hx_api_object):
 		job = dict(j)
 		job.update({'id': j.doc_id})
 		job['state'] = ("STOPPED" if job['stopped'] else "RUNNING")
-		job['file_count'] = len(job.pop('files'))
+		job['file_count'] = job.get('file_count', 0)
 
 		# Completion rate
 		bulk_download = hxtool_global.hxtool_db.bulkDownloadGet(bulk_download_eid = job['bulk_download_eid'])
@@ -1483,12 +1540,10 @@ def datatable_avcontent_detail(hx_api_object):
 
 	myversion = request.args.get('version')
 
-	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts()
-	for host in hresponse_data['data']['entries']:
-		(ret, response_code, response_data) = hx_api_object.restGetHostSysinfo(host['_id'])
-		if 'malware' in response_data['data']:
-			if 'av' in response_data['data']['malware']:
-				if myversion == response_data['data']['malware']['av']['content']['version']:
+	for (host, sysinfo) in host_sysinfo_list(hx_api_object, session['ht_profileid']):
+		if 'malware' in sysinfo:
+			if 'av' in sysinfo['malware']:
+				if myversion == sysinfo['malware']['av']['content']['version']:
 					mydata['data'].append({
 						"hostname": host['hostname'],
 						"agentid": host['_id'],
@@ -1502,8 +1557,6 @@ def datatable_avcontent_detail(hx_api_object):
 					"content_version": myversion
 					})
 
-	del hresponse_data
-
 	return(app.response_class(response=json.dumps(mydata), status=200, mimetype='application/json'))
 
 
@@ -1515,12 +1568,10 @@ def datatable_avengine_detail(hx_api_object):
 
 	myversion = request.args.get('version')
 
-	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts()
-	for host in hresponse_data['data']['entries']:
-		(ret, response_code, response_data) = hx_api_object.restGetHostSysinfo(host['_id'])
-		if 'malware' in response_data['data']:
-			if 'av' in response_data['data']['malware']:
-				if myversion == response_data['data']['malware']['av']['engine']['version']:
+	for (host, sysinfo) in host_sysinfo_list(hx_api_object, session['ht_profileid']):
+		if 'malware' in sysinfo:
+			if 'av' in sysinfo['malware']:
+				if myversion == sysinfo['malware']['av']['engine']['version']:
 					mydata['data'].append({
 						"hostname": host['hostname'],
 						"agentid": host['_id'],
@@ -1534,8 +1585,6 @@ def datatable_avengine_detail(hx_api_object):
 					"engine_version": myversion
 					})
 
-	del hresponse_data
-
 	return(app.response_class(response=json.dumps(mydata), status=200, mimetype='application/json'))
 
 @ht_api.route('/api/v{0}/datatable/avstatus'.format(HXTOOL_API_VERSION), methods=['GET'])
@@ -1546,11 +1595,9 @@ def datatable_avstatus_detail(hx_api_object):
 
 	mystate = request.args.get('state')
 
-	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts()
-	for host in hresponse_data['data']['entries']:
-		(ret, response_code, response_data) = hx_api_object.restGetHostSysinfo(host['_id'])
-		if 'MalwareProtectionStatus' in response_data['data']:
-			if mystate == response_data['data']['MalwareProtectionStatus']:
+	for (host, sysinfo) in host_sysinfo_list(hx_api_object, session['ht_profileid']):
+		if 'MalwareProtectionStatus' in sysinfo:
+			if mystate == sysinfo['MalwareProtectionStatus']:
 				mydata['data'].append({
 					"hostname": host['hostname'],
 					"agentid": host['_id'],
@@ -1564,8 +1611,6 @@ def datatable_avstatus_detail(hx_api_object):
 					"state": mystate
 					})
 
-	del hresponse_data
-
 	return(app.response_class(response=json.dumps(mydata), status=200, mimetype='application/json'))
 
 @ht_api.route('/api/v{0}/datatable_categories'.format(HXTOOL_API_VERSION), methods=['GET'])
@@ -2281,23 +2326,25 @@ def datatable_es_result(hx_api_object):
 @valid_session_required
 def chartjs_agentstatus(hx_api_object):
 
-	(ret, response_code, response_data) = hx_api_object.restListHosts(limit=100000)
-
 	myField = request.args.get('field')
-	myData = {}
+	myData = apicache_histogram(session['ht_profileid'], myField)
 
-	for host in response_data['data']['entries']:
-		if "." in myField:
-			item1, item2 = myField.split(".")
-			if host[item1][item2] not in myData.keys():
-				myData[host[item1][item2]] = 0
-			myData[host[item1][item2]] += 1
-		else:
-			if host[myField] not in myData.keys():
-				myData[host[myField]] = 0
-			myData[host[myField]] += 1
+	if myData is None:
+		(ret, response_code, response_data) = hx_api_object.restListHosts(limit=100000)
+		myData = {}
+
+		for host in response_data['data']['entries']:
+			if "." in myField:
+				item1, item2 = myField.split(".")
+				if host[item1][item2] not in myData.keys():
+					myData[host[item1][item2]] = 0
+				myData[host[item1][item2]] += 1
+			else:
+				if host[myField] not in myData.keys():
+					myData[host[myField]] = 0
+				myData[host[myField]] += 1
 
-	del response_data
+		del response_data
 
 	myPattern = ["#0fb8dc", "#006b8c", "#fb715e", "#59dc90", "#11a962", "#99ddff", "#ffe352", "#f0950e", "#ea475b", "#00cbbe"]
 	random.shuffle(myPattern)
@@ -2322,32 +2369,28 @@ def chartjs_agentstatus(hx_api_object):
 def chartjs_malwarecontent(hx_api_object):
 	if request.method == 'GET':
 		
-		myContent = {}
-		myContent['none'] = 0
 		myData = {}
 		myData['labels'] = []
 		myData['datasets'] = []
 
-		(ret, response_code, response_data) = hx_api_object.restListHosts(limit=100000)
-		if ret:
-			for host in response_data['data']['entries']:
-				(sret, sresponse_code, sresponse_data) = hx_api_object.restGetHostSysinfo(host['_id'])
-				if sret and 'malware' in sresponse_data['data'].keys():
-					if 'av' in sresponse_data['data']['malware'].keys():
-						if 'content' in sresponse_data['data']['malware']['av'].keys():
-							if not sresponse_data['data']['malware']['av']['content']['version'] in myContent.keys():
-								myContent[sresponse_data['data']['malware']['av']['content']['version']] = 1
+		myContent = apicache_histogram(session['ht_profileid'], 'content_version')
+		if myContent is None:
+			myContent = {'none' : 0}
+			for (host, sysinfo) in host_sysinfo_list(hx_api_object, session['ht_profileid']):
+				if 'malware' in sysinfo.keys():
+					if 'av' in sysinfo['malware'].keys():
+						if 'content' in sysinfo['malware']['av'].keys():
+							if not sysinfo['malware']['av']['content']['version'] in myContent.keys():
+								myContent[sysinfo['malware']['av']['content']['version']] = 1
 							else:
-								myContent[sresponse_data['data']['malware']['av']['content']['version']] += 1
+								myContent[sysinfo['malware']['av']['content']['version']] += 1
 						else:
 							myContent['none'] += 1
 					else:
 						myContent['none'] += 1
 				else:
 					myContent['none'] += 1
-		
-		del response_data
-		
+
 		dataset = []
 		mylist = []
 		for ckey, cval in myContent.items():
@@ -2380,23 +2423,21 @@ def chartjs_malwarecontent(hx_api_object):
 def chartjs_malwareengine(hx_api_object):
 	if request.method == 'GET':
 		
-		myContent = {}
-		myContent['none'] = 0
 		myData = {}
 		myData['labels'] = []
 		myData['datasets'] = []
 
-		(ret, response_code, response_data) = hx_api_object.restListHosts(limit=100000)
-		if ret:
-			for host in response_data['data']['entries']:
-				(sret, sresponse_code, sresponse_data) = hx_api_object.restGetHostSysinfo(host['_id'])
-				if sret and 'malware' in sresponse_data['data'].keys():
-					if 'av' in sresponse_data['data']['malware'].keys():
-						if 'content' in sresponse_data['data']['malware']['av'].keys():
-							if not sresponse_data['data']['malware']['av']['engine']['version'] in myContent.keys():
-								myContent[sresponse_data['data']['malware']['av']['engine']['version']] = 1
+		myContent = apicache_histogram(session['ht_profileid'], 'engine_version')
+		if myContent is None:
+			myContent = {'none' : 0}
+			for (host, sysinfo) in host_sysinfo_list(hx_api_object, session['ht_profileid']):
+				if 'malware' in sysinfo.keys():
+					if 'av' in sysinfo['malware'].keys():
+						if 'content' in sysinfo['malware']['av'].keys():
+							if not sysinfo['malware']['av']['engine']['version'] in myContent.keys():
+								myContent[sysinfo['malware']['av']['engine']['version']] = 1
 							else:
-								myContent[sresponse_data['data']['malware']['av']['engine']['version']] += 1
+								myContent[sysinfo['malware']['av']['engine']['version']] += 1
 						else:
 							myContent['none'] += 1
 					else:
@@ -2404,8 +2445,6 @@ def chartjs_malwareengine(hx_api_object):
 				else:
 					myContent['none'] += 1
 
-		del response_data
-
 		dataset = []
 		mylist = []
 		for ckey, cval in myContent.items():
@@ -2437,26 +2476,22 @@ def chartjs_malwareengine(hx_api_object):
 def chartjs_malwarestatus(hx_api_object):
 	if request.method == 'GET':
 		
-		myContent = {}
-		myContent['none'] = 0
 		myData = {}
 		myData['labels'] = []
 		myData['datasets'] = []
 
-		(ret, response_code, response_data) = hx_api_object.restListHosts(limit=100000)
-		if ret:
-			for host in response_data['data']['entries']:
-				(sret, sresponse_code, sresponse_data) = hx_api_object.restGetHostSysinfo(host['_id'])
-				if 'MalwareProtectionStatus' in sresponse_data['data'].keys():
-					if not sresponse_data['data']['MalwareProtectionStatus'] in myContent.keys():
-						myContent[sresponse_data['data']['MalwareProtectionStatus']] = 1
+		myContent = apicache_histogram(session['ht_profileid'], 'protection_status')
+		if myContent is None:
+			myContent = {'none' : 0}
+			for (host, sysinfo) in host_sysinfo_list(hx_api_object, session['ht_profileid']):
+				if 'MalwareProtectionStatus' in sysinfo.keys():
+					if not sysinfo['MalwareProtectionStatus'] in myContent.keys():
+						myContent[sysinfo['MalwareProtectionStatus']] = 1
 					else:
-						myContent[sresponse_data['data']['MalwareProtectionStatus']] += 1
+						myContent[sysinfo['MalwareProtectionStatus']] += 1
 				else:
 					myContent['none'] += 1
 
-		del response_data
-
 		dataset = []
 		mylist = []
 		for ckey, cval in myContent.items():
@@ -2904,7 +2939,19 @@ def stack_job_results(hx_api_object, stack_job_eid):
 		return make_response_by_code(401)
 		
 	ht_data_model = hxtool_data_models(stack_job['stack_type'])
-	return ht_data_model.stack_data(stack_job['results'])	
+	return ht_data_model.stack_data(hxtool_global.hxtool_db.stackJobResults(stack_job.doc_id))	
+
+
+#####################
+# Database API calls #
+#####################
+@ht_api.route('/api/v{0}/db/statistics'.format(HXTOOL_API_VERSION), methods=['GET'])
+@valid_session_required
+def db_statistics(hx_api_object):
+	mystats = {}
+	mystats['locks'] = hxtool_global.hxtool_db.lockStatistics()
+	mystats['sizes'] = hxtool_global.hxtool_db.sizeStatistics()
+	return(app.response_class(response=json.dumps(mystats), status=200, mimetype='application/json'))
 
 
 #####################
@@ -2931,6 +2978,10 @@ def cache_statistics(hx_api_object):
 			mystats[k] = {}
 			mystats[k]['settings'] = v['settings']
 			mystats[k]['records processed'] = v['stats']['records']
+			mystats[k]['cursor'] = v['stats'].get('cursor')
+			mystats[k]['last full sweep'] = v['stats'].get('last_full_sweep')
+			if 'sysinfo' in v['stats']:
+				mystats[k]['sysinfo'] = v['stats']['sysinfo']
 
 		return(app.response_class(response=json.dumps(mystats), status=200, mimetype='application/json'))
 	else:
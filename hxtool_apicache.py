@@ -4,19 +4,119 @@
 import hxtool_logging
 import hxtool_global
 import time
-from collections import deque
+import threading
+from collections import deque, Counter
+from multiprocessing.pool import ThreadPool
 
 from hx_lib import *
 from hxtool_scheduler import *
 from hxtool_db import *
 
 
+"""
+Host counts by agent and AV attributes for the dashboards, kept up to date by the apicache
+as host and sysinfo records are written, so that a dashboard doesn't have to walk every host.
+"""
+class hxtool_api_cache_aggregates:
+	HOST_FIELDS = ['agent_version', 'domain', 'timezone', 'containment_state', 'containment_queued', 'containment_missing_software', 'reported_clone', 'os.product_name']
+	SYSINFO_FIELDS = ['content_version', 'engine_version', 'protection_status']
+
+	def __init__(self):
+		# Set once the first full host sweep and its sysinfo requests are done
+		self.complete = False
+		self._lock = threading.Lock()
+		self._histograms = {k : Counter() for k in self.HOST_FIELDS + self.SYSINFO_FIELDS}
+		self._host_values = {}
+
+	def update_host(self, host):
+		values = {}
+		for field in self.HOST_FIELDS:
+			value = host
+			for k in field.split('.'):
+				value = value.get(k) if isinstance(value, dict) else None
+			values[field] = value
+		self._update(host['_id'], values, initial = {k : 'none' for k in self.SYSINFO_FIELDS})
+
+	# Sysinfo for a host that has been removed in the meantime is ignored
+	def update_sysinfo(self, host_id, sysinfo):
+		av = sysinfo.get('malware', {}).get('av', {})
+		self._update(host_id, {
+			'content_version' : av['content']['version'] if 'content' in av else 'none',
+			'engine_version' : av['engine']['version'] if 'engine' in av else 'none',
+			'protection_status' : sysinfo.get('MalwareProtectionStatus', 'none')
+		}, create = False)
+
+	def remove_host(self, host_id):
+		with self._lock:
+			host_values = self._host_values.pop(host_id, None)
+			if host_values is not None:
+				for field, value in host_values.items():
+					self._decrement(field, value)
+
+	def host_ids(self):
+		with self._lock:
+			return set(self._host_values.keys())
+
+	def _update(self, host_id, values, initial = {}, create = True):
+		with self._lock:
+			host_values = self._host_values.get(host_id)
+			if host_values is None:
+				if not create:
+					return
+				host_values = self._host_values[host_id] = {}
+				values = dict(initial, **values)
+			for field, value in values.items():
+				if field in host_values:
+					self._decrement(field, host_values[field])
+				self._histograms[field][value] += 1
+				host_values[field] = value
+
+	def _decrement(self, field, value):
+		histogram = self._histograms[field]
+		histogram[value] -= 1
+		if histogram[value] <= 0:
+			del histogram[value]
+
+	# None for fields that aren't aggregated
+	def histogram(self, field):
+		with self._lock:
+			return dict(self._histograms[field]) if field in self._histograms else None
+
 class hxtool_api_cache:
 	def __init__(self, hx_api_object, profile_id, intervals, objectTypes):
 		self.logger = hxtool_logging.getLogger(__name__)
 		self.hx_api_object = hx_api_object
 		self.profile_id = profile_id
 
+		# The list function for each object type, and the field used as the cursor for incremental sweeps. Hosts have
+		# last_poll_timestamp, which advances when a host changes. The other types have no modification time to sort on,
+		# so their cursor is _id: incremental sweeps only pick up new objects, changes to existing ones (i.e. alert
+		# resolution, triage or acquisition state) are picked up by the next full sweep.
+		self.list_functions = {
+			'host' : (self.hx_api_object.restListHosts, 'last_poll_timestamp'),
+			'alert' : (self.hx_api_object.restGetAlerts, '_id'),
+			'triage' : (self.hx_api_object.restListTriages, '_id'),
+			'file' : (self.hx_api_object.restListFileaq, '_id'),
+			'live' : (self.hx_api_object.restListDataAcquisitions, '_id')
+		}
+		self.cursors = {}
+		self.last_full_sweep = {}
+		self.aggregates = hxtool_global.apicache_aggregates[self.profile_id] = hxtool_api_cache_aggregates()
+
+		# Host sysinfo is fetched by a bounded pool of workers per controller. At most sysinfo_queue_size
+		# requests are outstanding (the host pipeline blocks until a slot frees up), and requests are spaced
+		# so that no more than sysinfo_rate_limit are sent to the controller per second (0 is unlimited).
+		self.sysinfo_concurrency = max(1, hxtool_global.hxtool_config.get_child_item('apicache', 'sysinfo_concurrency', 4))
+		self.sysinfo_rate_limit = hxtool_global.hxtool_config.get_child_item('apicache', 'sysinfo_rate_limit', 10)
+		self.sysinfo_pool = None
+		self._sysinfo_slots = threading.BoundedSemaphore(max(self.sysinfo_concurrency, hxtool_global.hxtool_config.get_child_item('apicache', 'sysinfo_queue_size', 100)))
+		self._sysinfo_pending = 0
+		self._sysinfo_condition = threading.Condition()
+		self._sysinfo_rate_lock = threading.Lock()
+		self._sysinfo_next_request = 0
+		if 'host' in objectTypes:
+			self.sysinfo_pool = ThreadPool(self.sysinfo_concurrency)
+
 		# TEMP: drop cache
 		hxtool_global.hxtool_db.cacheDrop(self.profile_id)
 
@@ -26,6 +126,7 @@ class hxtool_api_cache:
 					setattr(self, objectType + "_fetcher_interval", intervals[objectType]["fetcher_interval"])
 					setattr(self, objectType + "_objects_per_poll", intervals[objectType]["objects_per_poll"])
 					setattr(self, objectType + "_refresh_interval", intervals[objectType]["refresh_interval"])
+					setattr(self, objectType + "_reconcile_interval", intervals[objectType].get("reconcile_interval"))
 				except:
 					self.logger.error("Missing interval settings for {}, check configuration to enable cache".format(objectType))
 					exit(2)
@@ -38,10 +139,13 @@ class hxtool_api_cache:
 
 		stats = {}
 		for k, v in intervals.items():
-			stats[k] = {"settings": v, "stats": {"records": 0, "timeline": deque([], maxlen=1000)}}
+			stats[k] = {"settings": v, "stats": {"records": 0, "timeline": deque([], maxlen=1000), "cursor": None, "last_full_sweep": None}}
+		if 'host' in stats:
+			stats['host']['stats']['sysinfo'] = {"concurrency": self.sysinfo_concurrency, "rate_limit": self.sysinfo_rate_limit, "queued": 0, "fetched": 0, "failed": 0, "requests_per_second": 0.0}
 
 		hxtool_global.apicache = { "started" : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "types" : objectTypes, "data": stats }
 
+	# With myCache set to None, the cache entries are looked up one record at a time (incremental sweeps)
 	def apicache_processor(self, currOffset, objectType, records, myCache, refresh_interval):
 
 		s_start = datetime.datetime.now()
@@ -54,19 +158,17 @@ class hxtool_api_cache:
 			s_total += 1
 			currOffset += 1
 
-			if record['_id'] in myCache.keys():
-				t = datetime.datetime.now() - datetime.datetime.strptime(myCache[record['_id']], "%Y-%m-%d %H:%M:%S")
-				if t.seconds > refresh_interval:
+			update_timestamp = myCache.get(record['_id']) if myCache is not None else hxtool_global.hxtool_db.cacheGetUpdateTime(self.profile_id, objectType, record['_id'])
+			if update_timestamp is not None:
+				if time.time() - update_timestamp > refresh_interval:
 					hxtool_global.hxtool_db.cacheUpdate(self.profile_id, objectType, record['_id'], record)
 					s_update += 1
 					self.logger.debug("{}: {} record updated: {}".format(self.profile_id, objectType, record['_id']))
 
 					# Special case, also get sysinfo for hosts
 					if objectType == "host":
-						(ret, response_code, response_data) = self.hx_api_object.restGetHostSysinfo(record['_id'])
-						if ret:
-							hxtool_global.hxtool_db.cacheUpdate(self.profile_id, "sysinfo", record['_id'], response_data['data'])
-							self.logger.debug("{}: Host sysinfo record updated: {}".format(self.profile_id, record['_id']))
+						self.aggregates.update_host(record)
+						self.sysinfo_submit(record['_id'])
 			else:
 				hxtool_global.hxtool_db.cacheAdd(self.profile_id, objectType, record)
 				s_add += 1
@@ -74,10 +176,8 @@ class hxtool_api_cache:
 
 				# Special case, also get sysinfo for hosts
 				if objectType == "host":
-					(ret, response_code, response_data) = self.hx_api_object.restGetHostSysinfo(record['_id'])
-					if ret:
-						hxtool_global.hxtool_db.cacheAddById(self.profile_id, "sysinfo", record['_id'], response_data['data'])
-						self.logger.debug("{}: New sysinfo record added: {}".format(self.profile_id, record['_id']))
+					self.aggregates.update_host(record)
+					self.sysinfo_submit(record['_id'])
 
 		# Process stats
 		s_end = datetime.datetime.now()
@@ -91,62 +191,144 @@ class hxtool_api_cache:
 
 		return currOffset
 
+	# Blocks while sysinfo_queue_size requests are outstanding
+	def sysinfo_submit(self, host_id):
+		self._sysinfo_slots.acquire()
+		with self._sysinfo_condition:
+			self._sysinfo_pending += 1
+		try:
+			self.sysinfo_pool.apply_async(self.sysinfo_fetch, args = (host_id,))
+		except Exception as e:
+			self.logger.error(pretty_exceptions(e))
+			self._sysinfo_done()
+
+	def sysinfo_fetch(self, host_id):
+		try:
+			if self.sysinfo_rate_limit:
+				with self._sysinfo_rate_lock:
+					now = time.time()
+					wait = self._sysinfo_next_request - now
+					self._sysinfo_next_request = max(now, self._sysinfo_next_request) + 1.0 / self.sysinfo_rate_limit
+				if wait > 0:
+					time.sleep(wait)
+			(ret, response_code, response_data) = self.hx_api_object.restGetHostSysinfo(host_id)
+			if ret:
+				self.aggregates.update_sysinfo(host_id, response_data['data'])
+				if hxtool_global.hxtool_db.cacheGetUpdateTime(self.profile_id, "sysinfo", host_id) is None:
+					hxtool_global.hxtool_db.cacheAddById(self.profile_id, "sysinfo", host_id, response_data['data'])
+					self.logger.debug("{}: New sysinfo record added: {}".format(self.profile_id, host_id))
+				else:
+					hxtool_global.hxtool_db.cacheUpdate(self.profile_id, "sysinfo", host_id, response_data['data'])
+					self.logger.debug("{}: Host sysinfo record updated: {}".format(self.profile_id, host_id))
+			self._sysinfo_done(fetched = ret)
+		except Exception as e:
+			self.logger.error(pretty_exceptions(e))
+			self._sysinfo_done()
+
+	def _sysinfo_done(self, fetched = False):
+		with self._sysinfo_condition:
+			self._sysinfo_pending -= 1
+			self._sysinfo_condition.notify_all()
+			stats = hxtool_global.apicache['data']['host']['stats']['sysinfo']
+			stats['fetched' if fetched else 'failed'] += 1
+			stats['queued'] = self._sysinfo_pending
+		self._sysinfo_slots.release()
+
+	# Wait for the outstanding sysinfo requests
+	def sysinfo_wait(self):
+		with self._sysinfo_condition:
+			while self._sysinfo_pending > 0:
+				self._sysinfo_condition.wait()
+
 	def apicache_fetcher(self, objectType):
 
 		#Temp workaround
 		time.sleep(2)
 
-		# Get a list of current cache entries for this object type
-		res = hxtool_global.hxtool_db.cacheList(self.profile_id, objectType)
+		fetch_start = time.time()
+		objects_per_poll = getattr(self, objectType + "_objects_per_poll")
+		refresh_interval = getattr(self, objectType + "_refresh_interval")
+		reconcile_interval = getattr(self, objectType + "_reconcile_interval", None)
+		(list_function, cursor_field) = self.list_functions[objectType]
+		cursor = self.cursors.get(objectType)
+		stats = hxtool_global.apicache['data'][objectType]['stats']
+		sysinfo_start_count = (stats['sysinfo']['fetched'] + stats['sysinfo']['failed']) if 'sysinfo' in stats else 0
 
-		# Format the local cache results into a dict
-		myCache = {}
-		for cacheEntry in res:
-			myCache[cacheEntry['contentId']] = cacheEntry['update_timestamp']
-		
-		# We always start the query from the top (always check everything)
-		myoffset = 0
+		# Do a full sweep when incremental mode is off, on the first run, and every reconcile_interval seconds
+		if not reconcile_interval or cursor is None or time.time() - self.last_full_sweep.get(objectType, 0) > reconcile_interval:
+			# Get a list of current cache entries for this object type
+			res = hxtool_global.hxtool_db.cacheList(self.profile_id, objectType)
 
-		if objectType == "host":
-			while True:
-				(ret, response_code, response_data) = self.hx_api_object.restListHosts(offset=myoffset, sort_term="_id+ascending", limit=self.host_objects_per_poll)
-				if ret:
-					# Leave loop if no new records are returned
-					if len(response_data['data']['entries']) == 0:
-						break
-					myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, self.host_refresh_interval)
+			# Format the local cache results into a dict
+			myCache = {}
+			for cacheEntry in res:
+				myCache[cacheEntry['contentId']] = cacheEntry['update_timestamp']
+			res = None
 
-		elif objectType == "alert":
+			# We always start the query from the top (always check everything)
+			myoffset = 0
+			sweep_start = time.time()
+			seen = set()
 			while True:
-				(ret, response_code, response_data) = self.hx_api_object.restGetAlerts(offset=myoffset, sort_term="_id+ascending", limit=self.alert_objects_per_poll)
-				if ret:
-					if len(response_data['data']['entries']) == 0:
-						break
-					myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, self.alert_refresh_interval)
+				(ret, response_code, response_data) = list_function(offset=myoffset, sort_term="_id+ascending", limit=objects_per_poll)
+				# Leave loop if no new records are returned
+				if not ret or len(response_data['data']['entries']) == 0:
+					break
+				for record in response_data['data']['entries']:
+					seen.add(record['_id'])
+					if record.get(cursor_field) is not None and (cursor is None or record[cursor_field] > cursor):
+						cursor = record[cursor_field]
+				myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, refresh_interval)
 
-		elif objectType == "triage":
-			while True:
-				(ret, response_code, response_data) = self.hx_api_object.restListTriages(offset=myoffset, sort_term="_id+ascending", limit=self.triage_objects_per_poll)
-				if ret:
-					if len(response_data['data']['entries']) == 0:
-						break
-					myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, self.triage_refresh_interval)
+			# Only advance the cursors if the sweep wasn't cut short by an API error
+			if ret:
+				self.last_full_sweep[objectType] = sweep_start
+				self.cursors[objectType] = cursor
+				stats['last_full_sweep'] = datetime.datetime.fromtimestamp(sweep_start).strftime("%Y-%m-%d %H:%M:%S")
+				
+				# Hosts that the controller no longer lists, i.e. deleted hosts, no longer count towards the dashboards
+				if objectType == "host":
+					removed_host_ids = self.aggregates.host_ids() - seen
+					for host_id in removed_host_ids:
+						self.aggregates.remove_host(host_id)
+					if removed_host_ids:
+						self.logger.info("{}: {} hosts removed from the host aggregates".format(self.profile_id, len(removed_host_ids)))
 
-		elif objectType == "file":
+		# Incremental sweep: walk the objects newest first and stop at the first one that is older than the cursor. Objects
+		# with the same cursor value as the cursor are processed again, as they may not all have been seen by the last sweep.
+		else:
+			myoffset = 0
+			new_cursor = cursor
 			while True:
-				(ret, response_code, response_data) = self.hx_api_object.restListFileaq(offset=myoffset, sort_term="_id+ascending", limit=self.file_objects_per_poll)
-				if ret:
-					if len(response_data['data']['entries']) == 0:
+				(ret, response_code, response_data) = list_function(offset=myoffset, sort_term="{}+descending".format(cursor_field), limit=objects_per_poll)
+				if not ret or len(response_data['data']['entries']) == 0:
+					break
+				records = []
+				for record in response_data['data']['entries']:
+					if record.get(cursor_field) is None or record[cursor_field] < cursor:
 						break
-					myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, self.file_refresh_interval)
+					if record[cursor_field] > new_cursor:
+						new_cursor = record[cursor_field]
+					records.append(record)
+				if records:
+					myoffset = self.apicache_processor(myoffset, objectType, records, None, refresh_interval)
+				if len(records) < len(response_data['data']['entries']):
+					break
 
-		elif objectType == "live":
-			while True:
-				(ret, response_code, response_data) = self.hx_api_object.restListDataAcquisitions(offset=myoffset, sort_term="_id+ascending", limit=self.live_objects_per_poll)
-				if ret:
-					if len(response_data['data']['entries']) == 0:
-						break
-					myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, self.live_refresh_interval)
+			if ret:
+				self.cursors[objectType] = new_cursor
 
-		return True
+		stats['cursor'] = self.cursors.get(objectType)
+
+		# Don't let the next host run start until this run's sysinfo requests are done
+		if objectType == "host" and self.sysinfo_pool is not None:
+			self.sysinfo_wait()
+			if objectType in self.last_full_sweep:
+				self.aggregates.complete = True
+			sysinfo_stats = stats['sysinfo']
+			request_count = sysinfo_stats['fetched'] + sysinfo_stats['failed'] - sysinfo_start_count
+			if request_count > 0:
+				sysinfo_stats['requests_per_second'] = request_count / max(time.time() - fetch_start, 0.001)
+				self.logger.info("{}: {} sysinfo records fetched at {:.1f} requests per second".format(self.profile_id, request_count, sysinfo_stats['requests_per_second']))
 
+		return True
@@ -37,7 +37,34 @@ class hxtool_config:
 		},
 		'scheduler' : {
 			'thread_count' : None,
-			'defer_interval' : 30
+			'defer_interval' : 30,
+			'pools' : {
+				'io' : None,
+				'parse' : None,
+				'system' : 8,
+				'download' : 8
+			},
+			'process_pool_size' : 0,
+			'audit_batch_size' : 1000,
+			'bulk_download_concurrency' : 8,
+			'bulk_download_retries' : 3,
+			'defer_max_interval' : 3600,
+			'bulk_status_ttl' : 30,
+			'history_length' : 1000,
+			'history_archive' : False
+		},
+		'database' : {
+			'engine' : 'tinydb',
+			'journal' : False,
+			'journal_compact_size' : 16777216,
+			'compaction_interval' : 60,
+			'retention' : {}
+		},
+		'download' : {
+			'chunk_size' : 1048576,
+			'segments' : 1,
+			'segment_size' : 67108864,
+			'retries' : 3
 		},
 		'headers' : {
 		},
@@ -84,7 +111,8 @@ class hxtool_config:
 			if self[parent_key] is not None:
 				return self[parent_key].get(child_key, default)
 		except TypeError:
-			return default
+			pass
+		return default
 			
 	def get_config(self):
 		return self._config
@@ -3,6 +3,10 @@
 
 import xml.etree.ElementTree as ET
 import hashlib
+import json
+from collections import OrderedDict
+
+from hx_audit import iter_batches
 try:
 	from pandas import DataFrame
 except ImportError:
@@ -13,33 +17,38 @@ class hxtool_data_models:
 	def __init__(self, stack_type):
 		self.stack_type = self.stack_types[stack_type]
 	
-	def stack_data(self, data, index = None, group_by = None):
-		if len(data) > 0:
-	
-			if not index:
-				index = self.stack_type['default_index']
-			if not group_by:
-				group_by = self.stack_type['default_groupby']
- 
-			try:
-				data_frame = DataFrame(data).astype(unicode)
-			except NameError:
-				# under Python 3, str is unicode
-				data_frame = DataFrame(data).astype(str)
- 
-			data_frame.replace('nan', '', inplace = True)
+	# Groups the records by group_by, with the distinct index values of each group, most common group first.
+	# records can be any iterable, i.e. the stream of a stacking job's results. It's aggregated batch_size records
+	# at a time, so only the groups are held in memory rather than every record.
+	def stack_data(self, records, index = None, group_by = None, batch_size = 10000):
+		if not index:
+			index = self.stack_type['default_index']
+		if not group_by:
+			group_by = self.stack_type['default_groupby']
+		
+		columns = list(group_by) + [index]
+		groups = OrderedDict()
+		for batch in iter_batches(records, batch_size):
+			# Missing fields, including ones that none of the records in the batch have, are empty
+			data_frame = DataFrame(batch).reindex(columns = columns).fillna('').astype(str)
 			
 			# Drop duplicates
-			duplicate_filter = [index]
-			duplicate_filter.extend(group_by)
-			data_frame.drop_duplicates(subset = duplicate_filter, inplace = True)
+			data_frame.drop_duplicates(inplace = True)
 			
-			data_frame = data_frame.groupby(by = group_by).apply(lambda _: list(_[index])).reset_index(name = index)
-			data_frame['count'] = data_frame[index].apply(lambda _: len(_))
-			data_frame.sort_values(by = 'count', ascending = False, inplace = True)
-			return data_frame.to_json(orient = 'records')
-		else:
+			for row in data_frame.itertuples(index = False, name = None):
+				groups.setdefault(row[:-1], OrderedDict())[row[-1]] = True
+		
+		if len(groups) == 0:
 			return '{}'
+		
+		stacked = []
+		for group, index_values in groups.items():
+			r = OrderedDict(zip(group_by, group))
+			r[index] = list(index_values)
+			r['count'] = len(index_values)
+			stacked.append(r)
+		stacked.sort(key = lambda _: _['count'], reverse = True)
+		return json.dumps(stacked)
 	
 	def w32mbr_post_process(mbr_data):
 		return {
@@ -2,14 +2,18 @@
 # -*- coding: utf-8 -*-
 
 from threading import Lock
+from functools import wraps
+from contextlib import contextmanager
+import threading
+import os
+import sys
+import time
 import datetime
 import json
+import sqlite3
 
 try:
-	import tinydb
 	import tinydb.operations
-	from tinydb.storages import JSONStorage
-	from tinydb.middlewares import CachingMiddleware
 except ImportError:
 	print("hxtool_db requires the 'tinydb' module, please install it.")
 	exit(1)
@@ -18,22 +22,94 @@ except ImportError:
 import hxtool_vars
 import hxtool_logging
 from hx_lib import HXAPI
-from hxtool_util import secure_uuid4
+from hxtool_util import secure_uuid4, pretty_exceptions, ReadWriteLock
+from hxtool_db_engine import get_db_engine, db_engine_file_names, hxtool_db_result_store, DB_ENGINE_TINYDB, DB_ENGINE_SQLITE
 
 logger = hxtool_logging.getLogger(__name__)
 
+class hxtool_db_table_lock:
+	def __init__(self, db, table_names, write, method_name):
+		self.db = db
+		self.locks = [db._table_lock(_) for _ in table_names]
+		self.write = write
+		self.method_name = method_name
+	
+	def __enter__(self):
+		waited = False
+		start_time = time.time()
+		# Writers serialize on the engine's storage lock first, which lets a batch apply
+		# its writes under the storage lock without inverting the lock order.
+		if self.write:
+			if not self.db._db.storage_lock.acquire(False):
+				waited = True
+				self.db._db.storage_lock.acquire()
+		for l in self.locks:
+			if self.write:
+				waited = l.acquire_write() or waited
+			else:
+				waited = l.acquire_read() or waited
+		self.db._record_lock_wait(self.method_name, self.write, waited, time.time() - start_time)
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		for l in reversed(self.locks):
+			if self.write:
+				l.release_write()
+			else:
+				l.release_read()
+		if self.write:
+			self.db._db.storage_lock.release()
+
+"""
+Write methods decorated with batchable are queued instead of executed when the calling
+thread is inside hxtool_db.batch(), and return None. They take an optional on_write callback,
+which is called with the return value of the write once it has been applied, and isn't called
+if the write fails.
+"""
+def batchable(f):
+	@wraps(f)
+	def queue_if_batched(self, *args, **kwargs):
+		on_write = kwargs.pop('on_write', None)
+		pending = getattr(self._batch_local, 'pending', None)
+		if pending is not None:
+			pending.append((f, args, kwargs, on_write))
+			return None
+		ret = f(self, *args, **kwargs)
+		if on_write:
+			on_write(ret)
+		return ret
+	return queue_if_batched
+
 class hxtool_db:
-	def __init__(self, db_file, apicache = False, apicache_refresh_interval = None, write_cache_size = 10):
+	def __init__(self, db_file, apicache = False, apicache_refresh_interval = None, write_cache_size = 10, db_engine = DB_ENGINE_TINYDB, migrate_from = None, results_path = None, journal = False, journal_compact_size = 16777216):
+		is_new_db = not os.path.exists(db_file)
 		# If we can't open the DB file, rename the existing one
 		try:
-			CachingMiddleware.WRITE_CACHE_SIZE = write_cache_size
-			self._db = tinydb.TinyDB(db_file, storage=CachingMiddleware(JSONStorage))
+			if db_engine == DB_ENGINE_TINYDB:
+				self._db = get_db_engine(db_engine, db_file, write_cache_size = write_cache_size, journal = journal, journal_compact_size = journal_compact_size)
+			else:
+				self._db = get_db_engine(db_engine, db_file)
 		except ValueError:
 			logger.error("%s is not a TinyDB formatted database. Please move or rename this file before starting HXTool.", db_file)
 			exit(1)
+		except sqlite3.DatabaseError:
+			logger.error("%s is not a SQLite formatted database. Please move or rename this file before starting HXTool.", db_file)
+			exit(1)
+		
+		if db_engine == DB_ENGINE_SQLITE and is_new_db and migrate_from and os.path.isfile(migrate_from):
+			logger.info("Migrating the existing TinyDB database %s to %s", migrate_from, db_file)
+			self._db.migrate_from_tinydb(migrate_from)
 			
+		# Stacking and file listing results live next to the database file
+		self._results = hxtool_db_result_store(results_path or os.path.join(os.path.dirname(os.path.abspath(db_file)), 'results'))
+		
+		self._table_locks = {}
+		self._lock_statistics = {}
 		self._lock = Lock()
+		self._batch_local = threading.local()
+		self._size_statistics = None
 		self.check_schema()
+		self._cache_index_build()
 
 		self.apicache = apicache
 		self.apicache_refresh_interval = apicache_refresh_interval
@@ -41,14 +117,103 @@ class hxtool_db:
 	def close(self):
 		if self._db is not None:
 			self._db.close()
+			self._db = None
 	
 	def __exit__(self, exc_type, exc_value, traceback):
 		self.close()
-		
+	
+	"""
+	Per table readers-writer locks, the engine decides whether reads of the same table can run concurrently.
+	Methods that touch more than one table take the locks in name order to avoid lock order inversions.
+	"""
+	def _read_lock(self, *table_names):
+		return hxtool_db_table_lock(self, sorted(table_names), False, sys._getframe(1).f_code.co_name)
+	
+	def _write_lock(self, *table_names):
+		return hxtool_db_table_lock(self, sorted(table_names), True, sys._getframe(1).f_code.co_name)
+	
+	def _table_lock(self, table_name):
+		l = self._table_locks.get(table_name)
+		if l is None:
+			with self._lock:
+				l = self._table_locks.get(table_name)
+				if l is None:
+					l = self._table_locks[table_name] = ReadWriteLock(shared_reads = self._db.shared_reads)
+		return l
+	
+	def _record_lock_wait(self, method_name, write, waited, wait_time):
+		with self._lock:
+			s = self._lock_statistics.get(method_name)
+			if s is None:
+				s = self._lock_statistics[method_name] = {'mode' : 'write' if write else 'read', 'acquired' : 0, 'contended' : 0, 'wait_time' : 0.0, 'max_wait_time' : 0.0}
+			s['acquired'] += 1
+			if waited:
+				s['contended'] += 1
+				s['wait_time'] += wait_time
+				if wait_time > s['max_wait_time']:
+					s['max_wait_time'] = wait_time
+	
+	"""
+	Group writes made by the current thread into one locked pass and one flush (TinyDB) or transaction (SQLite).
+	Batchable writes made inside the with block are queued and applied, in order, when the outermost batch exits.
+	Reads inside the block don't see the queued writes, and callers must not rely on the return value of a queued write.
+	"""
+	@contextmanager
+	def batch(self):
+		if getattr(self._batch_local, 'pending', None) is not None:
+			yield self
+			return
+		self._batch_local.pending = []
+		try:
+			yield self
+		finally:
+			pending = self._batch_local.pending
+			self._batch_local.pending = None
+			if pending:
+				written = []
+				with self._db.storage_lock:
+					with self._db.batch():
+						for f, args, kwargs, on_write in pending:
+							try:
+								ret = f(self, *args, **kwargs)
+								if on_write:
+									written.append((on_write, ret))
+							except Exception as e:
+								logger.error(pretty_exceptions(e))
+				# Only once the batch has been flushed or committed
+				for on_write, ret in written:
+					on_write(ret)
+	
+	"""
+	Lock contention counters per hxtool_db method, wait times are in seconds
+	"""
+	def lockStatistics(self):
+		with self._lock:
+			return {k : dict(v) for k, v in self._lock_statistics.items()}
+	
+	"""
+	Rewrite the database file compactly (TinyDB snapshot, SQLite checkpoint + VACUUM) and record its size per table
+	"""
+	def compact(self):
+		with self._write_lock(*self._db.tables()):
+			self._db.compact()
+			self._size_statistics = {'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow()),
+									'files' : self._db.file_sizes(),
+									'tables' : self._db.table_sizes(),
+									'results' : self._results.sizes()}
+		return self.sizeStatistics()
+	
+	"""
+	Sizes in bytes as of the last compaction
+	"""
+	def sizeStatistics(self):
+		with self._lock:
+			return dict(self._size_statistics) if self._size_statistics else None
+	
 	
 	def check_schema(self):
 		current_schema_version = None
-		with self._lock:
+		with self._read_lock('schema_version'):
 			current_schema_version = self._db.table('schema_version').get(doc_id = 1)
 			if current_schema_version:
 				current_schema_version = int(current_schema_version['schema_version'])
@@ -56,29 +221,31 @@ class hxtool_db:
 			logger.warning("The current HXTool database has no schema version set, a DB schema upgrade may be required.")
 			if self.upgrade_schema():
 				logger.info("Database schema upgraded successfully.")
-				self._db.table('schema_version').insert({'schema_version' : hxtool_vars.hxtool_schema_version})
+				with self._write_lock('schema_version'):
+					self._db.table('schema_version').insert({'schema_version' : hxtool_vars.hxtool_schema_version})
 		elif current_schema_version < hxtool_vars.hxtool_schema_version:
 			logger.warning("The current HXTool database has a schema version: {} that is older than the current version of: {}, a DB schema upgrade may be required.".format(current_schema_version, hxtool_vars.hxtool_schema_version))
 			if self.upgrade_schema():
 				logger.info("Database schema upgraded successfully.")
-				self._db.table('schema_version').update({'schema_version' : hxtool_vars.hxtool_schema_version}, doc_ids = [1])
+				with self._write_lock('schema_version'):
+					self._db.table('schema_version').update({'schema_version' : hxtool_vars.hxtool_schema_version}, doc_ids = [1])
 		
 	def upgrade_schema(self):
 		try:
-			with self._lock:
+			with self._write_lock('bulk_download', 'file_listing', 'stacking', 'ObjectCache'):
 				# Schema upgrade code - will change from release to release
 				
 				# Upgrade stack and file listing jobs to 4.0 schema
 				for r in self._db.table('stacking').all():
 					if 'bulk_download_id' in r and r['bulk_download_id'] > 0:
-						b = self._db.table('bulk_download').get((tinydb.Query()['profile_id'] == r['profile_id']) & (tinydb.Query()['bulk_download_id'] == r['bulk_download_id']))
+						b = self._db.table('bulk_download').get(self._db.query(profile_id = r['profile_id'], bulk_download_id = r['bulk_download_id']))
 						if b:
 							self._db.table('stacking').update({'bulk_download_eid' : b.doc_id}, doc_ids = [r.doc_id])
 							self._db.table('stacking').update(tinydb.operations.delete('bulk_download_id'), doc_ids = [r.doc_id])
 				
 				for r in self._db.table('file_listing').all():
 					if 'bulk_download_id' in r and r['bulk_download_id'] > 0:
-						b = self._db.table('bulk_download').get((tinydb.Query()['profile_id'] == r['profile_id']) & (tinydb.Query()['bulk_download_id'] == r['bulk_download_id']))
+						b = self._db.table('bulk_download').get(self._db.query(profile_id = r['profile_id'], bulk_download_id = r['bulk_download_id']))
 						if b:
 							self._db.table('file_listing').update({'bulk_download_eid' : b.doc_id}, doc_ids = [r.doc_id])
 							self._db.table('file_listing').update(tinydb.operations.delete('bulk_download_id'), doc_ids = [r.doc_id])
@@ -92,6 +259,25 @@ class hxtool_db:
 						self._db.table('bulk_download').update({'task_profile' : r['post_download_handler']}, doc_ids = [r.doc_id])
 						self._db.table('bulk_download').update(tinydb.operations.delete('post_download_handler'), doc_ids = [r.doc_id])
 				
+				# Move stacking and file listing results out of the job documents and into the result store (schema 41)
+				for r in self._db.table('stacking').all():
+					if 'results' in r:
+						self._results.delete('stacking', r.doc_id)
+						self._db.table('stacking').update({'result_count' : self._results.append('stacking', r.doc_id, r['results'])}, doc_ids = [r.doc_id])
+						self._db.table('stacking').update(tinydb.operations.delete('results'), doc_ids = [r.doc_id])
+				
+				for r in self._db.table('file_listing').all():
+					if 'files' in r:
+						self._results.delete('file_listing', r.doc_id)
+						self._db.table('file_listing').update({'file_count' : self._results.append('file_listing', r.doc_id, r['files'])}, doc_ids = [r.doc_id])
+						self._db.table('file_listing').update(tinydb.operations.delete('files'), doc_ids = [r.doc_id])
+				
+				# ObjectCache timestamps are epoch seconds (schema 42)
+				for r in self._db.table('ObjectCache').all():
+					d = {k : time.mktime(datetime.datetime.strptime(r[k], "%Y-%m-%d %H:%M:%S").timetuple()) for k in ['create_timestamp', 'update_timestamp', 'removed_timestamp'] if isinstance(r.get(k), str)}
+					if d:
+						self._db.table('ObjectCache').update(d, doc_ids = [r.doc_id])
+				
 			return True
 		except:
 			raise
@@ -111,7 +297,7 @@ class hxtool_db:
 		# Generate a unique profile id
 		profile_id = str(secure_uuid4())
 		r = None
-		with self._lock:
+		with self._write_lock('profile'):
 			try:
 				r = self._db.table('profile').insert({'profile_id' : profile_id, 'hx_name' : hx_name, 'hx_host' : hx_host, 'hx_port' : hx_port})
 			except:	
@@ -123,19 +309,19 @@ class hxtool_db:
 	List all profiles
 	"""
 	def profileList(self):
-		with self._lock:
+		with self._read_lock('profile'):
 			return self._db.table('profile').all()
 	
 	"""
 	Get a profile by id
 	"""
 	def profileGet(self, profile_id):
-		with self._lock:
-			return self._db.table('profile').get((tinydb.Query()['profile_id'] == profile_id))
+		with self._read_lock('profile'):
+			return self._db.table('profile').get(self._db.query(profile_id = profile_id))
 			
 	def profileUpdate(self, profile_id, hx_name, hx_host, hx_port):
-		with self._lock:
-			return self._db.table('profile').update({'hx_name' : hx_name, 'hx_host' : hx_host, 'hx_port' : hx_port}, (tinydb.Query()['profile_id'] == profile_id))
+		with self._write_lock('profile'):
+			return self._db.table('profile').update({'hx_name' : hx_name, 'hx_host' : hx_host, 'hx_port' : hx_port}, self._db.query(profile_id = profile_id))
 		
 	"""
 	Delete a profile
@@ -143,12 +329,12 @@ class hxtool_db:
 	"""
 	def profileDelete(self, profile_id):
 		self.backgroundProcessorCredentialRemove(profile_id)	
-		with self._lock:
-			return self._db.table('profile').remove((tinydb.Query()['profile_id'] == profile_id))
+		with self._write_lock('profile'):
+			return self._db.table('profile').remove(self._db.query(profile_id = profile_id))
 		
 	def backgroundProcessorCredentialCreate(self, profile_id, hx_api_username, iv, salt, hx_api_encrypted_password):
 		r = None
-		with self._lock:
+		with self._write_lock('background_processor_credential'):
 			try:
 				r = self._db.table('background_processor_credential').insert({'profile_id' : profile_id, 'hx_api_username' : hx_api_username, 'iv' : iv, 'salt': salt, 'hx_api_encrypted_password' : hx_api_encrypted_password})
 			except:
@@ -157,17 +343,17 @@ class hxtool_db:
 		return r
 		
 	def backgroundProcessorCredentialRemove(self, profile_id):
-		with self._lock:
-			return self._db.table('background_processor_credential').remove((tinydb.Query()['profile_id'] == profile_id))
+		with self._write_lock('background_processor_credential'):
+			return self._db.table('background_processor_credential').remove(self._db.query(profile_id = profile_id))
 			
 	def backgroundProcessorCredentialGet(self, profile_id):
-		with self._lock:
-			return self._db.table('background_processor_credential').get((tinydb.Query()['profile_id'] == profile_id))
+		with self._read_lock('background_processor_credential'):
+			return self._db.table('background_processor_credential').get(self._db.query(profile_id = profile_id))
 		
 	def alertCreate(self, profile_id, hx_alert_id):
 		r = self.alertGet(profile_id, hx_alert_id)
 		if not r:
-			with self._lock:
+			with self._write_lock('alert'):
 				try:
 					r = self._db.table('alert').insert({'profile_id' : profile_id, 'hx_alert_id' : int(hx_alert_id), 'annotations' : []})
 				except:
@@ -178,20 +364,20 @@ class hxtool_db:
 		return r
 
 	def alertList(self, profile_id):
-		with self._lock:
-			return self._db.table('alert').search((tinydb.Query()['profile_id'] == profile_id))
+		with self._read_lock('alert'):
+			return self._db.table('alert').search(self._db.query(profile_id = profile_id))
 
 	def alertGet(self, profile_id, hx_alert_id):
-		with self._lock:
-			return self._db.table('alert').get((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['hx_alert_id'] == int(hx_alert_id)))
+		with self._read_lock('alert'):
+			return self._db.table('alert').get(self._db.query(profile_id = profile_id, hx_alert_id = int(hx_alert_id)))
 	
 	def alertAddAnnotation(self, profile_id, hx_alert_id, annotation, state, create_user):
-		with self._lock:
-			return self._db.table('alert').update(self._db_append_to_list('annotations', {'annotation' : annotation, 'state' : int(state), 'create_user' : create_user, 'create_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}), (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['hx_alert_id'] == int(hx_alert_id)))
+		with self._write_lock('alert'):
+			return self._db.table('alert').update(self._db_append_to_list('annotations', {'annotation' : annotation, 'state' : int(state), 'create_user' : create_user, 'create_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}), self._db.query(profile_id = profile_id, hx_alert_id = int(hx_alert_id)))
 		
 	def bulkDownloadCreate(self, profile_id, hostset_name = None, hostset_id = None, task_profile = None):
 		r = None
-		with self._lock:
+		with self._write_lock('bulk_download'):
 			try:
 				ts = HXAPI.dt_to_str(datetime.datetime.utcnow())
 				r = self._db.table('bulk_download').insert({'profile_id' : profile_id, 
@@ -210,16 +396,17 @@ class hxtool_db:
 	
 	def bulkDownloadGet(self, bulk_download_eid = None, profile_id = None, bulk_acquisition_id = None):
 		if bulk_download_eid:
-			with self._lock:
+			with self._read_lock('bulk_download'):
 				return self._db.table('bulk_download').get(doc_id = int(bulk_download_eid))
 		elif profile_id and bulk_acquisition_id:
-			with self._lock:
-				return self._db.table('bulk_download').get((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['bulk_acquisition_id'] == bulk_acquisition_id))
+			with self._read_lock('bulk_download'):
+				return self._db.table('bulk_download').get(self._db.query(profile_id = profile_id, bulk_acquisition_id = bulk_acquisition_id))
 	
 	def bulkDownloadList(self, profile_id):
-		with self._lock:
-			return self._db.table('bulk_download').search((tinydb.Query()['profile_id'] == profile_id))
+		with self._read_lock('bulk_download'):
+			return self._db.table('bulk_download').search(self._db.query(profile_id = profile_id))
 	
+	@batchable
 	def bulkDownloadUpdate(self, bulk_download_eid, bulk_acquisition_id = None, hosts = None, stopped = None, complete = None):
 		d = {'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}
 		
@@ -232,31 +419,36 @@ class hxtool_db:
 		if complete is not None:
 			d['complete'] = complete
 
-		with self._lock:
+		with self._write_lock('bulk_download'):
 			return self._db.table('bulk_download').update(d, doc_ids = [int(bulk_download_eid)])
 			
-	def bulkDownloadUpdateHost(self, bulk_download_eid, host_id, downloaded = None, hostname = None):
+	@batchable
+	def bulkDownloadUpdateHost(self, bulk_download_eid, host_id, downloaded = None, hostname = None, attempts = None, failed = None):
 		d = {}
 			
 		if downloaded is not None:
 			d['downloaded'] = downloaded
 		if hostname is not None:
 			d['hostname'] = hostname
+		if attempts is not None:
+			d['attempts'] = attempts
+		if failed is not None:
+			d['failed'] = failed
 		
-		with self._lock:
+		with self._write_lock('bulk_download'):
 			return self._db.table('bulk_download').update(self._db_update_nested_dict('hosts', host_id, d), doc_ids = [int(bulk_download_eid)])
 	
 	def bulkDownloadDeleteHost(self, bulk_download_eid, host_id):
-		with self._lock:
+		with self._write_lock('bulk_download'):
 			return self._db.table('bulk_download').update(self._db_delete_from_nested_dict('hosts', host_id), doc_ids = [int(bulk_download_eid)])		
 	
 	def bulkDownloadDelete(self, bulk_download_eid):
-		with self._lock:
+		with self._write_lock('bulk_download'):
 			return self._db.table('bulk_download').remove(doc_ids = [int(bulk_download_eid)])
 	
 	def fileListingCreate(self, profile_id, username, bulk_download_eid, path, regex, depth, display_name, api_mode=False):
 		r = None
-		with self._lock:
+		with self._write_lock('file_listing'):
 			ts = HXAPI.dt_to_str(datetime.datetime.utcnow())
 			try:
 				r = self._db.table('file_listing').insert({'profile_id' : profile_id, 
@@ -264,7 +456,7 @@ class hxtool_db:
 														'bulk_download_eid' : int(bulk_download_eid),
 														'username': username,
 														'stopped' : False,
-														'files' : [],
+														'file_count' : 0,
 														'cfg': {
 															'path': path,
 															'regex': regex,
@@ -279,34 +471,45 @@ class hxtool_db:
 				raise
 		return r
 		
+	@batchable
 	def fileListingAddResult(self, profile_id, bulk_download_eid, result):
-		with self._lock:
-			return self._db.table('file_listing').update(self._db_append_to_list('files', result), (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['bulk_download_eid'] == int(bulk_download_eid)))
+		with self._write_lock('file_listing'):
+			r = self._db.table('file_listing').get(self._db.query(profile_id = profile_id, bulk_download_eid = int(bulk_download_eid)))
+			if r:
+				file_count = self._results.append('file_listing', r.doc_id, result)
+				return self._db.table('file_listing').update(self._db_increment('file_count', file_count), doc_ids = [r.doc_id])
+	
+	"""
+	Stream the files of a file listing job, optionally paged with offset and limit
+	"""
+	def fileListingResults(self, file_listing_id, offset = 0, limit = None):
+		return self._results.read('file_listing', file_listing_id, offset = offset, limit = limit)
 	
 	def fileListingGetByBulkId(self, profile_id, bulk_download_eid):
-		with self._lock:
-			result = self._db.table('file_listing').search((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['bulk_download_eid'] == int(bulk_download_eid)))
+		with self._read_lock('file_listing'):
+			result = self._db.table('file_listing').search(self._db.query(profile_id = profile_id, bulk_download_eid = int(bulk_download_eid)))
 			return result and result[0] or None
 	
 	def fileListingGetById(self, flid):
-		with self._lock:
+		with self._read_lock('file_listing'):
 			return self._db.table('file_listing').get(doc_id = int(flid))
 	
 	def fileListingList(self, profile_id):
-		with self._lock:
-			return self._db.table('file_listing').search(tinydb.Query()['profile_id'] == profile_id)
+		with self._read_lock('file_listing'):
+			return self._db.table('file_listing').search(self._db.query(profile_id = profile_id))
 
 	def fileListingStop(self, file_listing_id):
-		with self._lock:
+		with self._write_lock('file_listing'):
 			return self._db.table('file_listing').update({'stopped' : True, 'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}, doc_ids = [int(file_listing_id)])		
 	
 	def fileListingDelete(self, file_listing_id):
-		with self._lock:
+		with self._write_lock('file_listing'):
+			self._results.delete('file_listing', file_listing_id)
 			return self._db.table('file_listing').remove(doc_ids = [int(file_listing_id)])
 	
 	def multiFileCreate(self, username, profile_id, display_name=None, file_listing_id=None, api_mode=False):
 		r = None
-		with self._lock:
+		with self._write_lock('multi_file'):
 			ts = HXAPI.dt_to_str(datetime.datetime.utcnow())
 			try:
 				return self._db.table('multi_file').insert({
@@ -329,38 +532,37 @@ class hxtool_db:
 
 	def multiFileAddJob(self, multi_file_id, job):
 		try:
-			with self._lock:
-				return self._db.table('multi_file').update(self._db_append_to_list('files', job), eids=[int(multi_file_id)])
+			with self._write_lock('multi_file'):
+				return self._db.table('multi_file').update(self._db_append_to_list('files', job), doc_ids = [int(multi_file_id)])
 		except:
 			return None
 
 	def multiFileList(self, profile_id):
-		with self._lock:
-			return self._db.table('multi_file').search(tinydb.Query()['profile_id'] == profile_id)
+		with self._read_lock('multi_file'):
+			return self._db.table('multi_file').search(self._db.query(profile_id = profile_id))
 
 	def multiFileGetById(self, multi_file_id):
-		with self._lock:
+		with self._read_lock('multi_file'):
 			return self._db.table('multi_file').get(doc_id = int(multi_file_id))
 
 	def multiFileUpdateFile(self, profile_id, multi_file_id, acquisition_id):
 		try:
-			with self._lock:
-				doc_ids = self._db.table('multi_file').update(self._db_update_dict_in_list('files', 'acquisition_id', acquisition_id, 'downloaded', True), eids=[int(multi_file_id)])
-				return eids
+			with self._write_lock('multi_file'):
+				return self._db.table('multi_file').update(self._db_update_dict_in_list('files', 'acquisition_id', acquisition_id, 'downloaded', True), doc_ids = [int(multi_file_id)])
 		except:
 			return None
 																			
 	def multiFileStop(self, multi_file_id):
-		with self._lock:
+		with self._write_lock('multi_file'):
 			return self._db.table('multi_file').update({'stopped' : True, 'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}, doc_ids = [int(multi_file_id)])
 	
 	def multiFileDelete(self, multi_file_id):
-		with self._lock:
+		with self._write_lock('multi_file'):
 			return self._db.table('multi_file').remove(doc_ids = [int(multi_file_id)])
 	
 	def stackJobCreate(self, profile_id, bulk_download_eid, stack_type):
 		r = None
-		with self._lock:
+		with self._write_lock('stacking'):
 			ts = HXAPI.dt_to_str(datetime.datetime.utcnow())
 			try:
 				r = self._db.table('stacking').insert({'profile_id' : profile_id, 
@@ -368,7 +570,7 @@ class hxtool_db:
 														'stopped' : False,
 														'stack_type' : stack_type,
 														'hosts' : [],
-														'results' : [],
+														'result_count' : 0,
 														'last_index' : None,
 														'last_groupby' : [],
 														'create_timestamp' : ts, 
@@ -381,65 +583,81 @@ class hxtool_db:
 		
 	def stackJobGet(self, stack_job_eid = None, profile_id = None, bulk_download_eid = None):
 		if stack_job_eid:
-			with self._lock:
+			with self._read_lock('stacking'):
 				return self._db.table('stacking').get(doc_id = int(stack_job_eid))
 		elif profile_id and bulk_download_eid:
-			with self._lock:
-				return self._db.table('stacking').get((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['bulk_download_eid'] == bulk_download_eid))
+			with self._read_lock('stacking'):
+				return self._db.table('stacking').get(self._db.query(profile_id = profile_id, bulk_download_eid = bulk_download_eid))
 	
 	def stackJobList(self, profile_id):
-		with self._lock:
-			return self._db.table('stacking').search((tinydb.Query()['profile_id'] == profile_id))
+		with self._read_lock('stacking'):
+			return self._db.table('stacking').search(self._db.query(profile_id = profile_id))
 	
+	@batchable
 	def stackJobAddHost(self, profile_id, bulk_download_eid, hostname):
-		with self._lock:
-			return self._db.table('stacking').update(self._db_append_to_list('hosts', {'hostname' : hostname, 'processed' : False}), (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['bulk_download_eid'] == int(bulk_download_eid)))
+		with self._write_lock('stacking'):
+			return self._db.table('stacking').update(self._db_append_to_list('hosts', {'hostname' : hostname, 'processed' : False}), self._db.query(profile_id = profile_id, bulk_download_eid = int(bulk_download_eid)))
 	
+	@batchable
 	def stackJobAddResult(self, profile_id, bulk_download_eid, hostname, result):
-		with self._lock:
-			e_id = self._db.table('stacking').update(self._db_append_to_list('results', result), (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['bulk_download_eid'] == int(bulk_download_eid)))
-			return self._db.table('stacking').update(self._db_update_dict_in_list('hosts', 'hostname', hostname, 'processed', True), doc_ids = e_id)
+		with self._write_lock('stacking'):
+			r = self._db.table('stacking').get(self._db.query(profile_id = profile_id, bulk_download_eid = int(bulk_download_eid)))
+			if r:
+				result_count = self._results.append('stacking', r.doc_id, result)
+				self._db.table('stacking').update(self._db_increment('result_count', result_count), doc_ids = [r.doc_id])
+				return self._db.table('stacking').update(self._db_update_dict_in_list('hosts', 'hostname', hostname, 'processed', True), doc_ids = [r.doc_id])
+	
+	"""
+	Stream the records of a stacking job, optionally paged with offset and limit
+	"""
+	def stackJobResults(self, stack_job_eid, offset = 0, limit = None):
+		return self._results.read('stacking', stack_job_eid, offset = offset, limit = limit)
 			
 	def stackJobUpdateIndex(self, profile_id, bulk_download_eid, last_index):
-		with self._lock:
-			return self._db.table('stacking').update({'last_index' : last_index, 'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}, (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['bulk_download_eid'] == int(bulk_download_eid)))
+		with self._write_lock('stacking'):
+			return self._db.table('stacking').update({'last_index' : last_index, 'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}, self._db.query(profile_id = profile_id, bulk_download_eid = int(bulk_download_eid)))
 	
 	def stackJobUpdateGroupBy(self, profile_id, bulk_download_eid, last_groupby):
-		with self._lock:
-			return self._db.table('stacking').update({'last_groupby' : last_groupby, 'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}, (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['bulk_download_eid'] == int(bulk_download_eid)))
+		with self._write_lock('stacking'):
+			return self._db.table('stacking').update({'last_groupby' : last_groupby, 'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}, self._db.query(profile_id = profile_id, bulk_download_eid = int(bulk_download_eid)))
 	
 	def stackJobStop(self, stack_job_eid):
-		with self._lock:
+		with self._write_lock('stacking'):
 			return self._db.table('stacking').update({'stopped' : True, 'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}, doc_ids = [int(stack_job_eid)])		
 	
 	def stackJobDelete(self, stack_job_eid):
-		with self._lock:
+		with self._write_lock('stacking'):
+			self._results.delete('stacking', stack_job_eid)
 			return self._db.table('stacking').remove(doc_ids = [int(stack_job_eid)])
 	
 	def sessionCreate(self, session_id):
-		with self._lock:
+		with self._write_lock('session'):
 			return self._db.table('session').insert({'session_id' 		: session_id,
 													'session_data'		: {},
 													'update_timestamp'	: HXAPI.dt_to_str(datetime.datetime.utcnow())})
 	
 	def sessionList(self):
-		with self._lock:
+		with self._read_lock('session'):
 			return self._db.table('session').all()
 	
 	def sessionGet(self, session_id):
-		with self._lock:
-			return self._db.table('session').get((tinydb.Query()['session_id'] == session_id))
+		with self._read_lock('session'):
+			return self._db.table('session').get(self._db.query(session_id = session_id))
 		
 	def sessionUpdate(self, session_id, session_data):
-		with self._lock:
-			return self._db.table('session').update({'session_data' : session_data, 'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}, (tinydb.Query()['session_id'] == session_id))
+		with self._write_lock('session'):
+			return self._db.table('session').update({'session_data' : session_data, 'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())}, self._db.query(session_id = session_id))
 		
 	def sessionDelete(self, session_id):
-		with self._lock:
-			return self._db.table('session').remove((tinydb.Query()['session_id'] == session_id))
+		with self._write_lock('session'):
+			return self._db.table('session').remove(self._db.query(session_id = session_id))
+	
+	def sessionPurge(self, max_age):
+		with self._write_lock('session'):
+			return self._db_purge('session', 'update_timestamp', max_age, HXAPI.dt_from_str)
 	
 	def scriptCreate(self, scriptname, script, username):
-		with self._lock:
+		with self._write_lock('scripts'):
 			return self._db.table('scripts').insert({'script_id' : str(secure_uuid4()), 
 														'scriptname': str(scriptname), 
 														'username' : str(username),
@@ -448,20 +666,20 @@ class hxtool_db:
 														'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())})		
 
 	def scriptList(self):
-		with self._lock:
+		with self._read_lock('scripts'):
 			return self._db.table('scripts').all()
 
 	def scriptDelete(self, script_id):
-		with self._lock:
-			return self._db.table('scripts').remove((tinydb.Query()['script_id'] == script_id))
+		with self._write_lock('scripts'):
+			return self._db.table('scripts').remove(self._db.query(script_id = script_id))
 
 	def scriptGet(self, script_id):
-		with self._lock:
-			return self._db.table('scripts').get((tinydb.Query()['script_id'] == script_id))
+		with self._read_lock('scripts'):
+			return self._db.table('scripts').get(self._db.query(script_id = script_id))
 
 
 	def oiocCreate(self, iocname, ioc, username):
-		with self._lock:
+		with self._write_lock('openioc'):
 			return self._db.table('openioc').insert({'ioc_id' : str(secure_uuid4()), 
 														'iocname': str(iocname), 
 														'username' : str(username),
@@ -470,39 +688,47 @@ class hxtool_db:
 														'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())})		
 
 	def oiocList(self):
-		with self._lock:
+		with self._read_lock('openioc'):
 			return self._db.table('openioc').all()
 
 	def oiocDelete(self, ioc_id):
-		with self._lock:
-			return self._db.table('openioc').remove((tinydb.Query()['ioc_id'] == ioc_id))
+		with self._write_lock('openioc'):
+			return self._db.table('openioc').remove(self._db.query(ioc_id = ioc_id))
 
 	def oiocGet(self, ioc_id):
-		with self._lock:
-			return self._db.table('openioc').get((tinydb.Query()['ioc_id'] == ioc_id))
+		with self._read_lock('openioc'):
+			return self._db.table('openioc').get(self._db.query(ioc_id = ioc_id))
 
+	@batchable
 	def taskCreate(self, serialized_task):
-		with self._lock:
+		with self._write_lock('tasks'):
 			return self._db.table('tasks').insert(serialized_task)
 	
 	def taskList(self):
-		with self._lock:
+		with self._read_lock('tasks'):
 			return self._db.table('tasks').all()
 	
 	def taskGet(self, profile_id, task_id):
-		with self._lock:
-			return self._db.table('tasks').get((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['task_id'] == task_id))
+		with self._read_lock('tasks'):
+			return self._db.table('tasks').get(self._db.query(profile_id = profile_id, task_id = task_id))
 	
-	def taskUpdate(self, profile_id, task_id, serialized_task):
-		with self._lock:
-			return self._db.table('tasks').update(serialized_task, (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['task_id'] == task_id))
+	"""
+	Update some or all fields of a task, by doc_id when the caller knows it rather than with a query
+	"""
+	@batchable
+	def taskUpdate(self, profile_id, task_id, serialized_task, doc_id = None):
+		with self._write_lock('tasks'):
+			if doc_id is not None:
+				return self._db.table('tasks').update(serialized_task, doc_ids = [int(doc_id)])
+			return self._db.table('tasks').update(serialized_task, self._db.query(profile_id = profile_id, task_id = task_id))
 	
+	@batchable
 	def taskDelete(self, profile_id, task_id):
-		with self._lock:
-			return self._db.table('tasks').remove((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['task_id'] == task_id))
+		with self._write_lock('tasks'):
+			return self._db.table('tasks').remove(self._db.query(profile_id = profile_id, task_id = task_id))
 			
 	def taskProfileAdd(self, name, actor, params):
-		with self._lock:
+		with self._write_lock('taskprofiles'):
 			return self._db.table('taskprofiles').insert({'taskprofile_id' : str(secure_uuid4()), 
 														'name': str(name), 
 														'actor' : str(actor),
@@ -511,20 +737,20 @@ class hxtool_db:
 														'update_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())})
 
 	def taskProfileList(self):
-		with self._lock:
+		with self._read_lock('taskprofiles'):
 			return self._db.table('taskprofiles').all()
 			
 	def taskProfileGet(self, taskprofile_id):
-		with self._lock:
-			return self._db.table('taskprofiles').get((tinydb.Query()['taskprofile_id'] == taskprofile_id))
+		with self._read_lock('taskprofiles'):
+			return self._db.table('taskprofiles').get(self._db.query(taskprofile_id = taskprofile_id))
 
 	def taskProfileDelete(self, taskprofile_id):
-		with self._lock:
-			return self._db.table('taskprofiles').remove((tinydb.Query()['taskprofile_id'] == taskprofile_id))
+		with self._write_lock('taskprofiles'):
+			return self._db.table('taskprofiles').remove(self._db.query(taskprofile_id = taskprofile_id))
 
 
 	def auditCreate(self, profile_id, host_id, hostname, generator, start_time, end_time, results):
-		with self._lock:
+		with self._write_lock('audits'):
 			return self._db.table('audits').insert({'profile_id' : profile_id,
 													'audit_id'	: str(secure_uuid4()),
 													'host_id:'	: host_id,
@@ -532,61 +758,67 @@ class hxtool_db:
 													'generator'	: generator,
 													'start_time': start_time,
 													'end_time'	: end_time,
-													'results'	: results})
+													'results'	: results,
+													'create_timestamp' : HXAPI.dt_to_str(datetime.datetime.utcnow())})
 	
 	def auditList(self, profile_id):
-		with self._lock:
-			return self._db.table('audits').get((tinydb.Query()['profile_id'] == profile_id))
+		with self._read_lock('audits'):
+			return self._db.table('audits').get(self._db.query(profile_id = profile_id))
 	
 	def auditGet(self, profile_id, audit_id):
-		with self._lock:
-			return self._db.table('audits').get((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['audit_id']))
+		with self._read_lock('audits'):
+			return self._db.table('audits').get(self._db.query(profile_id = profile_id, audit_id = audit_id))
 			
+	# Audits created before create_timestamp was recorded fall back to the end_time reported by the host
+	def auditPurge(self, max_age):
+		with self._write_lock('audits'):
+			return self._db_purge('audits', 'create_timestamp', max_age, HXAPI.dt_from_str, fallback_field = 'end_time')
+	
 	def auditDelete(self, profile_id, audit_id):
-		with self._lock:
-			return self._db.table('audits').remove((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['audit_id']))
+		with self._write_lock('audits'):
+			return self._db.table('audits').remove(self._db.query(profile_id = profile_id, audit_id = audit_id))
 
 
 	def ruleList(self, profile_id):
-		with self._lock:
-			return self._db.table('rules').search((tinydb.Query()['profile_id'] == profile_id))
+		with self._read_lock('rules'):
+			return self._db.table('rules').search(self._db.query(profile_id = profile_id))
 
 	def ruleGet(self, rule_id):
-		with self._lock:
-			r = self._db.table('rules').get((tinydb.Query()['id'] == rule_id))
+		with self._read_lock('rules'):
+			r = self._db.table('rules').get(self._db.query(id = rule_id))
 			if r:
 				return HXAPI.b64(r['rule'], decode = True, decode_string = True)
 			else:
 				return False
 
 	def ruleUpdateState(self, rule_id, state):
-		with self._lock:
+		with self._write_lock('rules'):
 			r = self._db.table('rules').update({
 				 'state' : state
-				 }, (tinydb.Query()['id'] == rule_id))
+				 }, self._db.query(id = rule_id))
 			return r
-			#return self._db.table('rules').update(statement, (tinydb.Query()['id'] == rule_id))
+			#return self._db.table('rules').update(statement, self._db.query(id = rule_id))
 
 	def ruleAddLog(self, rule_id, message):
-		with self._lock:
-			r = self._db.table('rules').get((tinydb.Query()['id'] == rule_id))
+		with self._write_lock('rules'):
+			r = self._db.table('rules').get(self._db.query(id = rule_id))
 			if 'log' in r.keys():
 				log = r['log']
 				log.append({ "c_timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "message": message })
 				rn = self._db.table('rules').update({
 					'log' : log
-					}, (tinydb.Query()['id'] == rule_id))
+					}, self._db.query(id = rule_id))
 				return True
 			else:
 				return False
 
 
 	def ruleRemove(self, rule_id):
-		with self._lock:
-			return self._db.table('rules').remove((tinydb.Query()['id'] == rule_id))
+		with self._write_lock('rules'):
+			return self._db.table('rules').remove(self._db.query(id = rule_id))
 
 	def ruleAdd(self, profile_id, name, category, platform, create_user, rule, method):
-		with self._lock:
+		with self._write_lock('rules'):
 			r = self._db.table('rules').insert({
 				 'profile_id' : profile_id,
 				 'id' : str(secure_uuid4()),
@@ -605,83 +837,133 @@ class hxtool_db:
 			return r
 
 
+	"""
+	ObjectCache lookups go through an in-memory index of (profile_id, type, contentId) -> doc_id,
+	which is only modified while holding the ObjectCache write lock.
+	"""
+	def _cache_index_build(self):
+		with self._write_lock('ObjectCache'):
+			self._cache_index = {}
+			for r in self._db.table('ObjectCache').all():
+				self._cache_index.setdefault((r['profile_id'], r['type'], r['contentId']), r.doc_id)
+	
+	def _cache_index_remove(self, doc_ids):
+		doc_ids = set(doc_ids)
+		for k in [k for k, v in self._cache_index.items() if v in doc_ids]:
+			del self._cache_index[k]
+	
 	def cacheGet(self, profile_id, cacheType, contentId):
-		with self._lock:
+		with self._read_lock('ObjectCache'):
 			if self.apicache:
-				r = self._db.table("ObjectCache").get((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['type'] == cacheType) & (tinydb.Query()['contentId'] == contentId))
+				doc_id = self._cache_index.get((profile_id, cacheType, contentId))
+				r = self._db.table("ObjectCache").get(doc_id = doc_id) if doc_id is not None else None
 				if not r:
 					#print("{} - Cache Miss (no record)".format(cacheType))
 					return False
+				elif self.apicache_refresh_interval is not None and time.time() - r['update_timestamp'] > self.apicache_refresh_interval:
+					#print("{} - Cache Miss (dirty). Last updated: {}".format(cacheType, r['update_timestamp']))
+					return False
 				else:
-					t = datetime.datetime.now() - datetime.datetime.strptime(r['update_timestamp'], "%Y-%m-%d %H:%M:%S")
-					if self.apicache_refresh_interval is not None and t.seconds > self.apicache_refresh_interval:
-						#print("{} - Cache Miss (dirty). Last updated: {}".format(cacheType, r['update_timestamp']))
-						return False
-					else:
-						#print("{} - Cache Hit. Last updated: {}".format(cacheType, r['update_timestamp']))
-						return r
+					#print("{} - Cache Hit. Last updated: {}".format(cacheType, r['update_timestamp']))
+					return r
 			else:
 				return False
 
+	# Unlike cacheGet, this doesn't depend on the apicache settings, returns None if there is no record
+	def cacheGetUpdateTime(self, profile_id, cacheType, contentId):
+		with self._read_lock('ObjectCache'):
+			doc_id = self._cache_index.get((profile_id, cacheType, contentId))
+			r = self._db.table("ObjectCache").get(doc_id = doc_id) if doc_id is not None else None
+			return r['update_timestamp'] if r else None
+
+	@batchable
 	def cacheFlagRemove(self, profile_id, cacheType, offset):
-		with self._lock:
+		with self._write_lock('ObjectCache'):
 			r = self._db.table('ObjectCache').update({
-				 'removed_timestamp' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+				 'removed_timestamp' : time.time(),
 				 'removed' : True
-				 }, (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['type'] == cacheType) & (tinydb.Query()['offset'] == offset))
+				 }, self._db.query(profile_id = profile_id, type = cacheType, offset = offset))
 			return r
 
 	def cacheDrop(self, profile_id):
-		with self._lock:
-			return self._db.table("ObjectCache").remove((tinydb.Query()['profile_id'] == profile_id))
+		with self._write_lock('ObjectCache'):
+			r = self._db.table("ObjectCache").remove(self._db.query(profile_id = profile_id))
+			for k in [_ for _ in self._cache_index.keys() if _[0] == profile_id]:
+				del self._cache_index[k]
+			return r
 
+	# Drops entries flagged as removed as well as entries that haven't been refreshed within max_age
+	def cachePurge(self, max_age):
+		with self._write_lock('ObjectCache'):
+			table = self._db.table('ObjectCache')
+			doc_ids = [_.doc_id for _ in table.search(self._db.query(removed = True))]
+			if doc_ids:
+				table.remove(doc_ids = doc_ids)
+			doc_ids += self._db_purge('ObjectCache', 'update_timestamp', max_age, datetime.datetime.utcfromtimestamp)
+			self._cache_index_remove(doc_ids)
+			return doc_ids
 
 	def cacheListAll(self, profile_id):
-		with self._lock:
-			return self._db.table('ObjectCache').search((tinydb.Query()['profile_id'] == profile_id))
+		with self._read_lock('ObjectCache'):
+			return self._db.table('ObjectCache').search(self._db.query(profile_id = profile_id))
 
 	def cacheList(self, profile_id, cacheType):
-		with self._lock:
-			return self._db.table('ObjectCache').search((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['type'] == cacheType))
+		with self._read_lock('ObjectCache'):
+			return self._db.table('ObjectCache').search(self._db.query(profile_id = profile_id, type = cacheType))
 
 	def cacheListUpdate(self, profile_id, cacheType):
-		with self._lock:
-			return self._db.table('ObjectCache').search(~(tinydb.Query()['removed'] == True) & (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['type'] == cacheType))
+		with self._read_lock('ObjectCache'):
+			return [_ for _ in self._db.table('ObjectCache').search(self._db.query(profile_id = profile_id, type = cacheType)) if _.get('removed') != True]
 
+	@batchable
 	def cacheAdd(self, profile_id, cacheType, data):
-		with self._lock:
-			r = self._db.table('ObjectCache').insert({
-				 'profile_id' : profile_id,
-				 'type' : cacheType,
-				 'contentId' : data['_id'],
-				 'create_timestamp' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-				 'update_timestamp' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-				 'dirty' : False,
-				 'data' : data
-				 })
-			return r
+		return self.cacheAddById(profile_id, cacheType, data['_id'], data)
 
+	@batchable
 	def cacheAddById(self, profile_id, cacheType, contentId, data):
-		with self._lock:
+		with self._write_lock('ObjectCache'):
+			ts = time.time()
 			r = self._db.table('ObjectCache').insert({
 				 'profile_id' : profile_id,
 				 'type' : cacheType,
 				 'contentId' : contentId,
-				 'create_timestamp' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-				 'update_timestamp' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+				 'create_timestamp' : ts,
+				 'update_timestamp' : ts,
 				 'dirty' : False,
 				 'data' : data
 				 })
+			self._cache_index.setdefault((profile_id, cacheType, contentId), r)
 			return r
 
+	@batchable
 	def cacheUpdate(self, profile_id, cacheType, contentId, data):
-		with self._lock:
-			r = self._db.table('ObjectCache').update({
-				 'update_timestamp' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+		with self._write_lock('ObjectCache'):
+			doc_id = self._cache_index.get((profile_id, cacheType, contentId))
+			if doc_id is None:
+				return []
+			return self._db.table('ObjectCache').update({
+				 'update_timestamp' : time.time(),
 				 'data' : data
-				 }, (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['type'] == cacheType) & (tinydb.Query()['contentId'] == contentId))
-			return r
+				 }, doc_ids = [doc_id])
 				
+	# Callers hold the table write lock, records with a missing or unparseable timestamp are kept
+	def _db_purge(self, table_name, field, max_age, parse, fallback_field = None, utc = True):
+		cutoff = (datetime.datetime.utcnow() if utc else datetime.datetime.now()) - max_age
+		doc_ids = []
+		table = self._db.table(table_name)
+		for r in table.all():
+			t = r.get(field) or (r.get(fallback_field) if fallback_field else None)
+			try:
+				if t and parse(t) < cutoff:
+					doc_ids.append(r.doc_id)
+			except ValueError:
+				continue
+		if doc_ids:
+			table.remove(doc_ids = doc_ids)
+		return doc_ids
+	
+	# The transforms below list the paths of the fields they change in transform.paths, so that the journal
+	# only has to record those fields, see hxtool_db_journaled_table
 	def _db_update_nested_dict(self, dict_name, dict_key, dict_values, update_timestamp = True):
 		def transform(element):
 			if not dict_key in element[dict_name]:
@@ -693,6 +975,7 @@ class hxtool_db:
 					element[dict_name][dict_key] = dict_values
 			if update_timestamp and 'update_timestamp' in element:
 					element['update_timestamp'] =  HXAPI.dt_to_str(datetime.datetime.utcnow())		
+		transform.paths = self._db_paths([dict_name, dict_key], update_timestamp)
 		return transform
 		
 	def _db_delete_from_nested_dict(self, dict_name, dict_key, update_timestamp = True):
@@ -701,24 +984,46 @@ class hxtool_db:
 				del element[dict_name][dict_key]
 			if update_timestamp and 'update_timestamp' in element:
 					element['update_timestamp'] =  HXAPI.dt_to_str(datetime.datetime.utcnow())	
+		transform.paths = self._db_paths([dict_name, dict_key], update_timestamp)
 		return transform
 	
 	def _db_append_to_list(self, list_name, value, update_timestamp = True):
 		def transform(element):
+			start = len(element[list_name])
 			if type(value) is list:
 				element[list_name].extend(value)
 			else:
 				element[list_name].append(value)
+			transform.paths.extend([[list_name, i] for i in range(start, len(element[list_name]))])
+			if update_timestamp and 'update_timestamp' in element:
+				element['update_timestamp'] =  HXAPI.dt_to_str(datetime.datetime.utcnow())
+		transform.paths = self._db_paths(None, update_timestamp)
+		return transform
+	
+	def _db_increment(self, field, n, update_timestamp = True):
+		def transform(element):
+			element[field] = element.get(field, 0) + n
 			if update_timestamp and 'update_timestamp' in element:
 				element['update_timestamp'] =  HXAPI.dt_to_str(datetime.datetime.utcnow())
+		transform.paths = self._db_paths([field], update_timestamp)
 		return transform
 	
 	def _db_update_dict_in_list(self, list_name, query_key, query_value, k, v, update_timestamp = True):
 		def transform(element):
-			for i in element[list_name]:
+			for index, i in enumerate(element[list_name]):
 				if i[query_key] == query_value:
 					i[k] = v
+					transform.paths.append([list_name, index, k])
 					break
 			if update_timestamp and 'update_timestamp' in element:
 				element['update_timestamp'] =  HXAPI.dt_to_str(datetime.datetime.utcnow())
+		transform.paths = self._db_paths(None, update_timestamp)
 		return transform
+	
+	def _db_paths(self, path, update_timestamp):
+		paths = []
+		if path:
+			paths.append(path)
+		if update_timestamp:
+			paths.append(['update_timestamp'])
+		return paths
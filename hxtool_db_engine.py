@@ -0,0 +1,619 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Storage engines for hxtool_db
+#
+# Each engine exposes the small subset of the TinyDB API that hxtool_db uses:
+# table(name) returning an object with insert/get/search/update/remove/all/len,
+# and query(**fields) returning an equality condition usable by that table.
+
+import os
+import sys
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:
+	import tinydb
+	from tinydb.storages import JSONStorage, Storage
+	from tinydb.middlewares import CachingMiddleware
+except ImportError:
+	print("hxtool_db requires the 'tinydb' module, please install it.")
+	exit(1)
+
+import hxtool_logging
+
+logger = hxtool_logging.getLogger(__name__)
+
+DB_ENGINE_TINYDB = 'tinydb'
+DB_ENGINE_SQLITE = 'sqlite'
+
+db_engine_file_names = {
+	DB_ENGINE_TINYDB : 'hxtool.db',
+	DB_ENGINE_SQLITE : 'hxtool.sqlite'
+}
+
+def get_db_engine(db_engine, db_file, **kwargs):
+	if db_engine == DB_ENGINE_SQLITE:
+		return hxtool_db_sqlite_engine(db_file)
+	elif db_engine == DB_ENGINE_TINYDB:
+		return hxtool_db_tinydb_engine(db_file, **kwargs)
+	raise ValueError("Unknown database engine: {}".format(db_engine))
+
+class hxtool_db_tinydb_engine:
+	# TinyDB tables keep an unsynchronized query cache, so reads of the same table can't overlap,
+	# and every write rewrites the one JSON document that holds all of the tables.
+	shared_reads = False
+	
+	def __init__(self, db_file, write_cache_size = 10, journal = False, journal_compact_size = 16777216):
+		self.db_file = db_file
+		self.storage_lock = threading.RLock()
+		self._batch_depth = 0
+		self._journal = None
+		self._journal_tables = {}
+		if journal:
+			self.journal_file = db_file + '.journal'
+			self.journal_compact_size = journal_compact_size
+			self._journal_sync_pending = False
+			self._storage = hxtool_db_journaled_cache(hxtool_db_snapshot_storage)
+			self._db = tinydb.TinyDB(db_file, storage = self._storage)
+			self._recover()
+			self._journal = open(self.journal_file, 'a')
+		else:
+			CachingMiddleware.WRITE_CACHE_SIZE = write_cache_size
+			self._storage = CachingMiddleware(JSONStorage)
+			self._db = tinydb.TinyDB(db_file, storage = self._storage)
+
+	def table(self, table_name):
+		if self._journal is None:
+			return self._db.table(table_name)
+		t = self._journal_tables.get(table_name)
+		if t is None:
+			t = self._journal_tables[table_name] = hxtool_db_journaled_table(self, table_name, self._db.table(table_name))
+		return t
+
+	# Hold back CachingMiddleware flushes (or journal fsyncs) until the outermost batch exits, then write once
+	@contextmanager
+	def batch(self):
+		with self.storage_lock:
+			self._batch_depth += 1
+			if self._batch_depth == 1 and self._journal is None:
+				self._storage.WRITE_CACHE_SIZE = sys.maxsize
+			try:
+				yield self
+			finally:
+				self._batch_depth -= 1
+				if self._batch_depth == 0:
+					if self._journal is None:
+						del self._storage.WRITE_CACHE_SIZE
+						self._storage.flush()
+					else:
+						self._sync_journal()
+
+	def tables(self):
+		return self._db.tables()
+
+	def query(self, **fields):
+		q = None
+		for k, v in fields.items():
+			q = (tinydb.Query()[k] == v) if q is None else (q & (tinydb.Query()[k] == v))
+		return q
+
+	# Called with the storage lock held by every journaled write
+	def journal_write(self, records):
+		self._journal.write(''.join([json.dumps(_) + '\n' for _ in records]))
+		self._journal_sync_pending = True
+		if self._batch_depth == 0:
+			self._sync_journal()
+
+	def _sync_journal(self):
+		if self._journal_sync_pending:
+			self._journal.flush()
+			os.fsync(self._journal.fileno())
+			self._journal_sync_pending = False
+		if self._journal.tell() >= self.journal_compact_size:
+			self.compact()
+
+	# Replay mutations that were journaled but never made it into a snapshot, i.e. after a crash
+	def _recover(self):
+		tables = self._storage.read()
+		if tables is None:
+			tables = {}
+		record_count = replay_journal(tables, self.journal_file)
+		if record_count > 0:
+			logger.warning("Recovered %s journal records from %s", record_count, self.journal_file)
+			self._storage.cache = tables
+			self._storage.snapshot()
+			with open(self.journal_file, 'w') as f:
+				os.fsync(f.fileno())
+
+	"""
+	Write the in-memory database out to a new snapshot and empty the journal.
+	The snapshot replaces the database file atomically, and is written before the journal is
+	truncated, so a crash in between just replays records that are already in the snapshot.
+	"""
+	def compact(self):
+		if self._journal is None:
+			with self.storage_lock:
+				self._storage.flush()
+				# Rewrite the file even if nothing is pending, JSONStorage truncates whatever is left over
+				if self._storage.cache is not None:
+					self._storage.storage.write(self._storage.cache)
+			return
+		with self.storage_lock:
+			self._journal.flush()
+			self._storage.snapshot()
+			self._journal.seek(0)
+			self._journal.truncate()
+			os.fsync(self._journal.fileno())
+			self._journal_sync_pending = False
+
+	def table_sizes(self):
+		with self.storage_lock:
+			tables = self._storage.read() or {}
+			return {k : {'documents' : len(v), 'bytes' : len(json.dumps(v))} for k, v in tables.items()}
+
+	def file_sizes(self):
+		return {os.path.basename(_) : os.path.getsize(_) for _ in [self.db_file, self.db_file + '.journal'] if os.path.isfile(_)}
+
+	def close(self):
+		if self._db is not None:
+			if self._journal is not None:
+				self.compact()
+				self._journal.close()
+				self._journal = None
+			self._db.close()
+			self._db = None
+
+# Journaled writes go through this proxy, which appends the resulting document (or its removal)
+# to the journal. Updates only journal the fields they change, so that updating one host of a bulk download
+# doesn't journal all of its hosts: dict updates journal their keys, and callable updates journal the paths
+# they list in their paths attribute, see hxtool_db._db_update_nested_dict(). Callable updates without it
+# journal the whole document. Reads are passed straight through to the TinyDB table.
+class hxtool_db_journaled_table:
+	def __init__(self, engine, table_name, table):
+		self.engine = engine
+		self.name = table_name
+		self._table = table
+
+	def __getattr__(self, name):
+		return getattr(self._table, name)
+
+	def __len__(self):
+		return len(self._table)
+
+	def _put_records(self, doc_ids):
+		return [['put', self.name, doc_id, self._table.get(doc_id = doc_id)] for doc_id in doc_ids]
+
+	# A path is a list of dictionary keys and list indexes. Each change is [path, value], or [path] for a dictionary key
+	# that was removed. Paths to list items that don't exist are left out, as removing them would shift the list.
+	def _patch_records(self, doc_ids, paths):
+		records = []
+		for doc_id in doc_ids:
+			document = self._table.get(doc_id = doc_id)
+			changes = []
+			for path in paths:
+				(parent, value) = _document_path(document, path)
+				if isinstance(parent, dict) and path[-1] in parent:
+					changes.append([path, value])
+				elif isinstance(parent, list) and isinstance(path[-1], int) and 0 <= path[-1] < len(parent):
+					changes.append([path, value])
+				elif isinstance(parent, dict):
+					changes.append([path])
+			records.append(['patch', self.name, doc_id, changes])
+		return records
+
+	def insert(self, document):
+		with self.engine.storage_lock:
+			doc_id = self._table.insert(document)
+			self.engine.journal_write(self._put_records([doc_id]))
+			return doc_id
+
+	def update(self, fields, cond = None, doc_ids = None):
+		if callable(fields):
+			paths = getattr(fields, 'paths', None)
+		else:
+			paths = [[_] for _ in fields]
+		with self.engine.storage_lock:
+			updated = self._table.update(fields, cond, doc_ids = doc_ids)
+			if paths is None:
+				self.engine.journal_write(self._put_records(updated))
+			else:
+				# Callables add their paths once per document they update
+				self.engine.journal_write(self._patch_records(updated, [list(_) for _ in OrderedDict.fromkeys([tuple(_) for _ in paths])]))
+			return updated
+
+	def remove(self, cond = None, doc_ids = None):
+		with self.engine.storage_lock:
+			removed = self._table.remove(cond, doc_ids = doc_ids)
+			self.engine.journal_write([['del', self.name, doc_id, None] for doc_id in removed])
+			return removed
+
+# The container that holds the last element of path in document and the value at path, (None, None) if the
+# container doesn't exist, or (container, None) if the container doesn't hold the last element
+def _document_path(document, path):
+	parent = document
+	for k in path[:-1]:
+		if isinstance(parent, dict):
+			parent = parent.get(k, None)
+		elif isinstance(parent, list) and isinstance(k, int) and 0 <= k < len(parent):
+			parent = parent[k]
+		else:
+			return (None, None)
+	k = path[-1]
+	if isinstance(parent, dict):
+		return (parent, parent.get(k, None))
+	elif isinstance(parent, list) and isinstance(k, int) and 0 <= k < len(parent):
+		return (parent, parent[k])
+	return (parent if isinstance(parent, (dict, list)) else None, None)
+
+# Apply the changes of a patch record to a document. The values are absolute, a list index one past the end
+# appends, so replaying a patch that is already in the snapshot leaves the document as it is.
+def _patch_document(document, changes):
+	for change in changes:
+		path = change[0]
+		parent = document
+		for k in path[:-1]:
+			if isinstance(parent, dict):
+				parent = parent.setdefault(k, {})
+			elif isinstance(parent, list) and 0 <= k < len(parent):
+				parent = parent[k]
+			else:
+				parent = None
+				break
+		k = path[-1]
+		if isinstance(parent, dict):
+			if len(change) > 1:
+				parent[k] = change[1]
+			else:
+				parent.pop(k, None)
+		elif isinstance(parent, list) and len(change) > 1:
+			if 0 <= k < len(parent):
+				parent[k] = change[1]
+			elif k == len(parent):
+				parent.append(change[1])
+
+# With a journal the cache is the database, it is only written out as a whole by snapshot()
+class hxtool_db_journaled_cache(CachingMiddleware):
+	WRITE_CACHE_SIZE = sys.maxsize
+
+	def snapshot(self):
+		if self.cache is not None:
+			self.storage.write(self.cache)
+		self._cache_modified_count = 0
+
+# JSON storage that replaces the file atomically, so a crash mid-write leaves the previous snapshot intact
+class hxtool_db_snapshot_storage(Storage):
+	def __init__(self, path, **kwargs):
+		self.path = path
+
+	def read(self):
+		if not os.path.isfile(self.path) or os.path.getsize(self.path) == 0:
+			return None
+		with open(self.path, 'r') as f:
+			return json.load(f)
+
+	def write(self, data):
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(data, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.path)
+
+	def close(self):
+		pass
+
+def replay_journal(tables, journal_file):
+	record_count = 0
+	if not os.path.isfile(journal_file):
+		return record_count
+	with open(journal_file, 'r') as f:
+		for line in f:
+			# A torn last record is from a write that never completed
+			if not line.endswith('\n'):
+				break
+			try:
+				(op, table_name, doc_id, document) = json.loads(line)
+			except ValueError:
+				break
+			t = tables.setdefault(table_name, {})
+			if op == 'put':
+				t[str(doc_id)] = document
+			elif op == 'patch':
+				# Nothing to patch if the document was removed by a later record that is already in the snapshot
+				if str(doc_id) in t:
+					_patch_document(t[str(doc_id)], document)
+			elif op == 'del':
+				t.pop(str(doc_id), None)
+			record_count += 1
+	return record_count
+
+class hxtool_db_document(dict):
+	def __init__(self, value, doc_id):
+		super(hxtool_db_document, self).__init__(value)
+		self.doc_id = doc_id
+
+# SQLite engine, one SQL table per HXTool table holding the JSON document, with
+# expression indexes over the fields that hxtool_db looks documents up by.
+class hxtool_db_sqlite_engine:
+	shared_reads = True
+	
+	TABLE_INDEXES = {
+		'profile' : [('profile_id',)],
+		'background_processor_credential' : [('profile_id',)],
+		'alert' : [('profile_id', 'hx_alert_id')],
+		'bulk_download' : [('profile_id', 'bulk_acquisition_id')],
+		'file_listing' : [('profile_id', 'bulk_download_eid')],
+		'multi_file' : [('profile_id',)],
+		'stacking' : [('profile_id', 'bulk_download_eid')],
+		'session' : [('session_id',)],
+		'scripts' : [('script_id',)],
+		'openioc' : [('ioc_id',)],
+		'tasks' : [('profile_id', 'task_id')],
+		'taskprofiles' : [('taskprofile_id',)],
+		'audits' : [('profile_id', 'audit_id')],
+		'rules' : [('id',), ('profile_id',)],
+		'ObjectCache' : [('profile_id', 'type', 'contentId')]
+	}
+
+	def __init__(self, db_file, timeout = 30):
+		self.db_file = db_file
+		self.timeout = timeout
+		self._local = threading.local()
+		self._lock = threading.RLock()
+		# SQLite only allows a single writer anyway, serializing writers in process keeps
+		# them from spinning in SQLite's busy handler while a batch transaction is open
+		self.storage_lock = threading.RLock()
+		self._connections = []
+		self._tables = {}
+
+		c = self.connection()
+		c.execute("PRAGMA journal_mode=WAL")
+		for (table_name,) in c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'sqlite_sequence'").fetchall():
+			# Picks up any indexes added since the table was created
+			self._create_table(table_name)
+			self._tables[table_name] = hxtool_db_sqlite_table(self, table_name)
+
+	# SQLite connections can't be shared between threads while in a transaction, so each thread gets its own.
+	# WAL mode allows those connections to read concurrently with a single writer.
+	def connection(self):
+		c = getattr(self._local, 'connection', None)
+		if c is None:
+			c = sqlite3.connect(self.db_file, timeout = self.timeout, isolation_level = None, check_same_thread = False)
+			c.execute("PRAGMA synchronous=NORMAL")
+			self._local.connection = c
+			self._local.transaction_depth = 0
+			with self._lock:
+				self._connections.append(c)
+		return c
+
+	@contextmanager
+	def transaction(self):
+		c = self.connection()
+		if self._local.transaction_depth == 0:
+			c.execute("BEGIN IMMEDIATE")
+		self._local.transaction_depth += 1
+		try:
+			yield c
+		except:
+			self._local.transaction_depth -= 1
+			if self._local.transaction_depth == 0:
+				c.execute("ROLLBACK")
+			raise
+		else:
+			self._local.transaction_depth -= 1
+			if self._local.transaction_depth == 0:
+				c.execute("COMMIT")
+
+	@contextmanager
+	def batch(self):
+		with self.storage_lock:
+			with self.transaction():
+				yield self
+
+	def table(self, table_name):
+		t = self._tables.get(table_name)
+		if t is None:
+			with self._lock:
+				t = self._tables.get(table_name)
+				if t is None:
+					self._create_table(table_name)
+					t = self._tables[table_name] = hxtool_db_sqlite_table(self, table_name)
+		return t
+
+	def tables(self):
+		return list(self._tables.keys())
+
+	def _create_table(self, table_name):
+		c = self.connection()
+		c.execute('CREATE TABLE IF NOT EXISTS {} (doc_id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)'.format(sql_identifier(table_name)))
+		for i, fields in enumerate(self.TABLE_INDEXES.get(table_name, [])):
+			c.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(sql_identifier('ix_{}_{}'.format(table_name, i)),
+																		sql_identifier(table_name),
+																		', '.join([json_field_expression(_) for _ in fields])))
+
+	def query(self, **fields):
+		return fields
+
+	def compact(self):
+		with self.storage_lock:
+			c = self.connection()
+			c.execute("VACUUM")
+			c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+	def table_sizes(self):
+		c = self.connection()
+		r = {}
+		for table_name in self.tables():
+			(documents, size) = c.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM {}'.format(sql_identifier(table_name))).fetchone()
+			r[table_name] = {'documents' : documents, 'bytes' : size}
+		return r
+
+	def file_sizes(self):
+		return {os.path.basename(_) : os.path.getsize(_) for _ in [self.db_file, self.db_file + '-wal'] if os.path.isfile(_)}
+
+	# One-shot import of an existing TinyDB JSON file, doc_ids are preserved
+	# since documents reference each other by them (i.e. bulk_download_eid)
+	def migrate_from_tinydb(self, tinydb_file):
+		with open(tinydb_file, 'r') as f:
+			tinydb_data = json.load(f)
+		replay_journal(tinydb_data, tinydb_file + '.journal')
+
+		document_count = 0
+		with self.transaction() as c:
+			for table_name, documents in tinydb_data.items():
+				t = self.table(table_name)
+				for doc_id, document in documents.items():
+					c.execute('INSERT OR REPLACE INTO {} (doc_id, data) VALUES (?, ?)'.format(t.sql_name), (int(doc_id), json.dumps(document)))
+					document_count += 1
+		logger.info("Migrated %s documents in %s tables from %s to %s.", document_count, len(tinydb_data), tinydb_file, self.db_file)
+		return document_count
+
+	def close(self):
+		with self._lock:
+			for c in self._connections:
+				try:
+					c.close()
+				except sqlite3.ProgrammingError:
+					pass
+			self._connections = []
+		self._local = threading.local()
+
+class hxtool_db_sqlite_table:
+	def __init__(self, engine, table_name):
+		self.engine = engine
+		self.name = table_name
+		self.sql_name = sql_identifier(table_name)
+
+	def _where(self, cond = None, doc_ids = None, doc_id = None):
+		clauses = []
+		params = []
+		if doc_id is not None:
+			doc_ids = [doc_id]
+		if doc_ids is not None:
+			clauses.append('doc_id IN ({})'.format(', '.join(['?'] * len(doc_ids))))
+			params.extend([int(_) for _ in doc_ids])
+		if cond:
+			for k, v in cond.items():
+				if v is None:
+					clauses.append('{} IS NULL'.format(json_field_expression(k)))
+				else:
+					clauses.append('{} = ?'.format(json_field_expression(k)))
+					params.append(v)
+		return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+	def _select(self, where, params, limit = None):
+		sql = 'SELECT doc_id, data FROM {}{} ORDER BY doc_id'.format(self.sql_name, where)
+		if limit:
+			sql += ' LIMIT {}'.format(int(limit))
+		return [hxtool_db_document(json.loads(data), doc_id) for (doc_id, data) in self.engine.connection().execute(sql, params)]
+
+	def insert(self, document):
+		with self.engine.transaction() as c:
+			return c.execute('INSERT INTO {} (data) VALUES (?)'.format(self.sql_name), (json.dumps(document),)).lastrowid
+
+	def all(self):
+		return self._select('', [])
+
+	def search(self, cond):
+		return self._select(*self._where(cond))
+
+	def get(self, cond = None, doc_id = None):
+		r = self._select(*self._where(cond, doc_id = doc_id), limit = 1)
+		return r[0] if r else None
+
+	def update(self, fields, cond = None, doc_ids = None):
+		updated = []
+		with self.engine.transaction() as c:
+			for document in self._select(*self._where(cond, doc_ids = doc_ids)):
+				if callable(fields):
+					fields(document)
+				else:
+					document.update(fields)
+				c.execute('UPDATE {} SET data = ? WHERE doc_id = ?'.format(self.sql_name), (json.dumps(document), document.doc_id))
+				updated.append(document.doc_id)
+		return updated
+
+	def remove(self, cond = None, doc_ids = None):
+		with self.engine.transaction() as c:
+			(where, params) = self._where(cond, doc_ids = doc_ids)
+			removed = [_[0] for _ in c.execute('SELECT doc_id FROM {}{}'.format(self.sql_name, where), params)]
+			if removed:
+				c.execute('DELETE FROM {}{}'.format(self.sql_name, where), params)
+		return removed
+
+	def __len__(self):
+		return self.engine.connection().execute('SELECT COUNT(*) FROM {}'.format(self.sql_name)).fetchone()[0]
+
+# Append-only store for job results (stacking records, file listings), kept outside of the database
+# so that adding a host's results costs O(records added) instead of rewriting the parent document.
+# Each job gets one JSON lines file: <results_path>/<table name>/<doc_id>.jsonl
+class hxtool_db_result_store:
+	def __init__(self, results_path):
+		self.results_path = results_path
+		self._lock = threading.Lock()
+
+	def _file_name(self, table_name, doc_id):
+		return os.path.join(self.results_path, table_name, '{}.jsonl'.format(int(doc_id)))
+
+	def append(self, table_name, doc_id, records):
+		if type(records) is not list:
+			records = [records]
+		file_name = self._file_name(table_name, doc_id)
+		with self._lock:
+			if not os.path.isdir(os.path.dirname(file_name)):
+				os.makedirs(os.path.dirname(file_name))
+			with open(file_name, 'a') as f:
+				f.write(''.join([json.dumps(_) + '\n' for _ in records]))
+		return len(records)
+
+	# Streams the records back without loading the whole file, a line without a trailing
+	# newline is an append that is still in progress and is skipped.
+	def read(self, table_name, doc_id, offset = 0, limit = None):
+		file_name = self._file_name(table_name, doc_id)
+		if not os.path.isfile(file_name):
+			return
+		with open(file_name, 'r') as f:
+			index = 0
+			for line in f:
+				if not line.endswith('\n'):
+					break
+				if index >= offset:
+					if limit is not None and index >= offset + limit:
+						break
+					yield json.loads(line)
+				index += 1
+
+	def size(self, table_name, doc_id):
+		file_name = self._file_name(table_name, doc_id)
+		return os.path.getsize(file_name) if os.path.isfile(file_name) else 0
+
+	def sizes(self):
+		r = {}
+		if os.path.isdir(self.results_path):
+			for table_name in os.listdir(self.results_path):
+				table_path = os.path.join(self.results_path, table_name)
+				if os.path.isdir(table_path):
+					r[table_name] = {'files' : 0, 'bytes' : 0}
+					for file_name in os.listdir(table_path):
+						r[table_name]['files'] += 1
+						r[table_name]['bytes'] += os.path.getsize(os.path.join(table_path, file_name))
+		return r
+
+	def delete(self, table_name, doc_id):
+		file_name = self._file_name(table_name, doc_id)
+		with self._lock:
+			if os.path.isfile(file_name):
+				os.remove(file_name)
+
+def sql_identifier(name):
+	return '"{}"'.format(name.replace('"', '""'))
+
+# Must produce the exact same expression text for queries and indexes, otherwise SQLite won't use the index
+def json_field_expression(field_name):
+	if '"' in field_name or '\\' in field_name:
+		raise ValueError("Invalid field name: {}".format(field_name))
+	return "json_extract(data, '$.\"{}\"')".format(field_name.replace("'", "''"))
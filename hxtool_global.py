@@ -7,6 +7,10 @@ def initialize():
 	global apicache
 	apicache = {}
 	
+	# Dashboard aggregates maintained by the apicache, by profile ID
+	global apicache_aggregates
+	apicache_aggregates = {}
+	
 	global hxtool_db
 	global hxtool_config
 	global hxtool_scheduler
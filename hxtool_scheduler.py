@@ -6,8 +6,16 @@ import threading
 import datetime
 import calendar
 import random
+import heapq
+import itertools
+import bisect
+import time
+import os
+import gzip
+import json
+from collections import OrderedDict
 from multiprocessing.pool import ThreadPool
-from multiprocessing import cpu_count, TimeoutError
+from multiprocessing import cpu_count, get_context
 
 import hxtool_logging
 import hxtool_global
@@ -41,51 +49,245 @@ task_state_description = {
 
 
 MAX_HISTORY_QUEUE_LENGTH = 1000
+
+# Named thread pools, task modules pick one with pool()
+TASK_POOL_IO = 'io'
+TASK_POOL_PARSE = 'parse'
+TASK_POOL_SYSTEM = 'system'
+TASK_POOL_DOWNLOAD = 'download'
+
+# Upper bounds in seconds of the histogram buckets for step durations and task start delays
+METRICS_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+
+class hxtool_scheduler_histogram:
+	def __init__(self):
+		self.count = 0
+		self.sum = 0.0
+		self.buckets = [0] * (len(METRICS_BUCKETS) + 1)
+	
+	def observe(self, value):
+		self.count += 1
+		self.sum += value
+		self.buckets[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+	
+	# Cumulative bucket counts keyed on the upper bound, as Prometheus expects them
+	def snapshot(self):
+		buckets = OrderedDict()
+		total = 0
+		for le, n in zip([str(_) for _ in METRICS_BUCKETS] + ['+Inf'], self.buckets):
+			total += n
+			buckets[le] = total
+		return {'count' : self.count, 'sum' : self.sum, 'buckets' : buckets}
+
+# Counters and histograms collected as tasks run, the gauges are read from the scheduler when a snapshot is taken
+class hxtool_scheduler_metrics:
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.start_delay = hxtool_scheduler_histogram()
+		self.steps = {}
+		self.step_failures = {}
+		self.task_states = {}
+		self.defers = 0
+		self.pool_active = {}
+	
+	def observe_start_delay(self, seconds):
+		with self._lock:
+			self.start_delay.observe(max(0.0, seconds))
+	
+	def observe_step(self, step_name, seconds, ret):
+		with self._lock:
+			self.steps.setdefault(step_name, hxtool_scheduler_histogram()).observe(seconds)
+			if not ret:
+				self.step_failures[step_name] = self.step_failures.get(step_name, 0) + 1
+	
+	def observe_task(self, state, deferred):
+		with self._lock:
+			if deferred:
+				self.defers += 1
+			else:
+				state_name = task_state_description.get(state, "Unknown")
+				self.task_states[state_name] = self.task_states.get(state_name, 0) + 1
+	
+	def pool_enter(self, pool):
+		with self._lock:
+			self.pool_active[pool] = self.pool_active.get(pool, 0) + 1
+	
+	def pool_exit(self, pool):
+		with self._lock:
+			self.pool_active[pool] = self.pool_active.get(pool, 0) - 1
+	
+	def snapshot(self):
+		with self._lock:
+			return {
+				'start_delay' : self.start_delay.snapshot(),
+				'steps' : {k : dict(v.snapshot(), failures = self.step_failures.get(k, 0)) for k, v in self.steps.items()},
+				'task_runs' : dict(self.task_states),
+				'defers' : self.defers,
+				'pool_active' : dict(self.pool_active)
+			}
+	
+	@staticmethod
+	def _prometheus_histogram(lines, name, help_text, histograms, label = None):
+		lines.append("# HELP {} {}".format(name, help_text))
+		lines.append("# TYPE {} histogram".format(name))
+		for label_value, h in histograms:
+			labels = '{}="{}",'.format(label, hxtool_scheduler_metrics._prometheus_escape(label_value)) if label else ''
+			for le, n in h['buckets'].items():
+				lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, le, n))
+			labels = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+			lines.append("{}_sum{} {}".format(name, labels, h['sum']))
+			lines.append("{}_count{} {}".format(name, labels, h['count']))
+	
+	@staticmethod
+	def _prometheus_metric(lines, name, metric_type, help_text, samples, label = None):
+		lines.append("# HELP {} {}".format(name, help_text))
+		lines.append("# TYPE {} {}".format(name, metric_type))
+		for label_value, v in samples:
+			if label:
+				lines.append('{}{{{}="{}"}} {}'.format(name, label, hxtool_scheduler_metrics._prometheus_escape(label_value), v))
+			else:
+				lines.append("{} {}".format(name, v))
+	
+	@staticmethod
+	def _prometheus_escape(v):
+		return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+	
+	# Render a hxtool_scheduler.metrics() snapshot in the Prometheus text exposition format
+	@staticmethod
+	def prometheus(m):
+		lines = []
+		metric = hxtool_scheduler_metrics._prometheus_metric
+		metric(lines, 'hxtool_scheduler_run_queue_depth', 'gauge', "Tasks waiting for their next run.", [(None, m['queue']['run_queue'])])
+		metric(lines, 'hxtool_scheduler_tasks', 'gauge', "Tasks in the scheduler by state.", sorted(m['queue']['states'].items()), label = 'state')
+		metric(lines, 'hxtool_scheduler_history_tasks', 'gauge', "Tasks in the scheduler history.", [(None, m['queue']['history'])])
+		metric(lines, 'hxtool_scheduler_pool_threads', 'gauge', "Threads in each scheduler thread pool.", sorted([(k, v['threads']) for k, v in m['pools'].items()]), label = 'pool')
+		metric(lines, 'hxtool_scheduler_pool_active', 'gauge', "Busy threads in each scheduler thread pool.", sorted([(k, v['active']) for k, v in m['pools'].items()]), label = 'pool')
+		metric(lines, 'hxtool_scheduler_task_runs_total', 'counter', "Task runs by resulting state, deferred runs are counted separately.", sorted(m['task_runs'].items()), label = 'state')
+		metric(lines, 'hxtool_scheduler_defers_total', 'counter', "Task runs that ended in a defer.", [(None, m['defers'])])
+		metric(lines, 'hxtool_scheduler_step_failures_total', 'counter', "Task steps that returned False or raised.", sorted([(k, v['failures']) for k, v in m['steps'].items()]), label = 'step')
+		hxtool_scheduler_metrics._prometheus_histogram(lines, 'hxtool_scheduler_task_start_delay_seconds', "Time between a task's scheduled run and its actual start.", [(None, m['start_delay'])])
+		hxtool_scheduler_metrics._prometheus_histogram(lines, 'hxtool_scheduler_step_duration_seconds', "Duration of task steps.", sorted(m['steps'].items()), label = 'step')
+		return "\n".join(lines) + "\n"
 		
-# Note: scheduler resolution is a little less than a second
+# Tasks are dispatched from a heap ordered on next_run, the poll thread sleeps until the earliest
+# next_run or until a task is (re)scheduled. Heap entries are never removed, entries whose task was
+# removed or rescheduled in the meantime are skipped when they come up.
 class hxtool_scheduler:
-	def __init__(self, thread_count = None):
+	def __init__(self, thread_count = None, pool_sizes = None, process_pool_size = 0, history_length = None, history_archive_path = None):
 		self._lock = threading.Lock()
+		self._run_queue_condition = threading.Condition(self._lock)
+		self._run_queue = []
+		self._run_queue_counter = itertools.count()
 		self.task_queue = {}
-		self.history_queue = {}
+		# Oldest first, entries beyond history_length are evicted from the front and archived if there is an archive path
+		self.history_queue = OrderedDict()
+		self.history_length = history_length or MAX_HISTORY_QUEUE_LENGTH
+		self.history_archive_path = history_archive_path
+		self._history_archive_lock = threading.Lock()
+		# parent task_id -> task_ids of its children, in the task queue or the history
+		self._children = {}
 		self.task_hx_api_sessions = {}
 		self._poll_thread = threading.Thread(target = self._scan_task_queue, name = "PollThread")
 		self._stop_event = threading.Event()
 		# Allow for thread oversubscription based on CPU count
 		self.thread_count = thread_count or (cpu_count() + 1)
-		self.task_threads = ThreadPool(self.thread_count)
+		self.pool_sizes = {
+			TASK_POOL_IO : self.thread_count,
+			TASK_POOL_PARSE : cpu_count(),
+			TASK_POOL_SYSTEM : 8,
+			TASK_POOL_DOWNLOAD : 8
+		}
+		if pool_sizes:
+			self.pool_sizes.update({k : v for k, v in pool_sizes.items() if v})
+		self.task_pools = {k : ThreadPool(v) for k, v in self.pool_sizes.items()}
+		self._pool_local = threading.local()
+		self.metrics_collector = hxtool_scheduler_metrics()
+		# Worker processes for CPU bound audit parsing, 0 disables the process pool and parsing runs in the calling thread
+		self.process_pool_size = process_pool_size or 0
+		self.process_pool = None
 		logger.info("Task scheduler initialized.")
 
 
+	# Caller must hold the lock
+	def _schedule(self, task):
+		if task.next_run is not None:
+			heapq.heappush(self._run_queue, (task.next_run, next(self._run_queue_counter), task))
+			if self._run_queue[0][2] is task:
+				self._run_queue_condition.notify()
+	
+	# Caller must hold the lock
+	def _pop_due_tasks(self):
+		tasks = []
+		now = datetime.datetime.utcnow()
+		while self._run_queue and self._run_queue[0][0] <= now:
+			(next_run, _, task) = heapq.heappop(self._run_queue)
+			if self.task_queue.get(task.task_id) is task and task.next_run == next_run and task.should_run():
+				# Set the state here so that a duplicate entry for the same run can't dispatch the task twice
+				task.set_state(TASK_STATE_QUEUED)
+				tasks.append(task)
+		return tasks
+	
+	# Due tasks are handed to the thread pool without waiting for them, _run_task reschedules the task when it's done
 	def _scan_task_queue(self):
-		while not self._stop_event.wait(.1):
-			ret = None
-			with self._lock:
-				ret = self.task_threads.imap_unordered(self._run_task, [_ for _ in self.task_queue.values() if _.should_run()])
-			if ret:
-				while not self._stop_event.is_set():
-					try:
-						ret.next(timeout=5)
-					except TimeoutError:
-						break
-					except StopIteration:
-						break
-					except Exception as e:
-						logger.error(pretty_exceptions(e))
-						continue
+		while not self._stop_event.is_set():
+			with self._run_queue_condition:
+				tasks = self._pop_due_tasks()
+				for task in tasks:
+					pool = task.pool()
+					self.task_pools.get(pool, self.task_pools[TASK_POOL_IO]).apply_async(self._run_task, args = (task, pool), error_callback = self._run_task_error)
+				if not tasks and not self._stop_event.is_set():
+					timeout = (self._run_queue[0][0] - datetime.datetime.utcnow()).total_seconds() if self._run_queue else None
+					self._run_queue_condition.wait(timeout)
+	
+	def _run_task_error(self, e):
+		logger.error("Unhandled exception in a task thread: {}".format(e))
 					
-	def _run_task(self, task):
+	def _run_task(self, task, pool = TASK_POOL_IO):
 		ret = False
-		task.set_state(TASK_STATE_QUEUED)
+		self._pool_local.pool = pool
+		self.metrics_collector.pool_enter(pool)
 		logger.debug("Executing task with id: %s, name: %s.", task.task_id, task.name)
 		try:
 			ret = task.run(self)
 		except Exception as e:
 			logger.error(pretty_exceptions(e))
 			task.set_state(TASK_STATE_FAILED)
+			self.metrics_collector.observe_task(TASK_STATE_FAILED, False)
 		finally:
+			self.metrics_collector.pool_exit(pool)
+			with self._lock:
+				if task.state == TASK_STATE_SCHEDULED and self.task_queue.get(task.task_id) is task:
+					self._schedule(task)
 			return ret
 			
+	# Run f in the named pool and wait for the result, or run it directly if we're already in that pool
+	def run_in_pool(self, pool, f, *args, **kwargs):
+		if pool not in self.task_pools or getattr(self._pool_local, 'pool', None) == pool:
+			return f(*args, **kwargs)
+		return self.task_pools[pool].apply(self._run_in_pool, args = (pool, f, args, kwargs))
+	
+	# Run f in the named pool without waiting for it to finish
+	def submit(self, pool, f, *args, **kwargs):
+		if pool not in self.task_pools:
+			pool = TASK_POOL_IO
+		return self.task_pools[pool].apply_async(self._run_in_pool, args = (pool, f, args, kwargs), error_callback = self._run_task_error)
+	
+	def _run_in_pool(self, pool, f, args, kwargs):
+		self._pool_local.pool = pool
+		self.metrics_collector.pool_enter(pool)
+		try:
+			return f(*args, **kwargs)
+		finally:
+			self.metrics_collector.pool_exit(pool)
+			self._pool_local.pool = None
+	
+	# Run f in a worker process and wait for the result. f must be a module level function, and its arguments and 
+	# return value must be picklable. Runs f directly if the process pool is disabled.
+	def run_in_process(self, f, *args, **kwargs):
+		if self.process_pool is None:
+			return f(*args, **kwargs)
+		return self.process_pool.apply(f, args, kwargs)
+	
 	def _add_task_api_task(self, profile_id, hx_host, hx_port, username, password):
 		self.task_hx_api_sessions[profile_id] = HXAPI(hx_host,
 														hx_port = hx_port, 
@@ -103,16 +305,29 @@ class hxtool_scheduler:
 		self.add(api_login_task)
 	
 	def start(self):
+		if self.process_pool_size > 0:
+			# spawn rather than fork, forking a process with running threads can leave locks held in the child
+			self.process_pool = get_context('spawn').Pool(self.process_pool_size)
+			logger.info("Task scheduler process pool started with %d processes.", self.process_pool_size)
 		self._poll_thread.start()
-		logger.info("Task scheduler started with %s threads.", self.thread_count)
+		logger.info("Task scheduler started with thread pools: %s.", ", ".join(["{} ({} threads)".format(k, v) for k, v in self.pool_sizes.items()]))
 		
 	def stop(self):
 		logger.debug("stop() enter.")
 		self._stop_event.set()
-		logger.debug("Closing the task thread pool.")
-		self.task_threads.close()
+		with self._run_queue_condition:
+			self._run_queue_condition.notify_all()
+		logger.debug("Closing the task thread pools.")
+		for task_pool in self.task_pools.values():
+			task_pool.close()
 		logger.debug("Waiting for running threads to terminate.")
-		self.task_threads.join()
+		for task_pool in self.task_pools.values():
+			task_pool.join()
+		if self.process_pool is not None:
+			logger.debug("Closing the task process pool.")
+			self.process_pool.close()
+			self.process_pool.join()
+			self.process_pool = None
 		logger.debug("stop() exit.")
 	
 	def initialize_task_api_sessions(self):
@@ -158,75 +373,223 @@ class hxtool_scheduler:
 	
 	def signal_child_tasks(self, parent_task_id, parent_task_state, parent_stored_result):
 		with self._lock:
-			for task_id in self.task_queue:
-				self.task_queue[task_id].parent_state_callback(parent_task_id, parent_task_state, parent_stored_result)
+			# Child tasks store their updated state, write them all at once
+			with hxtool_global.hxtool_db.batch():
+				for task_id in self._children.get(parent_task_id, ()):
+					child_task = self.task_queue.get(task_id, None)
+					if child_task is not None:
+						child_task.parent_state_callback(parent_task_id, parent_task_state, parent_stored_result)
+						self._schedule(child_task)
+	
+	def _add(self, task, should_store = True):
+		self.task_queue[task.task_id] = task
+		self._index(task)
+		task.set_state(TASK_STATE_SCHEDULED)
+		self._schedule(task)
+		# Note: this must be within the lock otherwise we run into a nasty race condition where the task runs before the stored state is set -
+		# with the run lock taking precedence.
+		if should_store:
+			task.store()
 	
 	def add(self, task, should_store = True):
 		with self._lock:
-			self.task_queue[task.task_id] = task
-			task.set_state(TASK_STATE_SCHEDULED)
-			# Note: this must be within the lock otherwise we run into a nasty race condition where the task runs before the stored state is set -
-			# with the run lock taking precedence.
-			if should_store:
-				task.store()
+			self._add(task, should_store = should_store)
 		return task.task_id	
 		
 	def add_list(self, tasks):
 		if isinstance(tasks, list):
-			for t in tasks:
-				self.add(t)
+			with self._lock:
+				# The batch is written out before the lock is released, so none of the tasks can run before they are stored
+				with hxtool_global.hxtool_db.batch():
+					for t in tasks:
+						self._add(t)
 		
 	def remove(self, task_id, delete_children=True):
 		if task_id:
 			with self._lock:
 				if delete_children:
-					# We need to make a shallow copy so we don't modify the task_queue while iterating over it
-					for child_task_id in [_.task_id for _ in self.task_queue.values() if _.parent_id == task_id]:
-						self.task_queue[child_task_id].remove()
-						del self.task_queue[child_task_id]
-							
-					for child_task_id in [_['task_id'] for _ in self.history_queue.values() if _['parent_id'] == task_id]:
-						del self.history_queue[child_task_id]
+					for child_task_id in list(self._children.pop(task_id, ())):
+						child_task = self.task_queue.pop(child_task_id, None)
+						if child_task is not None:
+							child_task.remove()
+						self.history_queue.pop(child_task_id, None)
 							
 				t = self.task_queue.get(task_id, None)
 				if t and not t.immutable:
 					t.remove()
 					del self.task_queue[task_id]
+					self._unindex(task_id, t.parent_id)
 					t = None
 				elif task_id in self.history_queue:
-					del self.history_queue[task_id]
+					entry = self.history_queue.pop(task_id)
+					self._unindex(task_id, entry['parent_id'])
 				
 	def get(self, task_id):
 		with self._lock:
 			return self.task_queue.get(task_id, None)
 
 	def move_to_history(self, task_id):
+		evicted = []
 		with self._lock:
 			t = self.task_queue.pop(task_id, None)
 			if t is not None:
+				self.history_queue.pop(task_id, None)
 				self.history_queue[task_id] = t.metadata()
-		if len(self.history_queue) > MAX_HISTORY_QUEUE_LENGTH:
-			self.history_queue.popitem()
+			while len(self.history_queue) > self.history_length:
+				entry = self.history_queue.popitem(last = False)[1]
+				self._unindex(entry['task_id'], entry['parent_id'])
+				evicted.append(entry)
+		self._archive_history(evicted)
+	
+	# Caller must hold the lock
+	def _index(self, task):
+		if task.parent_id:
+			self._children.setdefault(task.parent_id, set()).add(task.task_id)
+	
+	# Caller must hold the lock, only drops the entry if the task is gone from both the task queue and the history
+	def _unindex(self, task_id, parent_id):
+		if parent_id and task_id not in self.task_queue and task_id not in self.history_queue:
+			children = self._children.get(parent_id, None)
+			if children is not None:
+				children.discard(task_id)
+				if not children:
+					del self._children[parent_id]
+	
+	# Caller must hold the lock
+	def _child_states(self, task_id):
+		states = {}
+		for child_task_id in self._children.get(task_id, ()):
+			child_task = self.task_queue.get(child_task_id, None)
+			if child_task is not None:
+				state = child_task.state
+				for state_name, count in child_task.child_states().items():
+					states[state_name] = states.get(state_name, 0) + count
+			elif child_task_id in self.history_queue:
+				state = self.history_queue[child_task_id]['state']
+			else:
+				continue
+			state_name = task_state_description.get(state, "Unknown")
+			states[state_name] = states.get(state_name, 0) + 1
+		return states
 	
-	def tasks(self):
-		# Shallow copy to avoid locking
-		return [_.metadata() for _ in list(self.task_queue.values())] + list(self.history_queue.values())
+	# The number of children of a task in each state, keyed on the state description
+	def child_states(self, task_id):
+		with self._lock:
+			return self._child_states(task_id)
+	
+	# Drop history entries whose last run is older than max_age, returns the removed task IDs
+	def prune_history(self, max_age):
+		cutoff = datetime.datetime.utcnow() - max_age
+		with self._lock:
+			task_ids = [k for k, v in self.history_queue.items() if v.get('last_run') and HXAPI.dt_from_str(str(v['last_run'])) < cutoff]
+			removed = [self.history_queue.pop(task_id) for task_id in task_ids]
+			for entry in removed:
+				self._unindex(entry['task_id'], entry['parent_id'])
+		self._archive_history(removed)
+		return task_ids
+	
+	# History entries that leave the history queue are appended to a gzip'd JSON lines file per day
+	def _archive_history(self, entries):
+		if not (entries and self.history_archive_path):
+			return
+		try:
+			with self._history_archive_lock:
+				if not os.path.isdir(self.history_archive_path):
+					os.makedirs(self.history_archive_path)
+				archive_file = os.path.join(self.history_archive_path, 'task_history_{}.jsonl.gz'.format(datetime.datetime.utcnow().strftime('%Y%m%d')))
+				with gzip.open(archive_file, 'at', encoding = default_encoding) as f:
+					for entry in entries:
+						f.write(json.dumps(entry, default = str) + "\n")
+		except Exception as e:
+			logger.error("Failed to archive task history: {}".format(pretty_exceptions(e)))
+	
+	# Archived history entries, newest first
+	def archived_history(self):
+		if not (self.history_archive_path and os.path.isdir(self.history_archive_path)):
+			return
+		for archive_file in sorted([_ for _ in os.listdir(self.history_archive_path) if _.startswith('task_history_') and _.endswith('.jsonl.gz')], reverse = True):
+			with self._history_archive_lock:
+				with gzip.open(os.path.join(self.history_archive_path, archive_file), 'rt', encoding = default_encoding) as f:
+					entries = [json.loads(_) for _ in f if _.strip()]
+			for entry in reversed(entries):
+				yield entry
+	
+	# Task metadata of the scheduled tasks, then the history newest first and optionally the archived history,
+	# filtered on profile and a list of states. Only the requested page is serialized.
+	def tasks(self, profile_id = None, states = None, offset = 0, limit = None, include_archive = False):
+		with self._lock:
+			task_queue = list(self.task_queue.values())
+			history_queue = list(self.history_queue.values())
+		
+		def match(task_profile_id, task_state):
+			return ((profile_id is None or str(task_profile_id) == str(profile_id)) and
+					(states is None or task_state in states))
+		
+		r = itertools.chain(
+			(_.metadata() for _ in task_queue if match(_.profile_id, _.state)),
+			(_ for _ in reversed(history_queue) if match(_['profile_id'], _['state']))
+		)
+		if include_archive:
+			r = itertools.chain(r, (_ for _ in self.archived_history() if match(_['profile_id'], _['state'])))
+		return list(itertools.islice(r, offset, (offset + limit) if limit is not None else None))
+	
+	# Fields of a scheduled task (a task object) or a history entry (a metadata dict), for sorting and searching
+	@staticmethod
+	def _task_field(task, field):
+		if isinstance(task, dict):
+			v = task.get(field, None)
+		else:
+			v = getattr(task, field, None)
+		if field == 'state':
+			return task_state_description.get(v, "Unknown")
+		elif field in ('last_run', 'next_run', 'start_time'):
+			return str(v) if v else ''
+		return v
+	
+	# One page of tasks for a table: (total tasks, tasks that match search, page). top_level leaves out child tasks,
+	# their states are in child_states of their parent. Only the tasks on the page are serialized.
+	def task_page(self, offset = 0, limit = None, search = None, order_by = None, descending = False, top_level = True, profile_id = None):
+		with self._lock:
+			all_tasks = list(self.task_queue.values()) + list(reversed(self.history_queue.values()))
+			if top_level:
+				all_tasks = [_ for _ in all_tasks if not self._task_field(_, 'parent_id')]
+			if profile_id is not None:
+				all_tasks = [_ for _ in all_tasks if str(self._task_field(_, 'profile_id')) == str(profile_id)]
+			total = len(all_tasks)
+			
+			if search:
+				search = search.lower()
+				all_tasks = [_ for _ in all_tasks if any([search in str(self._task_field(_, f)).lower() for f in ('name', 'profile_name', 'state', 'task_id', 'last_run', 'next_run')])]
+			
+			if order_by:
+				# None sorts first
+				all_tasks.sort(key = lambda _: (self._task_field(_, order_by) is not None, str(self._task_field(_, order_by))), reverse = descending)
+			
+			page = all_tasks[offset:(offset + limit) if limit is not None else None]
+			r = []
+			for task in page:
+				metadata = task if isinstance(task, dict) else task.metadata()
+				metadata = dict(metadata, child_states = self._child_states(metadata['task_id']))
+				r.append(metadata)
+		return (total, len(all_tasks), r)
 	
 	# Load queued tasks from the database
 	def load_from_database(self):
 		try:
 			if self.status():
-				tasks = hxtool_global.hxtool_db.taskList()
-				for task_entry in tasks:
-					p_id = task_entry.get('parent_id', None)
-					if p_id and (not task_entry['parent_complete'] and not hxtool_global.hxtool_db.taskGet(task_entry['profile_id'], p_id)):
-						logger.warn("Deleting orphan task {}, {}".format(task_entry['name'], task_entry['task_id']))
-						hxtool_global.hxtool_db.taskDelete(task_entry['profile_id'], task_entry['task_id'])
-					else:
-						task = hxtool_scheduler_task.deserialize(task_entry)
-						task.set_stored()
-						# Set should_store to False as we've already been stored, and we skip a needless update
-						self.add(task, should_store = False)
+				with hxtool_global.hxtool_db.batch():
+					tasks = hxtool_global.hxtool_db.taskList()
+					task_ids = set([(_['profile_id'], _['task_id']) for _ in tasks])
+					for task_entry in tasks:
+						p_id = task_entry.get('parent_id', None)
+						if p_id and (not task_entry['parent_complete'] and not (task_entry['profile_id'], p_id) in task_ids):
+							logger.warn("Deleting orphan task {}, {}".format(task_entry['name'], task_entry['task_id']))
+							hxtool_global.hxtool_db.taskDelete(task_entry['profile_id'], task_entry['task_id'])
+						else:
+							task = hxtool_scheduler_task.deserialize(task_entry)
+							task.set_stored()
+							# Set should_store to False as we've already been stored, and we skip a needless update
+							self.add(task, should_store = False)
 			else:
 				logger.warn("Task scheduler must be running before loading queued tasks from the database.")
 		except Exception as e:
@@ -234,6 +597,26 @@ class hxtool_scheduler:
 	
 	def status(self):
 		return self._poll_thread.is_alive()
+	
+	# Queue depth and pool utilization gauges, along with the counters and histograms collected by the tasks
+	def metrics(self):
+		m = self.metrics_collector.snapshot()
+		states = {}
+		with self._lock:
+			run_queue = len(self._run_queue)
+			for task in self.task_queue.values():
+				state_name = task_state_description.get(task.state, "Unknown")
+				states[state_name] = states.get(state_name, 0) + 1
+			history = len(self.history_queue)
+		m['queue'] = {
+			'run_queue' : run_queue,
+			'tasks' : sum(states.values()),
+			'states' : states,
+			'history' : history
+		}
+		m['pools'] = {k : {'threads' : v, 'active' : m['pool_active'].get(k, 0)} for k, v in self.pool_sizes.items()}
+		del m['pool_active']
+		return m
 		
 class hxtool_scheduler_task:
 	def __init__(self, profile_id, name, task_id = None, start_time = None, end_time = None, next_run = None, enabled = True, immutable = False, stop_on_fail = True, parent_id = None, wait_for_parent = True, defer_interval = 30):
@@ -263,10 +646,18 @@ class hxtool_scheduler_task:
 		self.steps = []
 		self.stored_result = {}
 		self.defer_interval = defer_interval
+		# Consecutive runs that ended in defer(), drives the backoff
+		self.defer_count = 0
 		
 		self._stored = False
+		# What the database has for this task, store() only writes the fields that changed since
+		self._persisted = {}
+		self._doc_id = None
+		self._stored_result_dirty = False
+		self._steps_dirty = False
 		self._stop_signal = False
 		self._defer_signal = False
+		self._defer_backoff = True
 		
 		profile = hxtool_global.hxtool_db.profileGet(self.profile_id)
 		if profile is not None:
@@ -285,8 +676,7 @@ class hxtool_scheduler_task:
 		now = datetime.datetime.utcnow().replace(microsecond=1)
 	
 		if self._defer_signal:
-			# Add some random seconds to the interval to keep the task threads from deadlocking
-			self.next_run = (self.last_run + datetime.timedelta(seconds = (self.defer_interval + random.randint(1, 15))))
+			self.next_run = (self.last_run + datetime.timedelta(seconds = self._defer_delay()))
 		# We've never run before because we we're waiting on the parent task to complete
 		elif not self.last_run and self.parent_id and self.parent_complete:
 			# Add some random seconds to the interval to keep the task threads from deadlocking
@@ -300,6 +690,13 @@ class hxtool_scheduler_task:
 				seconds = self.schedule['seconds']
 			)
 			
+	# Exponential backoff from defer_interval, capped at defer_max_interval. Add some random seconds to
+	# the delay to keep the task threads from deadlocking and deferred tasks from polling in lockstep.
+	def _defer_delay(self):
+		max_interval = hxtool_global.hxtool_config.get_child_item('scheduler', 'defer_max_interval', 3600) or self.defer_interval
+		delay = min(max_interval, self.defer_interval * (2 ** min(max(self.defer_count - 1, 0), 16)))
+		return delay + random.uniform(1, max(15, delay / 4))
+	
 	def set_schedule(self, seconds = 0, minutes = 0, hours = 0, days = 0, weeks = 0):
 		with self._lock:
 			self.schedule = {
@@ -317,12 +714,30 @@ class hxtool_scheduler_task:
 				(self.parent_complete if (self.parent_id and self.wait_for_parent) else True) and
 				datetime.datetime.utcnow() >= self.next_run)
 					
+	# Tasks run in the pool of their first task module step, tasks made of plain function steps are system tasks
+	def pool(self):
+		for module, func, args, kwargs in self.steps:
+			if getattr(module, 'hxtool_task_module', lambda: False)():
+				return module.pool()
+		return TASK_POOL_SYSTEM
+	
 	def add_step(self, module, func = "run", args = (), kwargs = {}):
 		# This is an HXTool task module, we need to init it.
 		if hasattr(module, 'hxtool_task_module'):
 			module = module(self)
 		with self._lock:
 			self.steps.append((module, func, args, kwargs))
+			self._steps_dirty = True
+	
+	# Keep only the results that the steps of this task take as input, rather than a copy of everything
+	# the parent task produced
+	def inherit_stored_result(self, stored_result):
+		input_names = set()
+		for module, func, args, kwargs in self.steps:
+			if getattr(module, 'hxtool_task_module', lambda: False)():
+				input_names.update([_['name'] for _ in module.input_args()])
+		self.stored_result = {k : v for k, v in stored_result.items() if k in input_names}
+		self._stored_result_dirty = True
 		
 	# Use this to set state, its thread-safe
 	def set_state(self, state):
@@ -336,6 +751,7 @@ class hxtool_scheduler_task:
 	def run(self, scheduler):
 		self._stop_signal = False
 		self._defer_signal = False
+		self._defer_backoff = True
 		self._pending_deletion_signal = False
 		ret = False
 		
@@ -343,6 +759,10 @@ class hxtool_scheduler_task:
 			
 			with self._lock:
 				
+				# Only tasks dispatched by the scheduler, not the ones that bulk_download_coordinator runs itself
+				if self.state == TASK_STATE_QUEUED and self.next_run:
+					scheduler.metrics_collector.observe_start_delay((datetime.datetime.utcnow() - self.next_run).total_seconds())
+				
 				self.state = TASK_STATE_RUNNING
 				
 				self.scheduler = scheduler
@@ -354,6 +774,8 @@ class hxtool_scheduler_task:
 				
 				for module, func, args, kwargs in self.steps:
 					logger.debug("Have module: {}, function: {}".format(module.__module__, func))
+					# Fill in arguments from the stored result on a copy, so the step as stored doesn't grow with every run
+					kwargs = dict(kwargs)
 					if getattr(module, 'hxtool_task_module', lambda: False)():
 						if module.enabled == False:
 							logger.error("Module {} is disabled!".format(module.__module__))
@@ -372,7 +794,16 @@ class hxtool_scheduler_task:
 									break
 					if self.state != TASK_STATE_FAILED:
 						logger.debug("Begin execute {}.{}".format(module.__module__, func))
-						result = getattr(module, func)(*args, **kwargs)
+						step_start = time.time()
+						try:
+							if getattr(module, 'hxtool_task_module', lambda: False)():
+								# Later steps may belong to a different pool than the one the task runs in, i.e. post-processing after a download
+								result = scheduler.run_in_pool(module.pool(), getattr(module, func), *args, **kwargs)
+							else:
+								result = getattr(module, func)(*args, **kwargs)
+						except:
+							scheduler.metrics_collector.observe_step("{}.{}".format(module.__module__, func), time.time() - step_start, False)
+							raise
 						logger.debug("End execute {}.{}".format(module.__module__, func))
 						if isinstance(result, tuple) and len(result) > 1:
 							ret = result[0]
@@ -380,10 +811,13 @@ class hxtool_scheduler_task:
 							if isinstance(result[1], dict):
 								# Use update so we don't clobber existing values
 								self.stored_result.update(result[1])
+								if result[1]:
+									self._stored_result_dirty = True
 							elif result[1] is not None:
 								logger.error("Task module {} returned a value that was not a dictionary or None. Discarding the result.".format(module.__module__))
 						else:
 							ret = result
+						scheduler.metrics_collector.observe_step("{}.{}".format(module.__module__, func), time.time() - step_start, ret)
 					
 					
 					if self._defer_signal:
@@ -404,6 +838,12 @@ class hxtool_scheduler_task:
 				if not self.parent_id:
 					hxtool_global.hxtool_scheduler.signal_child_tasks(self.task_id, self.state, self.stored_result)
 				
+				if self._defer_signal and self._defer_backoff:
+					self.defer_count += 1
+				else:
+					self.defer_count = 0
+				scheduler.metrics_collector.observe_task(self.state, self._defer_signal)
+				
 				self._calculate_next_run()
 				
 				if self.next_run:
@@ -422,6 +862,8 @@ class hxtool_scheduler_task:
 			self.unstore()
 			if self.state != TASK_STATE_PENDING_DELETION:
 				hxtool_global.hxtool_scheduler.move_to_history(self.task_id)
+			else:
+				self._notify_removed()
 		else:
 			self.store()
 				
@@ -433,7 +875,7 @@ class hxtool_scheduler_task:
 			if parent_state == TASK_STATE_COMPLETE:
 				logger.debug("Received signal that parent task is complete.")
 				with self._lock:
-					self.stored_result = parent_stored_result
+					self.inherit_stored_result(parent_stored_result)
 					self.parent_complete = True
 					# Now that the parent is complete set the next run
 					self._calculate_next_run()
@@ -453,25 +895,72 @@ class hxtool_scheduler_task:
 		if self.state != TASK_STATE_RUNNING:
 			self.set_state(TASK_STATE_STOPPED)
 			
-	def defer(self):
+	# Run the task again after a delay. Tasks polling for a single result back off, tasks that
+	# need to keep polling at the same pace, i.e. monitors, pass backoff = False.
+	def defer(self, backoff = True):
 		self._defer_signal = True
+		self._defer_backoff = backoff
 	
 	def remove(self):
 		self._pending_deletion_signal = True
 		if self.state != TASK_STATE_RUNNING:
 			self.set_state(TASK_STATE_PENDING_DELETION)
 			self.unstore()
+			self._notify_removed()
+	
+	# Let the task modules of the steps release anything they hold on behalf of this task, see task_module.on_remove()
+	def _notify_removed(self):
+		for module, func, args, kwargs in self.steps:
+			on_remove = getattr(module, 'on_remove', None)
+			if on_remove:
+				try:
+					on_remove(**kwargs)
+				except Exception as e:
+					logger.error(pretty_exceptions(e))
 			
+	# Child task states that the task modules of the steps report themselves, see task_module.child_states()
+	def child_states(self):
+		states = {}
+		for module, func, args, kwargs in self.steps:
+			child_states = getattr(module, 'child_states', None)
+			if child_states:
+				for state_name, count in child_states(**kwargs).items():
+					states[state_name] = states.get(state_name, 0) + count
+		return states
+	
 	def store(self):
 		if not (self.immutable or self._stored):
-			hxtool_global.hxtool_db.taskCreate(self.serialize())
+			metadata = self.metadata()
 			self.set_stored()
+			try:
+				hxtool_global.hxtool_db.taskCreate(self.serialize(), on_write = lambda doc_id: self._written(metadata, doc_id))
+			except:
+				self.set_stored(stored = False)
+				raise
 		elif self._stored:
-			hxtool_global.hxtool_db.taskUpdate(self.profile_id, self.task_id, self.serialize())
+			metadata = self.metadata()
+			changes = {k : v for k, v in metadata.items() if self._persisted.get(k, None) != v}
+			if self._stored_result_dirty:
+				changes['stored_result'] = self.stored_result
+			if self._steps_dirty:
+				changes['steps'] = self.serialize()['steps']
+			if changes:
+				hxtool_global.hxtool_db.taskUpdate(self.profile_id, self.task_id, changes, doc_id = self._doc_id, on_write = lambda r: self._written(metadata))
+	
+	# Called once a write of the task has been applied, which is later when store() is called inside hxtool_db.batch().
+	# Until then the next store() writes the same fields again.
+	def _written(self, metadata, doc_id = None):
+		self._persisted = metadata
+		if doc_id is not None:
+			self._doc_id = doc_id
+		self._stored_result_dirty = False
+		self._steps_dirty = False
 	
 	def unstore(self):
 		logger.debug("Deleting task_id = {} from DB".format(self.task_id))
 		hxtool_global.hxtool_db.taskDelete(self.profile_id, self.task_id)
+		self._persisted = {}
+		self._doc_id = None
 		self.set_stored(stored = False)
 	
 	def metadata(self):
@@ -495,6 +984,7 @@ class hxtool_scheduler_task:
 			'parent_complete' : self.parent_complete,
 			'wait_for_parent' : self.wait_for_parent,
 			'defer_interval' : self.defer_interval,
+			'defer_count' : self.defer_count,
 			'state' : self.state,
 			'last_run_state' : self.last_run_state,
 		}
@@ -527,6 +1017,7 @@ class hxtool_scheduler_task:
 		task.last_run = d.get('last_run', None)
 		task.parent_complete = d.get('parent_complete', False)
 		task.last_run_state = d.get('last_run_state', None)							
+		task.defer_count = d.get('defer_count', 0)
 		task.state = d.get('state')
 		schedule = d.get('schedule', None)
 		if schedule:
@@ -536,6 +1027,11 @@ class hxtool_scheduler_task:
 			# I hate this
 			step_module = eval(s['module'])
 			task.add_step(step_module, s['function'], s['args'], s['kwargs'])
+		task.stored_result = d.get('stored_result', {})
+		# This is what the database has, so far
+		task._persisted = {k : d.get(k, None) for k in task.metadata().keys()}
+		task._doc_id = getattr(d, 'doc_id', None)
+		task._steps_dirty = False
 		return task
 									
 									
@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import threading
+import datetime
+import heapq
+import itertools
+from collections import deque
+
 from .task_module import *
 import hxtool_global
 from hxtool_util import *
@@ -16,6 +22,181 @@ from .file_write_task_module import *
 from .helix_task_module import *
 from .x15_postgres_task_module import *
 
+# Downloads and post-processes the completed hosts of a bulk acquisition with bounded concurrency, instead of
+# creating a scheduler task for every host. There is one coordinator per bulk download entry, it only lives in memory,
+# the bulk download entry's hosts are what's persisted.
+class bulk_download_coordinator:
+	_coordinators = {}
+	_coordinators_lock = threading.Lock()
+	
+	@classmethod
+	def get(cls, bulk_download_eid, concurrency):
+		with cls._coordinators_lock:
+			coordinator = cls._coordinators.get(bulk_download_eid, None)
+			if coordinator is None:
+				coordinator = cls(bulk_download_eid, concurrency)
+				cls._coordinators[bulk_download_eid] = coordinator
+			return coordinator
+	
+	# The coordinator of a bulk download entry, or None if there isn't one, doesn't create it
+	@classmethod
+	def find(cls, bulk_download_eid):
+		with cls._coordinators_lock:
+			return cls._coordinators.get(bulk_download_eid, None)
+	
+	@classmethod
+	def remove(cls, bulk_download_eid):
+		with cls._coordinators_lock:
+			coordinator = cls._coordinators.pop(bulk_download_eid, None)
+		if coordinator:
+			coordinator.stop()
+	
+	def __init__(self, bulk_download_eid, concurrency):
+		self.logger = hxtool_logging.getLogger(__name__)
+		self.bulk_download_eid = bulk_download_eid
+		self.concurrency = max(1, int(concurrency))
+		self._lock = threading.Lock()
+		# (agent_id, host_name, task_factory, tasks), tasks is None until the host is first dispatched
+		self._queue = deque()
+		# Hosts whose task deferred, as a heap of (next_run, counter, queue entry) 
+		self._deferred = []
+		self._deferred_counter = itertools.count()
+		# Hosts that are queued, downloading or deferred
+		self._pending = set()
+		# Hosts that this coordinator downloaded, the monitor's copy of the bulk download entry may not show them yet
+		self._downloaded = set()
+		# Hosts that are downloading and hosts whose package is being post-processed, together they're bounded by concurrency
+		self._in_flight = 0
+		self._processing = 0
+		self._completed = 0
+		self._failed = 0
+		self._stopped = False
+		# Set once the controller job is no longer running, nothing new is submitted after that
+		self.draining = False
+	
+	# Queue (agent_id, host_name) pairs, task_factory(agent_id, host_name) builds the (download task, post-processing task)
+	# when the host is dispatched.
+	# Also dispatches the deferred hosts that are due, which relies on the monitor calling this on every run.
+	def submit(self, hosts, task_factory):
+		with self._lock:
+			for agent_id, host_name in hosts:
+				if agent_id not in self._pending and agent_id not in self._downloaded:
+					self._pending.add(agent_id)
+					self._queue.append((agent_id, host_name, task_factory, None))
+		self._dispatch()
+	
+	def _dispatch(self):
+		with self._lock:
+			now = datetime.datetime.utcnow()
+			while self._deferred and self._deferred[0][0] <= now:
+				self._queue.append(heapq.heappop(self._deferred)[2])
+			while not self._stopped and self._queue and self._in_flight + self._processing < self.concurrency:
+				(agent_id, host_name, task_factory, tasks) = self._queue.popleft()
+				self._in_flight += 1
+				hxtool_global.hxtool_scheduler.submit(TASK_POOL_DOWNLOAD, self._run_host, agent_id, host_name, task_factory, tasks)
+	
+	# Runs the download task in the download pool, then hands the post-processing task to the parse pool
+	# without waiting for it, so download threads only ever wait on the controller
+	def _run_host(self, agent_id, host_name, task_factory, tasks):
+		state = TASK_STATE_FAILED
+		process_task = None
+		try:
+			if tasks is None:
+				tasks = task_factory(agent_id, host_name)
+			(download_task, process_task) = tasks
+			download_task.run(hxtool_global.hxtool_scheduler)
+			state = download_task.state
+		except Exception as e:
+			self.logger.error(pretty_exceptions(e))
+		finally:
+			# Hosts that didn't download stay in the bulk download entry as not downloaded, the next monitor run queues them again
+			# if they have retries left
+			with self._lock:
+				self._in_flight -= 1
+				if state == TASK_STATE_SCHEDULED and download_task.next_run:
+					# The task deferred, i.e. the host's acquisition isn't ready. Keep the tasks, so the next delay
+					# backs off from this one, and run them again once next_run is due.
+					heapq.heappush(self._deferred, (download_task.next_run, next(self._deferred_counter), (agent_id, host_name, task_factory, tasks)))
+				elif state == TASK_STATE_COMPLETE:
+					self._downloaded.add(agent_id)
+					if process_task is not None and not self._stopped:
+						self._processing += 1
+					else:
+						process_task = None
+						self._pending.discard(agent_id)
+						self._completed += 1
+				else:
+					process_task = None
+					self._pending.discard(agent_id)
+					if state in (TASK_STATE_FAILED, TASK_STATE_STOPPED):
+						self._failed += 1
+			if process_task is not None:
+				hxtool_global.hxtool_scheduler.submit(TASK_POOL_PARSE, self._process_host, agent_id, download_task, process_task)
+			self._dispatch()
+	
+	def _process_host(self, agent_id, download_task, process_task):
+		state = TASK_STATE_FAILED
+		try:
+			# The post-processing steps take the package that the download task stored
+			process_task.inherit_stored_result(dict(process_task.stored_result, **download_task.stored_result))
+			process_task.run(hxtool_global.hxtool_scheduler)
+			state = process_task.state
+		except Exception as e:
+			self.logger.error(pretty_exceptions(e))
+		finally:
+			with self._lock:
+				self._processing -= 1
+				self._pending.discard(agent_id)
+				if state == TASK_STATE_COMPLETE:
+					self._completed += 1
+				else:
+					self._failed += 1
+			self._dispatch()
+	
+	# Whether the host is queued, downloading, deferred or was downloaded by this coordinator
+	def has_host(self, agent_id):
+		with self._lock:
+			return agent_id in self._pending or agent_id in self._downloaded
+	
+	# The controller job is done, hosts that are already queued or deferred still get downloaded
+	def drain(self):
+		with self._lock:
+			self.draining = True
+	
+	def idle(self):
+		with self._lock:
+			return len(self._queue) == 0 and len(self._deferred) == 0 and self._in_flight == 0 and self._processing == 0
+	
+	def stop(self):
+		with self._lock:
+			self._stopped = True
+			for agent_id, host_name, task_factory, tasks in self._queue:
+				self._pending.discard(agent_id)
+			self._queue.clear()
+			for next_run, counter, (agent_id, host_name, task_factory, tasks) in self._deferred:
+				self._pending.discard(agent_id)
+			self._deferred = []
+	
+	def status(self):
+		with self._lock:
+			return {
+				'queued' : len(self._queue),
+				'in_flight' : self._in_flight,
+				'processing' : self._processing,
+				'deferred' : len(self._deferred),
+				'completed' : self._completed,
+				'failed' : self._failed
+			}
+	
+	# The status as the number of host tasks in each state, the way the scheduler reports the states of child tasks
+	def child_states(self):
+		status = self.status()
+		states = {}
+		for k, state in [('queued', TASK_STATE_QUEUED), ('in_flight', TASK_STATE_RUNNING), ('processing', TASK_STATE_RUNNING), ('deferred', TASK_STATE_SCHEDULED), ('completed', TASK_STATE_COMPLETE), ('failed', TASK_STATE_FAILED)]:
+			if status[k]:
+				states[task_state_description[state]] = states.get(task_state_description[state], 0) + status[k]
+		return states
+
 class bulk_download_monitor_task_module(task_module):
 
 
@@ -55,118 +236,202 @@ class bulk_download_monitor_task_module(task_module):
 					hx_api_object = self.get_task_api_object()
 					if hx_api_object:
 						(ret, response_code, response_data) = hx_api_object.restGetBulkDetails(bulk_download_job['bulk_acquisition_id'])
-						if ret:
-							if response_data['data']['state'] != 'RUNNING':
+						if not ret:
+							self.logger.error("Failed to get bulk acquisition job status for ID {}".format(bulk_download_job['bulk_acquisition_id']))
+							self.parent_task.stop()
+							return(ret, result)
+						
+						coordinator = bulk_download_coordinator.get(bulk_download_eid, hxtool_global.hxtool_config.get_child_item('scheduler', 'bulk_download_concurrency', 8))
+						if response_data['data']['state'] != 'RUNNING':
+							if not coordinator.draining:
 								self.logger.warning("The bulk acquisition job {} is not in a running state. Controller state: {}".format(bulk_download_job['bulk_acquisition_id'], response_data['data']['state']))
+								# Record the hosts that completed since the last run, after that the controller isn't asked again
+								if self._record_completed_hosts(hx_api_object, bulk_download_job, bulk_download_eid, task_profile):
+									coordinator.drain()
+							
+							if coordinator.draining:
+								# Hosts that failed are queued again until they run out of retries
+								self._queue_hosts(bulk_download_job, bulk_download_eid, task_profile, coordinator)
+							
+							# The download tasks skip hosts once the bulk download entry is stopped, so only mark it when the coordinator is done
+							if coordinator.draining and coordinator.idle():
 								hxtool_global.hxtool_db.bulkDownloadUpdate(bulk_download_eid, stopped=True)
+								bulk_download_coordinator.remove(bulk_download_eid)
+								bulk_host_status_cache.remove(hx_api_object.hx_host, bulk_download_job['bulk_acquisition_id'])
 								self.parent_task.stop()
-								return(ret, result)
-						else:
-							self.logger.error("Failed to get bulk acquisition job status for ID {}".format(bulk_download_job['bulk_acquisition_id']))
-							self.parent_task.stop()
+							else:
+								self.logger.debug("Bulk download {}: {}".format(bulk_download_eid, coordinator.status()))
+								self.parent_task.defer(backoff = False)
 							return(ret, result)
 						
-						(ret, response_code, response_data) = hx_api_object.restListBulkHosts(bulk_download_job['bulk_acquisition_id'], filter_term = {'state' : 'COMPLETE'})
+						ret = self._record_completed_hosts(hx_api_object, bulk_download_job, bulk_download_eid, task_profile)
 						if ret:
-							for bulk_host in response_data['data']['entries']:
-								# Don't create duplicate jobs for the same hosts
-								if not bulk_download_job['hosts'].get(bulk_host['host']['_id'], None):
-									# Set wait_for_parent to False, as the parent is already complete
-									# if we've gotten to this point - and the task won't get a callback.
-									hxtool_global.hxtool_db.bulkDownloadUpdateHost(bulk_download_eid, bulk_host['host']['_id'], hostname = bulk_host['host']['hostname'], downloaded = False)
-									
-									download_and_process_task = hxtool_scheduler_task(
-																	self.parent_task.profile_id, 
-																	'Bulk Acquisition Download: {}'.format(bulk_host['host']['_id']), 
-																	parent_id = self.parent_task.parent_id,
-																	wait_for_parent = False,
-																	start_time = self.parent_task.start_time,
-																	defer_interval = hxtool_global.hxtool_config['scheduler']['defer_interval']
-																)
-																
-									download_and_process_task.add_step(
-										bulk_download_task_module,
-										kwargs = {
-											'bulk_download_eid' : bulk_download_eid,
-											'agent_id' : bulk_host['host']['_id'],
-											'host_name' : bulk_host['host']['hostname']
-										}
-									)
-									
-									if task_profile == 'stacking':
-										self.logger.debug("Using stacking task module.")
-										# TODO: Maybe move this to the stacking module instead
-										hxtool_global.hxtool_db.stackJobAddHost(self.parent_task.profile_id, bulk_download_eid, bulk_host['host']['hostname'])
-										download_and_process_task.add_step(
-											stacking_task_module, 
-											kwargs = {
-														'delete_bulk_download' : True
-											}
-										)
-									elif task_profile == 'file_listing':
-										self.logger.debug("Using file listing task module.")
-										download_and_process_task.add_step(
-											file_listing_task_module, 
-											kwargs = {
-														'delete_bulk_download' : False
-											}
-										)
-									elif task_profile:
-										_task_profile = hxtool_global.hxtool_db.taskProfileGet(task_profile)
-
-										if _task_profile and 'params' in _task_profile:
-											#TODO: once task profile page params are dynamic, remove static mappings
-											for task_module_params in _task_profile['params']:						
-												if task_module_params['module'] == 'ip':
-													self.logger.debug("Using taskmodule 'ip' with parameters: protocol {}, ip {}, port {}".format(task_module_params['protocol'], task_module_params['targetip'], task_module_params['targetport']))
-													download_and_process_task.add_step(streaming_task_module, kwargs = {
-																						'stream_host' : task_module_params['targetip'],
-																						'stream_port' : task_module_params['targetport'],
-																						'stream_protocol' : task_module_params['protocol'],
-																						'batch_mode' : (task_module_params['eventmode'] != 'per-event'),
-																						'delete_bulk_download' : False
-																					})
-												elif task_module_params['module'] == 'file':
-													self.logger.debug("Using taskmodule 'file' with parameters: filepath {}".format(task_module_params['filepath']))
-													download_and_process_task.add_step(file_write_task_module, kwargs = {
-																						'file_name' : task_module_params['filepath'],
-																						'batch_mode' : (task_module_params['eventmode'] != 'per-event'),
-																						'delete_bulk_download' : False
-																					})
-												elif task_module_params['module'] == 'helix':
-													self.logger.debug("Using taskmodule 'helix' with parameters: helix_url {}, helix_apikey: {}".format(task_module_params['helix_url'], task_module_params['helix_apikey']))
-													download_and_process_task.add_step(helix_task_module, kwargs = {
-																						'url' : task_module_params['helix_url'],
-																						'apikey' : task_module_params['helix_apikey'],
-																						'batch_mode' : (task_module_params['eventmode'] != 'per-event'),
-																						'delete_bulk_download' : False
-																					})
-												elif task_module_params['module'] == 'x15':
-													self.logger.debug("Using taskmodule 'x15' with parameters: x15_host: {}, x15_port: {}, x15_database: {}, x15_table: {}, x15_user: {}, x15_password: {}".format(task_module_params['x15_host'], task_module_params['x15_port'], task_module_params['x15_database'], task_module_params['x15_table'], task_module_params['x15_user'], "********"))
-													task_module_args = {
-														'batch_mode' : False, # Hardcode per-event as X15 might not handle large lists well
-														'delete_bulk_download' : False
-													}
-													task_module_args.update(task_module_params)
-													del task_module_args['module']
-													download_and_process_task.add_step(x15_postgres_task_module, kwargs = task_module_args)
-									
-									download_and_process_task.stored_result = self.parent_task.stored_result
-									self.parent_task.scheduler.add(download_and_process_task)
-									
-							
-							self.parent_task.defer()
-							ret = True
+							self._queue_hosts(bulk_download_job, bulk_download_eid, task_profile, coordinator)
+							self.logger.debug("Bulk download {}: {}".format(bulk_download_eid, coordinator.status()))
+							# The monitor queues newly completed hosts, so keep polling at defer_interval
+							self.parent_task.defer(backoff = False)
 						else:
-							self.logger.error("No task API session for profile: {}".format(self.parent_task.profile_id))
+							self.logger.error("Failed to list the completed hosts of bulk acquisition job {}".format(bulk_download_job['bulk_acquisition_id']))
+					else:
+						self.logger.error("No task API session for profile: {}".format(self.parent_task.profile_id))
 				else:
 					self.logger.warning("Bulk download database entry {} is marked as stopped.".format(bulk_download_eid))
+					bulk_download_coordinator.remove(bulk_download_eid)
 					self.parent_task.stop()
 			else:
 				self.logger.error("Bulk download database entry {} doesn't exist.".format(bulk_download_eid))
+				bulk_download_coordinator.remove(bulk_download_eid)
 				self.parent_task.stop()
 		except Exception as e:
 			self.logger.error(pretty_exceptions(e))
 			ret = False
 		finally:
 			return(ret, result)
+	
+	# Record the hosts that are complete on the controller in the bulk download entry, which is the persisted progress.
+	# bulk_download_job['hosts'] is updated to match.
+	def _record_completed_hosts(self, hx_api_object, bulk_download_job, bulk_download_eid, task_profile):
+		(ret, response_code, response_data) = hx_api_object.restListBulkHosts(bulk_download_job['bulk_acquisition_id'], filter_term = {'state' : 'COMPLETE'})
+		if ret:
+			# The download tasks use these instead of asking the controller about each host again
+			bulk_host_status_cache.update(hx_api_object.hx_host, bulk_download_job['bulk_acquisition_id'], response_data['data']['entries'])
+			hosts = bulk_download_job['hosts']
+			# Coalesce the per-host database updates into a single write
+			with hxtool_global.hxtool_db.batch():
+				for bulk_host in response_data['data']['entries']:
+					if not hosts.get(bulk_host['host']['_id'], None):
+						hxtool_global.hxtool_db.bulkDownloadUpdateHost(bulk_download_eid, bulk_host['host']['_id'], hostname = bulk_host['host']['hostname'], downloaded = False)
+						hosts[bulk_host['host']['_id']] = {'hostname' : bulk_host['host']['hostname'], 'downloaded' : False}
+						if task_profile == 'stacking':
+							# TODO: Maybe move this to the stacking module instead
+							hxtool_global.hxtool_db.stackJobAddHost(self.parent_task.profile_id, bulk_download_eid, bulk_host['host']['hostname'])
+		return ret
+	
+	# Queue the hosts that aren't downloaded yet with the coordinator, skipping the ones it already has. Each time a host
+	# is queued counts as an attempt, once a host has used up bulk_download_retries it's marked as failed and left alone.
+	def _queue_hosts(self, bulk_download_job, bulk_download_eid, task_profile, coordinator):
+		retries = hxtool_global.hxtool_config.get_child_item('scheduler', 'bulk_download_retries', 3)
+		queue = []
+		# The attempts are written before the hosts are queued, so a download can't race the update of its host
+		with hxtool_global.hxtool_db.batch():
+			for agent_id, host in bulk_download_job['hosts'].items():
+				if host.get('downloaded', False) or host.get('failed', False) or coordinator.has_host(agent_id):
+					continue
+				attempts = host.get('attempts', 0)
+				if attempts > retries:
+					self.logger.warning("Giving up on downloading host {} of bulk download {} after {} attempts.".format(host['hostname'], bulk_download_eid, attempts))
+					hxtool_global.hxtool_db.bulkDownloadUpdateHost(bulk_download_eid, agent_id, failed = True)
+					host['failed'] = True
+				else:
+					hxtool_global.hxtool_db.bulkDownloadUpdateHost(bulk_download_eid, agent_id, attempts = attempts + 1)
+					host['attempts'] = attempts + 1
+					queue.append((agent_id, host['hostname']))
+		
+		coordinator.submit(queue, lambda agent_id, host_name: self._host_task(bulk_download_eid, agent_id, host_name, task_profile))
+	
+	# The monitor task is removed, so nothing will finish the coordinator's queue
+	def on_remove(self, bulk_download_eid = None, **kwargs):
+		bulk_download_coordinator.remove(bulk_download_eid)
+	
+	# The host tasks aren't scheduler tasks, so report their states from the coordinator
+	def child_states(self, bulk_download_eid = None, **kwargs):
+		coordinator = bulk_download_coordinator.find(bulk_download_eid)
+		if coordinator:
+			return coordinator.child_states()
+		return {}
+	
+	# The download task and the post-processing task for a single host, the latter is None without post-processing steps.
+	# The tasks are run by the coordinator rather than the scheduler and are immutable, so they never get written to the database.
+	def _host_task(self, bulk_download_eid, agent_id, host_name, task_profile):
+		# Set wait_for_parent to False, as the parent is already complete
+		# if we've gotten to this point - and the task won't get a callback.
+		download_task = hxtool_scheduler_task(
+							self.parent_task.profile_id, 
+							'Bulk Acquisition Download: {}'.format(agent_id), 
+							parent_id = self.parent_task.parent_id or self.parent_task.task_id,
+							immutable = True,
+							wait_for_parent = False,
+							start_time = self.parent_task.start_time,
+							defer_interval = hxtool_global.hxtool_config['scheduler']['defer_interval']
+						)
+								
+		download_task.add_step(
+			bulk_download_task_module,
+			kwargs = {
+				'bulk_download_eid' : bulk_download_eid,
+				'agent_id' : agent_id,
+				'host_name' : host_name
+			}
+		)
+		
+		process_task = hxtool_scheduler_task(
+							self.parent_task.profile_id, 
+							'Bulk Acquisition Processing: {}'.format(agent_id), 
+							parent_id = self.parent_task.parent_id or self.parent_task.task_id,
+							immutable = True,
+							wait_for_parent = False,
+							start_time = self.parent_task.start_time
+						)
+	
+		if task_profile == 'stacking':
+			self.logger.debug("Using stacking task module.")
+			process_task.add_step(
+				stacking_task_module, 
+				kwargs = {
+							'delete_bulk_download' : True
+				}
+			)
+		elif task_profile == 'file_listing':
+			self.logger.debug("Using file listing task module.")
+			process_task.add_step(
+				file_listing_task_module, 
+				kwargs = {
+							'delete_bulk_download' : False
+				}
+			)
+		elif task_profile:
+			_task_profile = hxtool_global.hxtool_db.taskProfileGet(task_profile)
+
+			if _task_profile and 'params' in _task_profile:
+				#TODO: once task profile page params are dynamic, remove static mappings
+				for task_module_params in _task_profile['params']:						
+					if task_module_params['module'] == 'ip':
+						self.logger.debug("Using taskmodule 'ip' with parameters: protocol {}, ip {}, port {}".format(task_module_params['protocol'], task_module_params['targetip'], task_module_params['targetport']))
+						process_task.add_step(streaming_task_module, kwargs = {
+															'stream_host' : task_module_params['targetip'],
+															'stream_port' : task_module_params['targetport'],
+															'stream_protocol' : task_module_params['protocol'],
+															'batch_mode' : (task_module_params['eventmode'] != 'per-event'),
+															'delete_bulk_download' : False
+														})
+					elif task_module_params['module'] == 'file':
+						self.logger.debug("Using taskmodule 'file' with parameters: filepath {}".format(task_module_params['filepath']))
+						process_task.add_step(file_write_task_module, kwargs = {
+															'file_name' : task_module_params['filepath'],
+															'batch_mode' : (task_module_params['eventmode'] != 'per-event'),
+															'delete_bulk_download' : False
+														})
+					elif task_module_params['module'] == 'helix':
+						self.logger.debug("Using taskmodule 'helix' with parameters: helix_url {}, helix_apikey: {}".format(task_module_params['helix_url'], task_module_params['helix_apikey']))
+						process_task.add_step(helix_task_module, kwargs = {
+															'url' : task_module_params['helix_url'],
+															'apikey' : task_module_params['helix_apikey'],
+															'batch_mode' : (task_module_params['eventmode'] != 'per-event'),
+															'delete_bulk_download' : False
+														})
+					elif task_module_params['module'] == 'x15':
+						self.logger.debug("Using taskmodule 'x15' with parameters: x15_host: {}, x15_port: {}, x15_database: {}, x15_table: {}, x15_user: {}, x15_password: {}".format(task_module_params['x15_host'], task_module_params['x15_port'], task_module_params['x15_database'], task_module_params['x15_table'], task_module_params['x15_user'], "********"))
+						task_module_args = {
+							'batch_mode' : False, # Hardcode per-event as X15 might not handle large lists well
+							'delete_bulk_download' : False
+						}
+						task_module_args.update(task_module_params)
+						del task_module_args['module']
+						process_task.add_step(x15_postgres_task_module, kwargs = task_module_args)
+	
+		download_task.inherit_stored_result(self.parent_task.stored_result)
+		if not process_task.steps:
+			return (download_task, None)
+		process_task.inherit_stored_result(self.parent_task.stored_result)
+		return (download_task, process_task)
+
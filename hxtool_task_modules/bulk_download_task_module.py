@@ -1,10 +1,67 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import threading
+import time
+
 import hxtool_global
 from .task_module import *
 from hxtool_util import *
 
+# Host states of bulk acquisitions, from one restListBulkHosts call per job rather than a restGetBulkHost call
+# per pending host. Entries are shared by all of a job's download tasks until they are ttl seconds old.
+class bulk_host_status_cache:
+	_entries = {}
+	_lock = threading.Lock()
+	_fetch_locks = {}
+	_fetch_times = {}
+	
+	@classmethod
+	def update(cls, hx_host, bulk_acquisition_id, entries):
+		now = time.time()
+		with cls._lock:
+			job_entries = cls._entries.setdefault((hx_host, bulk_acquisition_id), {})
+			for entry in entries:
+				job_entries[entry['host']['_id']] = (now, entry)
+	
+	@classmethod
+	def remove(cls, hx_host, bulk_acquisition_id):
+		with cls._lock:
+			cls._entries.pop((hx_host, bulk_acquisition_id), None)
+			cls._fetch_locks.pop((hx_host, bulk_acquisition_id), None)
+			cls._fetch_times.pop((hx_host, bulk_acquisition_id), None)
+	
+	@classmethod
+	def _get_entry(cls, key, agent_id, ttl):
+		with cls._lock:
+			entry = cls._entries.get(key, {}).get(agent_id, None)
+		if entry and time.time() - entry[0] < ttl:
+			return entry[1]
+		return None
+	
+	# The controller's bulk host entry for agent_id, or None if the job's host list couldn't be fetched
+	# or doesn't include the host
+	@classmethod
+	def get(cls, hx_api_object, bulk_acquisition_id, agent_id, ttl):
+		key = (hx_api_object.hx_host, bulk_acquisition_id)
+		entry = cls._get_entry(key, agent_id, ttl)
+		if entry is not None:
+			return entry
+		
+		with cls._lock:
+			fetch_lock = cls._fetch_locks.setdefault(key, threading.Lock())
+		# Only one task fetches the host list for a job, the others wait and use its result
+		with fetch_lock:
+			entry = cls._get_entry(key, agent_id, ttl)
+			# Don't fetch the list again for hosts that weren't in a recent one
+			if entry is None and time.time() - cls._fetch_times.get(key, 0) >= ttl:
+				(ret, response_code, response_data) = hx_api_object.restListBulkHosts(bulk_acquisition_id)
+				if ret and isinstance(response_data, dict):
+					cls._fetch_times[key] = time.time()
+					cls.update(hx_api_object.hx_host, bulk_acquisition_id, response_data['data']['entries'])
+					entry = cls._get_entry(key, agent_id, ttl)
+		return entry
+
 class bulk_download_task_module(task_module):
 	def __init__(self, parent_task):
 		super(type(self), self).__init__(parent_task)
@@ -64,6 +121,11 @@ class bulk_download_task_module(task_module):
 			}
 		]	
 		
+	# Bulk acquisition downloads have their own pool, so they can't take all of the io threads
+	@staticmethod
+	def pool():
+		return 'download'
+	
 	def run(self, bulk_download_eid = None, agent_id = None, host_name = None):
 		ret = False
 		result = {}
@@ -72,12 +134,16 @@ class bulk_download_task_module(task_module):
 			if bulk_download_job and bulk_download_job['stopped'] == False:
 				hx_api_object = self.get_task_api_object()
 				if hx_api_object:
-					(ret, response_code, response_data) = hx_api_object.restGetBulkHost(bulk_download_job['bulk_acquisition_id'], agent_id)
+					bulk_host = bulk_host_status_cache.get(hx_api_object, bulk_download_job['bulk_acquisition_id'], agent_id, hxtool_global.hxtool_config.get_child_item('scheduler', 'bulk_status_ttl', 30))
+					if bulk_host is not None and (bulk_host['state'] != 'COMPLETE' or bulk_host.get('result', None)):
+						(ret, response_code, response_data) = (True, 200, {'data' : bulk_host})
+					else:
+						(ret, response_code, response_data) = hx_api_object.restGetBulkHost(bulk_download_job['bulk_acquisition_id'], agent_id)
 					if ret and isinstance(response_data, dict) and (response_data['data']['state'] == "COMPLETE" and response_data['data']['result']):
 						self.logger.debug("Processing bulk download for host: {0}".format(host_name))
 						download_directory = make_download_directory(hx_api_object.hx_host, bulk_download_job['bulk_acquisition_id'])
 						full_path = os.path.join(download_directory, get_download_filename(host_name, agent_id))
-						(ret, response_code, response_data) = hx_api_object.restDownloadFile(response_data['data']['result']['url'], full_path)
+						(ret, response_code, response_data) = hx_api_object.restDownloadFile(response_data['data']['result']['url'], full_path, **download_options())
 						if ret:
 							hxtool_global.hxtool_db.bulkDownloadUpdateHost(bulk_download_eid, agent_id, downloaded = True)
 							self.logger.debug("Bulk download for host {} successfully downloaded to {}".format(host_name, full_path))
@@ -85,12 +151,16 @@ class bulk_download_task_module(task_module):
 							result['bulk_download_path'] = full_path
 							result['agent_id'] = agent_id
 							result['host_name'] = host_name
-					elif (ret and isinstance(response_data, dict) and (response_data['data']['state'] in {'FAILED', 'CANCELLED', 'ABORTED'} or 
-													(response_code == 404 and response_data['details'][0]['code'] == 1005))) or not ret:
+					elif isinstance(response_data, dict) and ((ret and response_data['data']['state'] in {'FAILED', 'CANCELLED', 'ABORTED'}) or 
+													(response_code == 404 and response_data['details'][0]['code'] == 1005)):
 						self.logger.debug("Error! Controller returned code: {}, data: {}".format(response_code, response_data))
 						self.parent_task.stop()
 						hxtool_global.hxtool_db.bulkDownloadDeleteHost(bulk_download_eid, agent_id)
 						ret = False
+					elif not ret:
+						# Keep the host, the bulk download monitor retries it until it runs out of retries
+						self.logger.debug("Error! Controller returned code: {}, data: {}".format(response_code, response_data))
+						self.parent_task.stop()
 					elif ret:
 						self.logger.debug("Deferring bulk download task for: {}".format(host_name))
 						self.parent_task.defer()
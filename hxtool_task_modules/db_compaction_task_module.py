@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This is a system task module that applies the database retention settings and compacts the database file.
+
+import datetime
+
+import hxtool_global
+from .task_module import *
+
+class db_compaction_task_module(task_module):
+	def __init__(self, parent_task):
+		super(type(self), self).__init__(parent_task)
+
+	@staticmethod
+	def input_args():
+		return []
+
+	@staticmethod
+	def pool():
+		return 'system'
+
+	@staticmethod
+	def output_args():
+		return []
+
+	def run(self):
+		ret = False
+		result = {}
+		try:
+			retention = hxtool_global.hxtool_config.get_child_item('database', 'retention', {}) or {}
+			purge_methods = {
+				'ObjectCache' : hxtool_global.hxtool_db.cachePurge,
+				'session' : hxtool_global.hxtool_db.sessionPurge,
+				'audits' : hxtool_global.hxtool_db.auditPurge,
+				'history' : self.parent_task.scheduler.prune_history
+			}
+			for k, purge in purge_methods.items():
+				days = retention.get(k, 0)
+				if days:
+					purged = len(purge(datetime.timedelta(days = days)))
+					if purged > 0:
+						self.logger.info("Removed {} {} records older than {} days.".format(purged, k, days))
+
+			sizes = hxtool_global.hxtool_db.compact()
+			for table_name, table_size in sorted(sizes['tables'].items(), key = lambda _: _[1]['bytes'], reverse = True):
+				self.logger.debug("Table {}: {} documents, {} bytes.".format(table_name, table_size['documents'], table_size['bytes']))
+			self.logger.info("Database compacted, file size: {} bytes.".format(sum(sizes['files'].values())))
+			result['sizes'] = sizes
+			ret = True
+		except Exception as e:
+			self.logger.error(pretty_exceptions(e))
+
+		return(ret, result)
@@ -54,7 +54,7 @@ class file_acquisition_task_module(task_module):
 				if ret and response_data and response_data['data']['state'] == "COMPLETE" and response_data['data']['url']:
 					self.logger.debug("Processing multi file acquisition host: {0}".format(host_name))
 					full_path = os.path.join(download_directory, get_download_filename(host_name, file_acquisition_id))				
-					(ret, response_code, response_data) = hx_api_object.restDownloadFile('{}.zip'.format(response_data['data']['url']), full_path)
+					(ret, response_code, response_data) = hx_api_object.restDownloadFile('{}.zip'.format(response_data['data']['url']), full_path, **download_options())
 					if ret:
 						hxtool_global.hxtool_db.multiFileUpdateFile(self.parent_task.profile_id, multi_file_eid, file_acquisition_id)
 						self.logger.info("File Acquisition download complete. Acquisition ID: {0}, Batch: {1}".format(file_acquisition_id, multi_file_eid))
@@ -45,6 +45,10 @@ class file_listing_task_module(task_module):
 			}
 		]
 	
+	@staticmethod
+	def pool():
+		return 'parse'
+	
 	@staticmethod
 	def output_args():
 		return []
@@ -58,17 +62,15 @@ class file_listing_task_module(task_module):
 			generator = 'w32rawfiles'
 			if file_listing and 'api_mode' in file_listing['cfg'] and file_listing['cfg']['api_mode']:
 				generator = 'w32apifiles'
-			with AuditPackage(bulk_download_path) as audit_pkg:
-				audit_data = audit_pkg.get_audit(generator = generator, open_only=True)
-				if audit_data:
-					files = get_audit_records(audit_data, generator, 'FileItem', hostname=host_name)
-					if files:
-						hxtool_global.hxtool_db.fileListingAddResult(self.parent_task.profile_id, bulk_download_eid, files)
-						self.logger.debug("File Listing added to the database. bulk job: {0} host: {1}".format(bulk_download_eid, host_name))
-						ret = True
-					else:
-						self.logger.warn("File Listing: No audit data for {} from bulk download job {}".format(host_name, bulk_download_eid))
-					audit_data.close()
+			file_count = 0
+			for files in self.yield_audit_record_batches(bulk_download_path, generator, 'FileItem', hostname=host_name):
+				hxtool_global.hxtool_db.fileListingAddResult(self.parent_task.profile_id, bulk_download_eid, files)
+				file_count += len(files)
+			if file_count > 0:
+				self.logger.debug("File Listing added to the database. bulk job: {0} host: {1} files: {2}".format(bulk_download_eid, host_name, file_count))
+				ret = True
+			else:
+				self.logger.warn("File Listing: No audit data for {} from bulk download job {}".format(host_name, bulk_download_eid))
 					
 		except Exception as e:
 			self.logger.error(pretty_exceptions(e))
@@ -66,6 +66,10 @@ class file_write_task_module(task_module):
 			}
 		]
 	
+	@staticmethod
+	def pool():
+		return 'parse'
+	
 	@staticmethod
 	def output_args():
 		return []
@@ -72,6 +72,10 @@ class helix_task_module(task_module):
 				
 		]
 	
+	@staticmethod
+	def pool():
+		return 'parse'
+	
 	@staticmethod
 	def output_args():
 		return []
@@ -45,6 +45,10 @@ class stacking_task_module(task_module):
 			}
 		]
 	
+	@staticmethod
+	def pool():
+		return 'parse'
+	
 	@staticmethod
 	def output_args():
 		return []
@@ -55,19 +59,15 @@ class stacking_task_module(task_module):
 			if bulk_download_path:
 				stack_job = hxtool_global.hxtool_db.stackJobGet(profile_id = self.parent_task.profile_id, bulk_download_eid = bulk_download_eid)
 				stack_model = hxtool_data_models(stack_job['stack_type']).stack_type
-				with AuditPackage(bulk_download_path) as audit_pkg:
-					audit_data = audit_pkg.get_audit(generator=stack_model['audit_module'], open_only=True)
-					if audit_data:
-						records = get_audit_records(audit_data, stack_model['audit_module'], stack_model['item_name'], fields=stack_model['fields'], post_process=stack_model['post_process'], hostname=host_name)
-						if records:
-							hxtool_global.hxtool_db.stackJobAddResult(self.parent_task.profile_id, bulk_download_eid, host_name, records)
-							self.logger.debug("Stacking records added to the database for host {}".format(host_name))
-							ret = True
-						else:
-							self.logger.warn("Stacking: No audit data for {}".format(host_name))
-						
-						# Explicitly close
-						audit_data.close()
+				record_count = 0
+				for records in self.yield_audit_record_batches(bulk_download_path, stack_model['audit_module'], stack_model['item_name'], fields=stack_model['fields'], post_process=stack_model['post_process'], hostname=host_name):
+					hxtool_global.hxtool_db.stackJobAddResult(self.parent_task.profile_id, bulk_download_eid, host_name, records)
+					record_count += len(records)
+				if record_count > 0:
+					self.logger.debug("{} stacking records added to the database for host {}".format(record_count, host_name))
+					ret = True
+				else:
+					self.logger.warn("Stacking: No audit data for {}".format(host_name))
 					
 				if ret and delete_bulk_download:
 					try:
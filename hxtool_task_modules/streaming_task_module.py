@@ -81,6 +81,10 @@ class streaming_task_module(task_module):
 				
 		]
 	
+	@staticmethod
+	def pool():
+		return 'parse'
+	
 	@staticmethod
 	def output_args():
 		return []
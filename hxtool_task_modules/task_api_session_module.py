@@ -37,6 +37,10 @@ class task_api_session_module(task_module):
 			}
 		]
 		
+	@staticmethod
+	def pool():
+		return 'system'
+	
 	@staticmethod
 	def output_args():
 		return []
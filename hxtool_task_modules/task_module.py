@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import tempfile
+
+import hxtool_global
 import hxtool_logging
 from hx_lib import *
 from hx_audit import *
@@ -21,17 +25,33 @@ class task_module(object):
 			return None
 		
 		
-	def yield_audit_results(self, bulk_download_path, batch_mode, host_name, agent_id, bulk_acquisition_id = None):
+	def yield_audit_results(self, bulk_download_path, batch_mode, host_name, agent_id, bulk_acquisition_id = None, flatten = False):
 		hx_host = None
 		api_object = self.get_task_api_object()
 		if api_object:
 			hx_host = api_object.hx_host
 		api_object = None
 		
+		if self.parent_task.scheduler and self.parent_task.scheduler.process_pool is not None:
+			results_path = self._results_path(bulk_download_path)
+			try:
+				warnings = self.run_in_process(write_audit_package_dicts, bulk_download_path, results_path, host_name, agent_id = agent_id, batch_mode = batch_mode, flatten = flatten)
+				for warning in warnings:
+					self.logger.warning(warning)
+				for audit_object in iter_json_lines(results_path):
+					audit_object.update({
+						'hx_host' : hx_host,
+						'bulk_acquisition_id' : bulk_acquisition_id
+					})
+					yield audit_object
+			finally:
+				os.remove(results_path)
+			return
+		
 		with AuditPackage(bulk_download_path) as audit_package:
 			for audit in audit_package.audits:
 				try:
-					for audit_object in audit_package.audit_to_dict(audit, host_name, agent_id = agent_id, batch_mode = batch_mode):
+					for audit_object in audit_package.audit_to_dict(audit, host_name, agent_id = agent_id, batch_mode = batch_mode, flatten = flatten):
 						audit_object.update({
 							'hx_host' : hx_host,
 							'bulk_acquisition_id' : bulk_acquisition_id
@@ -39,6 +59,35 @@ class task_module(object):
 						yield audit_object
 				except EmptyAuditException as e:
 					self.logger.warning(e)
+	
+	# Yield the records of an audit in an acquisition package in lists of up to audit_batch_size records.
+	# With the process pool the records are parsed in a worker process, which writes them to a file that is read back in batches.
+	def yield_audit_record_batches(self, bulk_download_path, generator, item_name, fields = None, post_process = None, **static_values):
+		batch_size = hxtool_global.hxtool_config.get_child_item('scheduler', 'audit_batch_size', 1000) or 1000
+		if self.parent_task.scheduler and self.parent_task.scheduler.process_pool is not None:
+			results_path = self._results_path(bulk_download_path)
+			try:
+				if self.run_in_process(write_audit_package_records, bulk_download_path, results_path, generator, item_name, fields = fields, post_process = post_process, **static_values):
+					for records in iter_batches(iter_json_lines(results_path), batch_size):
+						yield records
+			finally:
+				os.remove(results_path)
+			return
+		
+		for records in iter_batches(iter_audit_package_records(bulk_download_path, generator, item_name, fields = fields, post_process = post_process, **static_values), batch_size):
+			yield records
+	
+	# An empty file next to the acquisition package for a worker process to write its results to
+	def _results_path(self, bulk_download_path):
+		(fd, results_path) = tempfile.mkstemp(suffix = '.jsonl', dir = os.path.dirname(os.path.realpath(bulk_download_path)))
+		os.close(fd)
+		return results_path
+	
+	# Run a module level function in the scheduler's process pool, see hxtool_scheduler.run_in_process()
+	def run_in_process(self, f, *args, **kwargs):
+		if self.parent_task.scheduler:
+			return self.parent_task.scheduler.run_in_process(f, *args, **kwargs)
+		return f(*args, **kwargs)
 			
 	# Input and output args are a list of dictionary objects containing the following five keys: name, type, required user_supplied, and description 
 	# these define the modules inputs and outputs, for example:
@@ -57,7 +106,22 @@ class task_module(object):
 	# Note: function return must be a tuple of (boolean, result)
 	def run(self, **kwargs):
 		raise NotImplementedError("You must override run() in your task module.")
+	
+	# Called with the step's kwargs when the task is removed, override it to release state the module keeps outside of the task
+	def on_remove(self, **kwargs):
+		pass
+	
+	# Called with the step's kwargs, override it to report work the module runs outside of the scheduler as the
+	# number of child tasks in each state, keyed on the state description
+	def child_states(self, **kwargs):
+		return {}
 		
+	# The scheduler thread pool that run() executes in: 'io' for API calls and downloads, 'parse' for
+	# CPU heavy processing of audit data, 'system' for housekeeping tasks and 'download' for bulk acquisition downloads
+	@staticmethod
+	def pool():
+		return 'io'
+	
 	# Used by the task scheduler to signal that we are an HXTool Task Module
 	@staticmethod
 	def hxtool_task_module():
@@ -104,6 +104,10 @@ class x15_postgres_task_module(task_module):
 			}
 		]
 	
+	@staticmethod
+	def pool():
+		return 'parse'
+	
 	@staticmethod
 	def output_args():
 		return []
@@ -140,6 +140,17 @@ def make_download_directory(hx_host, download_id, job_type=None):
 			
 	return download_directory
 
+"""
+Keyword arguments for HXAPI.restDownloadFile() from the download section of the config
+"""
+def download_options():
+	options = {}
+	for k in ['chunk_size', 'segments', 'segment_size', 'retries']:
+		v = hxtool_global.hxtool_config.get_child_item('download', k)
+		if v is not None:
+			options[k] = v
+	return options
+
 def secure_uuid4():
 	return uuid.UUID(bytes=crypt_generate_random(16), version=4)
 
@@ -200,8 +211,65 @@ class TemporaryFileLock(object):
 		return self
 		
 	def __exit__(self, exc_type, exc_value, traceback):
-		self.release()	
-	
+		self.release()
+
+"""
+Readers-writer lock, writers are preferred so that a steady stream of readers can't starve them.
+Write locks are reentrant for the owning thread, which can also take read locks while holding the write lock.
+With shared_reads = False, readers exclude each other as well (but still not more than one writer).
+acquire_read() and acquire_write() return True if the caller had to wait for the lock.
+"""
+class ReadWriteLock(object):
+	def __init__(self, shared_reads = True):
+		self.shared_reads = shared_reads
+		self._condition = threading.Condition(threading.Lock())
+		self._readers = 0
+		self._writer = None
+		self._writer_depth = 0
+		self._waiting_writers = 0
+
+	def acquire_read(self):
+		me = threading.current_thread().ident
+		waited = False
+		with self._condition:
+			if self._writer != me:
+				while self._writer is not None or self._waiting_writers > 0 or (not self.shared_reads and self._readers > 0):
+					waited = True
+					self._condition.wait()
+			self._readers += 1
+		return waited
+
+	def release_read(self):
+		with self._condition:
+			self._readers -= 1
+			if self._readers == 0:
+				self._condition.notify_all()
+
+	def acquire_write(self):
+		me = threading.current_thread().ident
+		waited = False
+		with self._condition:
+			if self._writer == me:
+				self._writer_depth += 1
+				return waited
+			self._waiting_writers += 1
+			try:
+				while self._writer is not None or self._readers > 0:
+					waited = True
+					self._condition.wait()
+			finally:
+				self._waiting_writers -= 1
+			self._writer = me
+			self._writer_depth = 1
+		return waited
+
+	def release_write(self):
+		with self._condition:
+			self._writer_depth -= 1
+			if self._writer_depth == 0:
+				self._writer = None
+				self._condition.notify_all()
+
 #from hxtool_scheduler import hxtool_scheduler_task
 from hxtool_task_modules import *
 
@@ -279,4 +347,37 @@ def parse_schedule(request_params):
 				start_time = HXAPI.dt_from_str(request_params['interval_start_value'])
 
 	return (start_time, schedule)
-	
\ No newline at end of file
+	
+"""
+Yield (host, sysinfo) for every host of a profile, from the apicache when it is enabled
+and populated. Only hosts with no cached sysinfo record cost a restGetHostSysinfo call, and the
+result is added to the cache. sysinfo is an empty dict if the controller didn't return one.
+"""
+def host_sysinfo_list(hx_api_object, profile_id, limit = HXAPI.DEFAULT_LIMIT):
+	hosts = None
+	sysinfo = {}
+	if hxtool_global.hxtool_db.apicache:
+		hosts = [_['data'] for _ in hxtool_global.hxtool_db.cacheListUpdate(profile_id, 'host')]
+		sysinfo = {_['contentId'] : _['data'] for _ in hxtool_global.hxtool_db.cacheListUpdate(profile_id, 'sysinfo')}
+	if not hosts:
+		(ret, response_code, response_data) = hx_api_object.restListHosts(limit = limit)
+		hosts = response_data['data']['entries'] if ret else []
+		
+	for host in hosts:
+		host_sysinfo = sysinfo.get(host['_id'])
+		if host_sysinfo is None:
+			(ret, response_code, response_data) = hx_api_object.restGetHostSysinfo(host['_id'])
+			host_sysinfo = response_data['data'] if ret else {}
+			if ret and hxtool_global.hxtool_db.apicache:
+				hxtool_global.hxtool_db.cacheAddById(profile_id, 'sysinfo', host['_id'], host_sysinfo)
+		yield (host, host_sysinfo)
+
+"""
+Host counts for a dashboard field, maintained by the apicache (see hxtool_api_cache_aggregates),
+or None if the apicache isn't running for the profile or hasn't finished its first host sweep yet.
+"""
+def apicache_histogram(profile_id, field):
+	aggregates = hxtool_global.apicache_aggregates.get(profile_id)
+	if aggregates and aggregates.complete:
+		return aggregates.histogram(field)
+	return None
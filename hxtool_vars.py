@@ -6,7 +6,7 @@
 default_encoding = 'utf-8'
 HXTOOL_API_VERSION = 1
 __version__ = "4.5.1.2"
-hxtool_schema_version = 40
+hxtool_schema_version = 42
 data_path = "data"
 log_path = "log"
 
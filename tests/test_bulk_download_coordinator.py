@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import datetime
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hxtool_global
+from hxtool_db import hxtool_db
+from hxtool_config import hxtool_config
+from hxtool_scheduler import *
+from hxtool_task_modules import *
+from hxtool_task_modules.bulk_download_monitor_task_module import bulk_download_coordinator
+
+# Tracks how many host tasks run at the same time
+class _tracker:
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.running = 0
+		self.max_running = 0
+		self.runs = {}
+
+	def enter(self, name):
+		with self._lock:
+			self.running += 1
+			self.max_running = max(self.max_running, self.running)
+			self.runs[name] = self.runs.get(name, 0) + 1
+			return self.runs[name]
+
+	def exit(self):
+		with self._lock:
+			self.running -= 1
+
+# Stands in for the download and post-processing scheduler tasks, each run ends in the next of states,
+# the last one repeats
+class _host_task:
+	def __init__(self, tracker, name, states):
+		self.tracker = tracker
+		self.name = name
+		self.states = states
+		self.state = None
+		self.next_run = None
+		self.stored_result = {}
+
+	def inherit_stored_result(self, stored_result):
+		self.stored_result = stored_result
+
+	def run(self, scheduler):
+		run_count = self.tracker.enter(self.name)
+		try:
+			time.sleep(0.05)
+			self.state = self.states[min(run_count, len(self.states)) - 1]
+			self.next_run = datetime.datetime.utcnow() + datetime.timedelta(seconds = 0.1) if self.state == TASK_STATE_SCHEDULED else None
+			self.stored_result = {'bulk_download_path' : self.name}
+		finally:
+			self.tracker.exit()
+
+def _globals(temp_dir):
+	hxtool_global.initialize()
+	hxtool_global.hxtool_config = hxtool_config(os.path.join(temp_dir, 'conf.json'))
+	hxtool_global.hxtool_db = hxtool_db(os.path.join(temp_dir, 'hxtool.db'))
+	hxtool_global.hxtool_scheduler = hxtool_scheduler(thread_count = 2)
+	hxtool_global.hxtool_scheduler.start()
+	return hxtool_global.hxtool_scheduler
+
+def _close(temp_dir):
+	hxtool_global.hxtool_scheduler.stop()
+	hxtool_global.hxtool_db.close()
+	shutil.rmtree(temp_dir)
+
+def _wait(f, timeout = 10):
+	end = time.time() + timeout
+	while not f():
+		assert time.time() < end
+		time.sleep(0.02)
+
+def _hosts(count):
+	return [('a{}'.format(i), 'host-{}'.format(i)) for i in range(count)]
+
+def test_concurrency_includes_processing():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		_globals(temp_dir)
+		tracker = _tracker()
+		processed = []
+		def task_factory(agent_id, host_name):
+			process_task = _host_task(tracker, 'process-' + agent_id, [TASK_STATE_COMPLETE])
+			processed.append(process_task)
+			return (_host_task(tracker, agent_id, [TASK_STATE_COMPLETE]), process_task)
+
+		coordinator = bulk_download_coordinator(1, 2)
+		coordinator.submit(_hosts(6), task_factory)
+		# Hosts that are already queued aren't queued again
+		coordinator.submit(_hosts(6), task_factory)
+		_wait(coordinator.idle)
+
+		assert tracker.max_running == 2
+		assert len(tracker.runs) == 12 and set(tracker.runs.values()) == set([1])
+		# The post-processing task gets what the download task stored
+		assert sorted([_.stored_result['bulk_download_path'] for _ in processed]) == ['process-a{}'.format(i) for i in range(6)]
+		assert coordinator.status() == {'queued' : 0, 'in_flight' : 0, 'processing' : 0, 'deferred' : 0, 'completed' : 6, 'failed' : 0}
+		assert coordinator.has_host('a0')
+		# Downloaded hosts aren't queued again either
+		coordinator.submit(_hosts(1), task_factory)
+		assert coordinator.status()['queued'] == 0 and coordinator.idle()
+	finally:
+		_close(temp_dir)
+
+def test_deferred_and_failed_hosts():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		_globals(temp_dir)
+		tracker = _tracker()
+		outcomes = {
+			'a0' : [TASK_STATE_SCHEDULED, TASK_STATE_SCHEDULED, TASK_STATE_COMPLETE],
+			'a1' : [TASK_STATE_FAILED],
+			'a2' : [TASK_STATE_COMPLETE]
+		}
+		coordinator = bulk_download_coordinator(1, 4)
+		coordinator.submit(_hosts(3), lambda agent_id, host_name: (_host_task(tracker, agent_id, outcomes[agent_id]), None))
+
+		_wait(lambda: coordinator.status()['deferred'] == 1)
+		assert not coordinator.idle()
+		assert coordinator.has_host('a0')
+		assert coordinator.child_states() == {task_state_description[TASK_STATE_SCHEDULED] : 1, task_state_description[TASK_STATE_COMPLETE] : 1, task_state_description[TASK_STATE_FAILED] : 1}
+
+		# Deferred hosts are dispatched again when submit() is called after their next_run
+		_wait(lambda: coordinator.submit([], None) or coordinator.idle())
+		assert tracker.runs == {'a0' : 3, 'a1' : 1, 'a2' : 1}
+		assert coordinator.status()['completed'] == 2 and coordinator.status()['failed'] == 1
+		# A host that failed can be queued again
+		assert not coordinator.has_host('a1')
+	finally:
+		_close(temp_dir)
+
+def test_stop_drops_queued_hosts():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		_globals(temp_dir)
+		tracker = _tracker()
+		coordinator = bulk_download_coordinator(1, 1)
+		coordinator.submit(_hosts(4), lambda agent_id, host_name: (_host_task(tracker, agent_id, [TASK_STATE_COMPLETE]), None))
+		coordinator.stop()
+		_wait(coordinator.idle)
+		assert len(tracker.runs) == 1
+		assert not coordinator.has_host('a3')
+	finally:
+		_close(temp_dir)
+
+class _api:
+	hx_host = 'hx'
+
+	def __init__(self, hosts):
+		self.hosts = hosts
+		self.state = 'RUNNING'
+
+	def restGetBulkDetails(self, bulk_acquisition_id):
+		return (True, 200, {'data' : {'state' : self.state}})
+
+	def restListBulkHosts(self, bulk_acquisition_id, filter_term = None):
+		return (True, 200, {'data' : {'entries' : [{'host' : {'_id' : agent_id, 'hostname' : host_name}} for agent_id, host_name in self.hosts]}})
+
+def test_monitor_gives_up_after_retries():
+	temp_dir = tempfile.mkdtemp()
+	bulk_download_eid = None
+	try:
+		_globals(temp_dir)
+		hxtool_global.hxtool_config['scheduler']['bulk_download_retries'] = 1
+		db = hxtool_global.hxtool_db
+		bulk_download_eid = db.bulkDownloadCreate(1, hostset_id = 1)
+		db.bulkDownloadUpdate(bulk_download_eid, bulk_acquisition_id = 99)
+
+		tracker = _tracker()
+		api = _api(_hosts(3))
+		monitor_task = hxtool_scheduler_task(1, 'Bulk Download Monitor', immutable = True)
+		monitor_task.add_step(bulk_download_monitor_task_module, kwargs = {'bulk_download_eid' : bulk_download_eid, 'task_profile' : None})
+		monitor = monitor_task.steps[0][0]
+		monitor.get_task_api_object = lambda: api
+		monitor._host_task = lambda bulk_download_eid, agent_id, host_name, task_profile: (_host_task(tracker, agent_id, [TASK_STATE_COMPLETE] if agent_id == 'a0' else [TASK_STATE_FAILED]), None)
+
+		def run_monitor():
+			monitor_task._defer_signal = False
+			monitor_task._stop_signal = False
+			monitor.run(bulk_download_eid = bulk_download_eid)
+			coordinator = bulk_download_coordinator.find(bulk_download_eid)
+			if coordinator:
+				_wait(coordinator.idle)
+
+		run_monitor()
+		assert monitor_task._defer_signal
+		assert monitor_task.child_states() == {task_state_description[TASK_STATE_COMPLETE] : 1, task_state_description[TASK_STATE_FAILED] : 2}
+
+		# Once the job is done the hosts that failed are queued until they run out of retries
+		api.state = 'COMPLETE'
+		run_monitor()
+		assert monitor_task._defer_signal
+		run_monitor()
+		assert monitor_task._stop_signal
+		assert bulk_download_coordinator.find(bulk_download_eid) is None
+
+		hosts = db.bulkDownloadGet(bulk_download_eid)['hosts']
+		assert tracker.runs == {'a0' : 1, 'a1' : 2, 'a2' : 2}
+		# The coordinator remembers the hosts it downloaded, they aren't queued again
+		assert hosts['a0']['attempts'] == 1
+		assert hosts['a1'] == {'hostname' : 'host-1', 'downloaded' : False, 'attempts' : 2, 'failed' : True}
+		assert db.bulkDownloadGet(bulk_download_eid)['stopped']
+	finally:
+		bulk_download_coordinator.remove(bulk_download_eid)
+		_close(temp_dir)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hxtool_db import hxtool_db
+from hxtool_db_engine import hxtool_db_tinydb_engine, hxtool_db_sqlite_engine, db_engine_file_names, json_field_expression, DB_ENGINE_TINYDB, DB_ENGINE_SQLITE
+
+# The same hxtool_db calls are expected to behave the same way on every engine
+DB_ENGINES = [DB_ENGINE_TINYDB, DB_ENGINE_SQLITE]
+
+def _open_db(temp_dir, db_engine, **kwargs):
+	return hxtool_db(os.path.join(temp_dir, db_engine_file_names[db_engine]), db_engine = db_engine, **kwargs)
+
+def _task(task_id, profile_id = 1):
+	return {'profile_id' : profile_id, 'task_id' : task_id, 'name' : 'Task {}'.format(task_id), 'state' : 0}
+
+def test_tasks():
+	for db_engine in DB_ENGINES:
+		temp_dir = tempfile.mkdtemp()
+		try:
+			db = _open_db(temp_dir, db_engine)
+			doc_id = db.taskCreate(_task('a'))
+			db.taskCreate(_task('b'))
+			db.taskCreate(_task('a', profile_id = 2))
+
+			assert db.taskUpdate(1, 'a', {'state' : 1}) == [doc_id]
+			assert db.taskUpdate(1, 'b', {'state' : 2}, doc_id = 2) == [2]
+			assert db.taskUpdate(1, 'c', {'state' : 1}) == []
+			assert db.taskGet(1, 'a')['state'] == 1
+			assert db.taskGet(1, 'a').doc_id == doc_id
+			assert db.taskGet(2, 'a')['state'] == 0
+			assert db.taskGet(1, 'c') is None
+
+			with db.batch():
+				db.taskCreate(_task('c'))
+				db.taskDelete(1, 'b')
+				# Batched writes are only applied when the batch exits
+				assert len(db.taskList()) == 3
+			assert sorted([(_['profile_id'], _['task_id'], _['state']) for _ in db.taskList()]) == [(1, 'a', 1), (1, 'c', 0), (2, 'a', 0)]
+			db.close()
+
+			db = _open_db(temp_dir, db_engine)
+			assert sorted([(_['profile_id'], _['task_id']) for _ in db.taskList()]) == [(1, 'a'), (1, 'c'), (2, 'a')]
+			db.close()
+		finally:
+			shutil.rmtree(temp_dir)
+
+def test_cache():
+	for db_engine in DB_ENGINES:
+		temp_dir = tempfile.mkdtemp()
+		try:
+			db = _open_db(temp_dir, db_engine, apicache = True)
+			db.cacheAdd(1, 'host', {'_id' : 'h1', 'hostname' : 'one'})
+			db.cacheAdd(1, 'host', {'_id' : 'h2', 'hostname' : 'two'})
+			db.cacheAdd(2, 'host', {'_id' : 'h1', 'hostname' : 'other'})
+
+			assert db.cacheGet(1, 'host', 'h1')['data'] == {'_id' : 'h1', 'hostname' : 'one'}
+			assert db.cacheGet(2, 'host', 'h1')['data']['hostname'] == 'other'
+			assert db.cacheGet(1, 'host', 'h3') == False
+			assert db.cacheGet(1, 'alert', 'h1') == False
+
+			assert len(db.cacheUpdate(1, 'host', 'h2', {'_id' : 'h2', 'hostname' : 'renamed'})) == 1
+			assert db.cacheUpdate(1, 'host', 'h3', {'_id' : 'h3'}) == []
+			assert sorted([_['data']['hostname'] for _ in db.cacheList(1, 'host')]) == ['one', 'renamed']
+			db.close()
+
+			# The lookup index is rebuilt from the table
+			db = _open_db(temp_dir, db_engine, apicache = True)
+			assert db.cacheGet(1, 'host', 'h2')['data']['hostname'] == 'renamed'
+			db.cacheDrop(1)
+			assert db.cacheGet(1, 'host', 'h1') == False
+			assert db.cacheGet(2, 'host', 'h1')['data']['hostname'] == 'other'
+			db.close()
+		finally:
+			shutil.rmtree(temp_dir)
+
+def test_bulk_download_hosts():
+	for db_engine in DB_ENGINES:
+		temp_dir = tempfile.mkdtemp()
+		try:
+			db = _open_db(temp_dir, db_engine)
+			bulk_download_eid = db.bulkDownloadCreate(1, hostset_id = 5)
+			db.bulkDownloadUpdate(bulk_download_eid, bulk_acquisition_id = 99)
+
+			db.bulkDownloadUpdateHost(bulk_download_eid, 'a', hostname = 'host-a', downloaded = False)
+			db.bulkDownloadUpdateHost(bulk_download_eid, 'b', hostname = 'host-b', downloaded = False)
+			db.bulkDownloadUpdateHost(bulk_download_eid, 'a', attempts = 2)
+			db.bulkDownloadUpdateHost(bulk_download_eid, 'b', downloaded = True)
+			db.bulkDownloadUpdateHost(bulk_download_eid, 'c', hostname = 'host-c', failed = True)
+			db.bulkDownloadDeleteHost(bulk_download_eid, 'c')
+
+			bulk_download = db.bulkDownloadGet(profile_id = 1, bulk_acquisition_id = 99)
+			assert bulk_download.doc_id == bulk_download_eid
+			# Updating a host only changes the fields that were passed
+			assert bulk_download['hosts'] == {
+				'a' : {'hostname' : 'host-a', 'downloaded' : False, 'attempts' : 2},
+				'b' : {'hostname' : 'host-b', 'downloaded' : True}
+			}
+			assert db.bulkDownloadGet(profile_id = 2, bulk_acquisition_id = 99) is None
+			db.close()
+		finally:
+			shutil.rmtree(temp_dir)
+
+def test_sqlite_conditions():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		engine = hxtool_db_sqlite_engine(os.path.join(temp_dir, 'hxtool.sqlite'))
+		table = engine.table('tasks')
+		table.insert({'profile_id' : 1, 'task_id' : 'a', "it's" : 'x', 'parent_id' : None})
+		table.insert({'profile_id' : 1, 'task_id' : 'b', "it's" : 'y', 'parent_id' : 'a'})
+		table.insert({'profile_id' : '1', 'task_id' : 'c'})
+
+		# Values are compared with their JSON type, 1 doesn't match '1'
+		assert [_['task_id'] for _ in table.search(engine.query(profile_id = 1))] == ['a', 'b']
+		assert [_['task_id'] for _ in table.search(engine.query(profile_id = '1'))] == ['c']
+		assert [_['task_id'] for _ in table.search(engine.query(profile_id = 1, task_id = 'b'))] == ['b']
+		assert [_['task_id'] for _ in table.search(engine.query(**{"it's" : 'x'}))] == ['a']
+		assert [_['task_id'] for _ in table.search(engine.query(profile_id = 1, parent_id = None))] == ['a']
+		assert table.get(engine.query(task_id = 'c'), doc_id = 1) is None
+
+		# Lookups use the expression index, which only happens if the query has the index's exact expression text
+		plan = engine.connection().execute('EXPLAIN QUERY PLAN SELECT doc_id FROM tasks WHERE {} = ? AND {} = ?'.format(json_field_expression('profile_id'), json_field_expression('task_id')), (1, 'a')).fetchall()
+		assert 'ix_tasks_0' in ' '.join([str(_[-1]) for _ in plan])
+
+		for field_name in ['a"b', 'a\\b']:
+			try:
+				json_field_expression(field_name)
+				assert False
+			except ValueError:
+				pass
+		engine.close()
+	finally:
+		shutil.rmtree(temp_dir)
+
+def test_sqlite_transaction():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		engine = hxtool_db_sqlite_engine(os.path.join(temp_dir, 'hxtool.sqlite'))
+		table = engine.table('tasks')
+		table.insert({'task_id' : 'a'})
+
+		try:
+			with engine.transaction():
+				table.insert({'task_id' : 'b'})
+				# Nested transactions are part of the outer one
+				with engine.transaction():
+					table.update({'state' : 1}, doc_ids = [1])
+				raise RuntimeError()
+		except RuntimeError:
+			pass
+		assert table.all() == [{'task_id' : 'a'}]
+
+		with engine.batch():
+			table.insert({'task_id' : 'b'})
+			table.remove(doc_ids = [1])
+		assert [(_.doc_id, _['task_id']) for _ in table.all()] == [(2, 'b')]
+
+		# Nothing is left uncommitted
+		other = hxtool_db_sqlite_engine(os.path.join(temp_dir, 'hxtool.sqlite'))
+		assert [_['task_id'] for _ in other.table('tasks').all()] == ['b']
+		other.close()
+		engine.close()
+	finally:
+		shutil.rmtree(temp_dir)
+
+def test_migrate_from_tinydb():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		tinydb_file = os.path.join(temp_dir, db_engine_file_names[DB_ENGINE_TINYDB])
+		db = hxtool_db(tinydb_file, journal = True)
+		db.taskCreate(_task('a'))
+		db.taskCreate(_task('b'))
+		db.taskDelete(1, 'a')
+		bulk_download_eid = db.bulkDownloadCreate(1, hostset_id = 5)
+		db.bulkDownloadUpdateHost(bulk_download_eid, 'a', hostname = 'host-a', downloaded = True)
+		db.close()
+
+		# Writes that are still only in the journal are migrated as well
+		engine = hxtool_db_tinydb_engine(tinydb_file, journal = True)
+		engine.table('tasks').update({'state' : 3}, doc_ids = [2])
+		with open(tinydb_file, 'r') as f:
+			tables = json.load(f)
+
+		sqlite_file = os.path.join(temp_dir, db_engine_file_names[DB_ENGINE_SQLITE])
+		db = hxtool_db(sqlite_file, db_engine = DB_ENGINE_SQLITE, migrate_from = tinydb_file)
+		# doc_ids are kept, documents reference each other by them
+		assert [(_.doc_id, _['task_id'], _['state']) for _ in db.taskList()] == [(2, 'b', 3)]
+		assert db.bulkDownloadGet(bulk_download_eid)['hosts'] == {'a' : {'hostname' : 'host-a', 'downloaded' : True}}
+		for table_name, documents in tables.items():
+			migrated = {str(_.doc_id) : dict(_) for _ in db._db.table(table_name).all()}
+			assert sorted(migrated.keys()) == sorted(documents.keys())
+		# New documents get doc_ids after the migrated ones
+		assert db.taskCreate(_task('c')) == 3
+		db.close()
+
+		# Migration only happens into a new database
+		db = hxtool_db(sqlite_file, db_engine = DB_ENGINE_SQLITE, migrate_from = tinydb_file)
+		assert sorted([_['task_id'] for _ in db.taskList()]) == ['b', 'c']
+		db.close()
+	finally:
+		shutil.rmtree(temp_dir)
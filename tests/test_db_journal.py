@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hxtool_db_engine import hxtool_db_tinydb_engine, replay_journal
+
+def _tables(db_file):
+	with open(db_file, 'r') as f:
+		return json.load(f)
+
+def _write_and_crash(db_file):
+	engine = hxtool_db_tinydb_engine(db_file, journal = True)
+	table = engine.table('tasks')
+	table.insert({'task_id' : 'a', 'state' : 0})
+	b = table.insert({'task_id' : 'b', 'state' : 0})
+	table.insert({'task_id' : 'c', 'state' : 0})
+	table.update({'state' : 1}, doc_ids = [b])
+	table.remove(doc_ids = [1])
+	# No close(), so nothing but the journal has the writes
+	return engine
+
+def test_replay_after_unclean_shutdown():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		db_file = os.path.join(temp_dir, 'hxtool.db')
+		_write_and_crash(db_file)
+		assert not os.path.isfile(db_file) or 'tasks' not in (_tables(db_file) or {})
+
+		engine = hxtool_db_tinydb_engine(db_file, journal = True)
+		documents = {_['task_id'] : _['state'] for _ in engine.table('tasks').all()}
+		assert documents == {'b' : 1, 'c' : 0}
+		# Recovery writes a snapshot and empties the journal
+		assert _tables(db_file)['tasks'] == {'2' : {'task_id' : 'b', 'state' : 1}, '3' : {'task_id' : 'c', 'state' : 0}}
+		assert os.path.getsize(db_file + '.journal') == 0
+		engine.close()
+	finally:
+		shutil.rmtree(temp_dir)
+
+def test_replay_is_idempotent():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		db_file = os.path.join(temp_dir, 'hxtool.db')
+		_write_and_crash(db_file)
+		journal_file = db_file + '.journal'
+
+		tables = {}
+		assert replay_journal(tables, journal_file) == 5
+		once = json.loads(json.dumps(tables))
+		# A crash between writing a snapshot and emptying the journal replays records that are already in the snapshot
+		assert replay_journal(tables, journal_file) == 5
+		assert tables == once
+
+		with open(db_file, 'w') as f:
+			json.dump(once, f)
+		engine = hxtool_db_tinydb_engine(db_file, journal = True)
+		assert {_['task_id'] : _['state'] for _ in engine.table('tasks').all()} == {'b' : 1, 'c' : 0}
+		engine.close()
+	finally:
+		shutil.rmtree(temp_dir)
+
+def test_torn_record_is_ignored():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		db_file = os.path.join(temp_dir, 'hxtool.db')
+		_write_and_crash(db_file)
+		journal_file = db_file + '.journal'
+		with open(journal_file, 'a') as f:
+			f.write('["put", "tasks", 4, {"task_id" : "d"')
+
+		tables = {}
+		assert replay_journal(tables, journal_file) == 5
+		assert sorted(tables['tasks'].keys()) == ['2', '3']
+	finally:
+		shutil.rmtree(temp_dir)
+
+def _set_host(host_id, downloaded):
+	def transform(element):
+		element['hosts'].setdefault(host_id, {})['downloaded'] = downloaded
+	transform.paths = [['hosts', host_id]]
+	return transform
+
+def _append_file(name):
+	def transform(element):
+		element['files'].append({'name' : name})
+		transform.paths.append(['files', len(element['files']) - 1])
+	transform.paths = []
+	return transform
+
+def _journal_records(journal_file):
+	with open(journal_file, 'r') as f:
+		return [json.loads(_) for _ in f]
+
+def test_update_journals_changed_fields():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		db_file = os.path.join(temp_dir, 'hxtool.db')
+		engine = hxtool_db_tinydb_engine(db_file, journal = True)
+		table = engine.table('bulk_download')
+		doc_id = table.insert({'hosts' : {'a{}'.format(i) : {'downloaded' : False} for i in range(1000)}, 'files' : [], 'stopped' : False})
+		table.update(_set_host('a1', True), doc_ids = [doc_id])
+		table.update(_append_file('a1.zip'), doc_ids = [doc_id])
+		table.update({'stopped' : True}, doc_ids = [doc_id])
+		# Without paths the whole document is journaled
+		table.update(lambda element: element['hosts'].pop('a2'), doc_ids = [doc_id])
+		
+		records = _journal_records(db_file + '.journal')
+		assert [_[0] for _ in records] == ['put', 'patch', 'patch', 'patch', 'put']
+		assert records[1][3] == [[['hosts', 'a1'], {'downloaded' : True}]]
+		assert records[2][3] == [[['files', 0], {'name' : 'a1.zip'}]]
+		assert records[3][3] == [[['stopped'], True]]
+		expected = table.get(doc_id = doc_id)
+		
+		tables = {}
+		assert replay_journal(tables, db_file + '.journal') == 5
+		assert tables['bulk_download'][str(doc_id)] == expected
+		# Patches hold absolute values, replaying them onto a snapshot that has them already changes nothing
+		assert replay_journal(tables, db_file + '.journal') == 5
+		assert tables['bulk_download'][str(doc_id)] == expected
+		engine.close()
+	finally:
+		shutil.rmtree(temp_dir)
+
+def test_patch_removes_keys():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		db_file = os.path.join(temp_dir, 'hxtool.db')
+		engine = hxtool_db_tinydb_engine(db_file, journal = True)
+		table = engine.table('bulk_download')
+		doc_id = table.insert({'hosts' : {'a' : {'downloaded' : False}, 'b' : {'downloaded' : False}}})
+		def remove_host(element):
+			del element['hosts']['a']
+		remove_host.paths = [['hosts', 'a']]
+		table.update(remove_host, doc_ids = [doc_id])
+		assert _journal_records(db_file + '.journal')[-1][3] == [[['hosts', 'a']]]
+		
+		engine = hxtool_db_tinydb_engine(db_file, journal = True)
+		assert engine.table('bulk_download').get(doc_id = doc_id) == {'hosts' : {'b' : {'downloaded' : False}}}
+		engine.close()
+	finally:
+		shutil.rmtree(temp_dir)
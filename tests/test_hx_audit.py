@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hx_audit import AuditPackage
+
+FILE_ITEM = """<FileItem uid="1">
+<FullPath>C:\\Windows\\System32\\kernel32.dll</FullPath>
+<SizeInBytes>1024</SizeInBytes>
+<Empty/>
+<PEInfo>
+<Type>Dll</Type>
+<DigitalSignature>
+<SignatureExists>true</SignatureExists>
+<CertificateSubject>Microsoft Windows</CertificateSubject>
+</DigitalSignature>
+<DetectedAnomalies>
+<string>checksum_is_zero</string>
+<string>oversized_section</string>
+</DetectedAnomalies>
+<Sections>
+<Section><Name>.text</Name><SizeInBytes>4096</SizeInBytes></Section>
+<Section><Name>.data</Name><SizeInBytes>512</SizeInBytes></Section>
+</Sections>
+</PEInfo>
+</FileItem>"""
+
+DRIVER_ITEM = """<DriverItem>
+<DriverName>\\Driver\\disk</DriverName>
+<DeviceItem>
+<DeviceName>\\Device\\Harddisk0</DeviceName>
+<AttachedDevices>
+<AttachedDevice><Name>partmgr</Name></AttachedDevice>
+</AttachedDevices>
+</DeviceItem>
+<DeviceItem>
+<DeviceName>\\Device\\Harddisk1</DeviceName>
+</DeviceItem>
+</DriverItem>"""
+
+# The recursive xml_to_dict that the iterative one replaced
+def recursive_xml_to_dict(element):
+	d = OrderedDict()
+	if len(element) > 0:
+		for child_element in element:
+			sub_value = recursive_xml_to_dict(child_element)[child_element.tag]
+			if child_element.tag in d:
+				if isinstance(d[child_element.tag], list):
+					d[child_element.tag].append(sub_value)
+				else:
+					d[child_element.tag] = [d[child_element.tag], sub_value]
+			else:
+				d[child_element.tag] = sub_value
+		return {element.tag : d}
+	else:
+		return {element.tag : element.text}
+
+def _audit_package():
+	return AuditPackage.__new__(AuditPackage)
+
+def test_xml_to_dict_matches_recursive():
+	for xml in [FILE_ITEM, DRIVER_ITEM, '<Item/>', '<Item>text</Item>', '<Item><a>1</a><a>2</a><a>3</a></Item>']:
+		element = ET.fromstring(xml)
+		# Compare the JSON so that the key order is checked as well
+		assert json.dumps(_audit_package().xml_to_dict(element)) == json.dumps(recursive_xml_to_dict(element))
+
+def test_xml_to_dict_flatten():
+	d = _audit_package().xml_to_dict(ET.fromstring(FILE_ITEM), flatten = True)
+	assert d == {
+		'FileItem' : {
+			'FullPath' : 'C:\\Windows\\System32\\kernel32.dll',
+			'SizeInBytes' : '1024',
+			'Empty' : None,
+			'PEInfo.Type' : 'Dll',
+			'PEInfo.DigitalSignature.SignatureExists' : 'true',
+			'PEInfo.DigitalSignature.CertificateSubject' : 'Microsoft Windows',
+			'PEInfo.DetectedAnomalies.string.0' : 'checksum_is_zero',
+			'PEInfo.DetectedAnomalies.string.1' : 'oversized_section',
+			'PEInfo.Sections.Section.0.Name' : '.text',
+			'PEInfo.Sections.Section.0.SizeInBytes' : '4096',
+			'PEInfo.Sections.Section.1.Name' : '.data',
+			'PEInfo.Sections.Section.1.SizeInBytes' : '512'
+		}
+	}
+
+def test_xml_to_dict_flatten_separator():
+	d = _audit_package().xml_to_dict(ET.fromstring(DRIVER_ITEM), flatten = True, separator = '/')
+	assert d == {
+		'DriverItem' : {
+			'DriverName' : '\\Driver\\disk',
+			'DeviceItem/0/DeviceName' : '\\Device\\Harddisk0',
+			'DeviceItem/0/AttachedDevices/AttachedDevice/Name' : 'partmgr',
+			'DeviceItem/1/DeviceName' : '\\Device\\Harddisk1'
+		}
+	}
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hxtool_global
+from hxtool_db import hxtool_db
+from hxtool_config import hxtool_config
+from hxtool_scheduler import *
+
+class _step:
+	def __init__(self, names, event = None):
+		self.names = names
+		self.event = event
+
+	def run(self, name):
+		self.names.append(name)
+		if self.event and len(self.names) == 2:
+			self.event.set()
+		return True
+
+def _globals(temp_dir):
+	hxtool_global.initialize()
+	hxtool_global.hxtool_config = hxtool_config(os.path.join(temp_dir, 'conf.json'))
+	hxtool_global.hxtool_db = hxtool_db(os.path.join(temp_dir, 'hxtool.db'))
+	hxtool_global.hxtool_scheduler = hxtool_scheduler(thread_count = 2)
+	return hxtool_global.hxtool_scheduler
+
+def _task(name, step, next_run = None, **kwargs):
+	kwargs.setdefault('immutable', True)
+	task = hxtool_scheduler_task(1, name, next_run = next_run, **kwargs)
+	task.add_step(step, kwargs = {'name' : name})
+	return task
+
+def _due(scheduler):
+	with scheduler._lock:
+		return [_.name for _ in scheduler._pop_due_tasks()]
+
+def test_due_tasks_in_next_run_order():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		scheduler = _globals(temp_dir)
+		step = _step([])
+		now = datetime.datetime.utcnow()
+		for name, seconds in [('c', -1), ('future', 60), ('a', -3), ('b', -2)]:
+			scheduler.add(_task(name, step, next_run = now + datetime.timedelta(seconds = seconds)), should_store = False)
+
+		assert _due(scheduler) == ['a', 'b', 'c']
+		assert [_.state for _ in scheduler.task_queue.values() if _.name != 'future'] == [TASK_STATE_QUEUED] * 3
+		assert _due(scheduler) == []
+		# The task that isn't due stays on the heap
+		assert [_[2].name for _ in scheduler._run_queue] == ['future']
+	finally:
+		hxtool_global.hxtool_db.close()
+		shutil.rmtree(temp_dir)
+
+def test_stale_entries_are_skipped():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		scheduler = _globals(temp_dir)
+		step = _step([])
+		past = datetime.datetime.utcnow() - datetime.timedelta(seconds = 1)
+		rescheduled = _task('rescheduled', step, next_run = past)
+		removed = _task('removed', step, next_run = past, immutable = False)
+		duplicate = _task('duplicate', step, next_run = past)
+		for task in [rescheduled, removed, duplicate]:
+			scheduler.add(task, should_store = False)
+
+		with scheduler._lock:
+			# Entries aren't removed from the heap, the one for the old next_run must not dispatch the task
+			rescheduled.next_run = past + datetime.timedelta(seconds = 60)
+			scheduler._schedule(rescheduled)
+			scheduler._schedule(duplicate)
+		scheduler.remove(removed.task_id)
+
+		assert _due(scheduler) == ['duplicate']
+		assert [_[2].name for _ in scheduler._run_queue] == ['rescheduled']
+	finally:
+		hxtool_global.hxtool_db.close()
+		shutil.rmtree(temp_dir)
+
+def test_child_waits_for_parent():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		scheduler = _globals(temp_dir)
+		names = []
+		step = _step(names)
+		parent = _task('parent', step)
+		child = _task('child', step, parent_id = parent.task_id)
+		scheduler.add(parent, should_store = False)
+		scheduler.add(child, should_store = False)
+
+		# Children waiting for their parent have no next_run and aren't on the heap
+		assert [_[2].name for _ in scheduler._run_queue] == ['parent']
+		assert _due(scheduler) == ['parent']
+
+		scheduler._run_task(parent)
+		assert names == ['parent']
+		assert parent.state == TASK_STATE_COMPLETE
+		# The parent completing schedules the child, after the defer interval
+		assert child.parent_complete
+		assert [_[2].name for _ in scheduler._run_queue] == ['child']
+		assert _due(scheduler) == []
+
+		child.next_run = datetime.datetime.utcnow() - datetime.timedelta(seconds = 1)
+		with scheduler._lock:
+			scheduler._schedule(child)
+		assert _due(scheduler) == ['child']
+	finally:
+		hxtool_global.hxtool_db.close()
+		shutil.rmtree(temp_dir)
+
+def test_poll_thread_wakes_up_for_new_tasks():
+	temp_dir = tempfile.mkdtemp()
+	try:
+		scheduler = _globals(temp_dir)
+		event = threading.Event()
+		names = []
+		step = _step(names, event)
+		scheduler.start()
+		try:
+			now = datetime.datetime.utcnow()
+			# The poll thread goes to sleep until the first task is due, adding an earlier one wakes it up
+			scheduler.add(_task('later', step, next_run = now + datetime.timedelta(seconds = 0.5)), should_store = False)
+			scheduler.add(_task('now', step, next_run = now), should_store = False)
+			assert event.wait(5)
+			assert names == ['now', 'later']
+		finally:
+			scheduler.stop()
+	finally:
+		hxtool_global.hxtool_db.close()
+		shutil.rmtree(temp_dir)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Measures how many audit records per second hx_audit parses, as the Helix and X15 task modules (audit_to_dict)
+# and the stacking and file listing task modules (iter_audit_records) read them.
+# When lxml is installed, the same conversion built on lxml is measured for comparison.
+# Usage: python audit_parse_benchmark.py [acquisition_package.zip ...]
+# Without arguments, acquisition packages with generated file, process and driver audits are used.
+
+import os
+import sys
+import json
+import time
+import zipfile
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hx_audit
+
+try:
+	from lxml import etree as lxml_etree
+except ImportError:
+	lxml_etree = None
+
+FILE_ITEM = """<FileItem created="2020-01-01T00:00:00Z" uid="{0}" sequence_num="{0}">
+<DevicePath>\\Device\\HarddiskVolume2</DevicePath>
+<FullPath>C:\\Windows\\System32\\file{0}.dll</FullPath>
+<Drive>C:</Drive>
+<FilePath>Windows\\System32</FilePath>
+<FileName>file{0}.dll</FileName>
+<FileExtension>.dll</FileExtension>
+<SizeInBytes>{0}</SizeInBytes>
+<Created>2019-03-19T04:43:22Z</Created>
+<Modified>2019-03-19T04:43:22Z</Modified>
+<Accessed>2020-01-01T00:00:00Z</Accessed>
+<Changed>2019-10-10T11:21:45Z</Changed>
+<Username>NT SERVICE\\TrustedInstaller</Username>
+<Md5sum>d41d8cd98f00b204e9800998ecf8427e</Md5sum>
+<PEInfo>
+<Type>Dll</Type>
+<Subsystem>Windows_CUI</Subsystem>
+<BaseAddress>0x180000000</BaseAddress>
+<PETimeStamp>2019-03-19T04:43:22Z</PETimeStamp>
+<DigitalSignature>
+<SignatureExists>true</SignatureExists>
+<SignatureVerified>true</SignatureVerified>
+<Description>File is signed and the signature was verified</Description>
+<CertificateSubject>Microsoft Windows</CertificateSubject>
+<CertificateIssuer>Microsoft Windows Production PCA 2011</CertificateIssuer>
+</DigitalSignature>
+<DetectedAnomalies>
+<string>checksum_is_zero</string>
+<string>oversized_section</string>
+</DetectedAnomalies>
+<Sections>
+<Section><Name>.text</Name><Type>CODE</Type><SizeInBytes>4096</SizeInBytes></Section>
+<Section><Name>.rdata</Name><Type>INITIALIZED_DATA</Type><SizeInBytes>2048</SizeInBytes></Section>
+<Section><Name>.data</Name><Type>INITIALIZED_DATA</Type><SizeInBytes>512</SizeInBytes></Section>
+</Sections>
+</PEInfo>
+</FileItem>
+"""
+
+PROCESS_ITEM = """<ProcessItem created="2020-01-01T00:00:00Z" uid="{0}" sequence_num="{0}">
+<pid>{0}</pid>
+<parentpid>4</parentpid>
+<path>C:\\Windows\\System32</path>
+<name>svchost.exe</name>
+<arguments>C:\\Windows\\system32\\svchost.exe -k netsvcs -p -s Schedule</arguments>
+<startTime>2020-01-01T00:00:00Z</startTime>
+<kernelTime>0</kernelTime>
+<userTime>0</userTime>
+<Username>NT AUTHORITY\\SYSTEM</Username>
+<SecurityID>S-1-5-18</SecurityID>
+<SecurityType>SidTypeWellKnownGroup</SecurityType>
+</ProcessItem>
+"""
+
+DRIVER_ITEM = """<DriverItem created="2020-01-01T00:00:00Z" uid="{0}" sequence_num="{0}">
+<DriverObjectAddress>0xffff8d0{0}</DriverObjectAddress>
+<DriverName>\\Driver\\driver{0}</DriverName>
+<DeviceItem>
+<DeviceObject>0xffff8d0000000001</DeviceObject>
+<DeviceName>\\Device\\device{0}</DeviceName>
+<AttachedDevices>
+<AttachedDevice><Name>\\Driver\\partmgr</Name><Address>0xffff8d0000000002</Address></AttachedDevice>
+<AttachedDevice><Name>\\Driver\\volsnap</Name><Address>0xffff8d0000000003</Address></AttachedDevice>
+</AttachedDevices>
+</DeviceItem>
+</DriverItem>
+"""
+
+AUDITS = [
+	('w32rawfiles', 'FileItem', FILE_ITEM, 20000),
+	('w32processes-memory', 'ProcessItem', PROCESS_ITEM, 50000),
+	('w32kernel-hookdetection', 'DriverItem', DRIVER_ITEM, 50000)
+]
+
+def create_package(path, generator, item_template, count):
+	manifest = {
+		'audits' : [{
+			'generator' : generator,
+			'generatorVersion' : '1.0',
+			'results' : [{
+				'type' : 'application/xml',
+				'payload' : 'payload',
+				'timestamps' : []
+			}]
+		}]
+	}
+	metadata = {'agent' : {'_id' : 'benchmark', 'sysinfo' : {'hostname' : 'benchmark'}}}
+	with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+		z.writestr('manifest.json', json.dumps(manifest))
+		z.writestr('metadata.json', json.dumps(metadata))
+		z.writestr('payload', '<?xml version="1.0" encoding="UTF-8"?>\n<itemList generator="{0}">\n{1}</itemList>\n'.format(generator, ''.join([item_template.format(i) for i in range(count)])))
+
+# Streams every audit in the package through AuditPackage.audit_to_dict, as the Helix and X15 task modules do
+def audit_to_dict_records(path):
+	count = 0
+	with hx_audit.AuditPackage(path) as audit_package:
+		for audit in audit_package.audits:
+			for audit_object in audit_package.audit_to_dict(audit, 'benchmark', batch_mode = False):
+				count += 1
+	return count
+
+# The payloads of the XML audits in the package with their item tag
+def xml_payloads(audit_package):
+	for audit in audit_package.audits:
+		result = audit_package.get_generator_result(audit['generator'])
+		if result and result['type'] == 'application/xml':
+			(root_tag, item_tag) = audit_package.get_payload_item_tag(result['payload'])
+			if item_tag:
+				yield (audit['generator'], result['payload'], item_tag)
+
+# Reads the records of every audit in the package as the stacking and file listing task modules do
+def audit_records(path):
+	count = 0
+	with hx_audit.AuditPackage(path) as audit_package:
+		for generator, payload_name, item_tag in xml_payloads(audit_package):
+			with audit_package.get_audit(payload_name = payload_name, open_only = True) as payload:
+				for record in hx_audit.iter_audit_records(payload, generator, item_tag):
+					count += 1
+	return count
+
+# audit_to_dict with lxml parsing the payload, lxml elements have the same API as ElementTree ones
+def lxml_audit_to_dict_records(path):
+	count = 0
+	with hx_audit.AuditPackage(path) as audit_package:
+		for generator, payload_name, item_tag in xml_payloads(audit_package):
+			with audit_package.get_audit(payload_name = payload_name, open_only = True) as payload:
+				for event, elem in lxml_etree.iterparse(payload, events = ("end",), tag = item_tag, encoding = 'utf-8', huge_tree = True):
+					result_dict = audit_package.xml_to_dict(elem)
+					elem.clear()
+					while elem.getprevious() is not None:
+						del elem.getparent()[0]
+					count += 1
+	return count
+
+def benchmark(path, rounds = 3):
+	methods = [('audit_to_dict', audit_to_dict_records), ('iter_audit_records', audit_records)]
+	if lxml_etree is not None:
+		methods.append(('audit_to_dict (lxml)', lxml_audit_to_dict_records))
+	
+	for name, f in methods:
+		best = None
+		for i in range(rounds):
+			start = time.perf_counter()
+			count = f(path)
+			elapsed = time.perf_counter() - start
+			if best is None or elapsed < best:
+				best = elapsed
+		print("  {0:<22} {1:>8} records {2:>8.3f}s {3:>10.0f} records/s".format(name, count, best, count / best if best else 0))
+
+def main(argv):
+	if len(argv) > 1:
+		for path in argv[1:]:
+			print(path)
+			benchmark(path)
+		return
+
+	temp_dir = tempfile.mkdtemp()
+	try:
+		for generator, item_name, item_template, count in AUDITS:
+			path = os.path.join(temp_dir, '{}.zip'.format(generator))
+			create_package(path, generator, item_template, count)
+			print("{0}: {1} {2} records".format(generator, count, item_name))
+			benchmark(path)
+	finally:
+		for file_name in os.listdir(temp_dir):
+			os.remove(os.path.join(temp_dir, file_name))
+		os.rmdir(temp_dir)
+
+if __name__ == '__main__':
+	main(sys.argv)